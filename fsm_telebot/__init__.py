@@ -1,18 +1,194 @@
 # -*- coding:utf-8; -*-
 
-import re
+import threading
+import time
 
 import telebot
-from telebot import util
 
+from fsm_telebot.context import FSMContext
+from fsm_telebot.dispatch import FILTER_COSTS, FILTERS, STATIC_FILTERS, UNKNOWN_FILTER_COST, HandlerList, UpdateContext, \
+    get_address
+from fsm_telebot.executor import ChatExecutor
 from fsm_telebot.storage.base import BaseStorage, DisabledStorage
+from fsm_telebot.timers import TimerWheel
+
+
+def _parse_id(value):
+    """
+    Convert chat or user id read from storage as string back to int, as Telegram sends it
+    :param value: Chat or user id
+    :return: int or str, if id isn't numeric
+    """
+    try:
+        parsed = int(value)
+    except ValueError:
+        return value
+    return parsed if str(parsed) == value else value
 
 
 class TeleBot(telebot.TeleBot):
-    def __init__(self, token, storage=DisabledStorage(), threaded=True, skip_pending=False, num_threads=2):
-        assert issubclass(storage.__class__, BaseStorage)
+    storage_class = BaseStorage
+    timer_tick = 1
+
+    def __init__(self, token, storage=DisabledStorage(), threaded=True, skip_pending=False, num_threads=2,
+                 ordered=False, max_queue=1000):
+        """
+        :param token: Bot API token
+        :param storage: Optional. Storage of states and data
+        :param threaded: Optional. Handle updates in worker threads
+        :param skip_pending: Optional. Skip updates received before start
+        :param num_threads: Optional. Number of worker threads
+        :param ordered: Optional. Handle updates of one chat one by one in order they were received,
+        updates of different chats are still handled in parallel. See ChatExecutor
+        :param max_queue: Optional. Maximum number of queued updates per worker thread if ordered
+        """
+        assert issubclass(storage.__class__, self.storage_class)
         self.storage = storage
-        super(TeleBot, self).__init__(token, threaded=threaded, skip_pending=skip_pending, num_threads=num_threads)
+        self.declared_states = None
+        self.profiler = None
+        self._contexts = threading.local()
+        self._timeouts = {}
+        self._timers = None
+        ordered = threaded and ordered
+        super(TeleBot, self).__init__(token, threaded=threaded and not ordered, skip_pending=skip_pending,
+                                      num_threads=num_threads)
+        if ordered:
+            self.threaded = True
+            self.worker_pool = ChatExecutor(num_shards=num_threads, max_queue=max_queue)
+
+        self.message_handlers = HandlerList()
+        self.edited_message_handlers = HandlerList()
+        self.channel_post_handlers = HandlerList()
+        self.edited_channel_post_handlers = HandlerList()
+        self.inline_handlers = HandlerList()
+        self.chosen_inline_handlers = HandlerList()
+        self.callback_query_handlers = HandlerList()
+        self.shipping_query_handlers = HandlerList()
+        self.pre_checkout_query_handlers = HandlerList()
+
+    def register_states(self, *groups):
+        """
+        Declare states of bot with StatesGroup classes.
+        After that, handler of undeclared state or setting undeclared state raises ValueError.
+        :param groups: StatesGroup subclasses
+        :return:
+        """
+        if self.declared_states is None:
+            self.declared_states = set()
+        for group in groups:
+            self.declared_states.update(group.states)
+
+        for handlers in (self.message_handlers, self.edited_message_handlers, self.channel_post_handlers,
+                         self.edited_channel_post_handlers, self.inline_handlers, self.chosen_inline_handlers,
+                         self.callback_query_handlers, self.shipping_query_handlers, self.pre_checkout_query_handlers):
+            for handler in handlers:
+                self._check_state(handler['filters'].get('state'))
+
+    def _check_state(self, state):
+        """
+        Raise ValueError if states are declared and state is not one of them
+        :param state: State or None
+        :return:
+        """
+        if state and self.declared_states is not None and state not in self.declared_states:
+            raise ValueError("State '{}' is not declared in registered states groups.".format(state))
+
+    def register_state_timeout(self, state, timeout, handler=None):
+        """
+        Reset state to None if user stays in it for timeout seconds.
+        Deadline is stored with state, so timers survive restart if storage persists deadlines.
+        Stored timers are restored when first timeout is registered, numeric ids are passed to handler as int
+        like ids of timers armed in process.
+        :param state: State
+        :param timeout: Seconds
+        Timers need synchronous storage, so bot with AsyncBaseStorage raises TypeError.
+        :param handler: Optional. Callable, which receives chat id, user id and timed out state
+        :return:
+        """
+        if not isinstance(self.storage, BaseStorage):
+            raise TypeError('State timeouts need BaseStorage, {} is not supported.'.format(type(self.storage).__name__))
+        self._check_state(state)
+        self._timeouts[state] = (timeout, handler)
+        if self._timers is None:
+            self._timers = TimerWheel(self._on_timeout, tick=self.timer_tick)
+            for chat, user, stored_state, deadline in self.storage.get_deadlines():
+                self._arm(_parse_id(chat), _parse_id(user), stored_state, deadline)
+            self._timers.start()
+
+    def timeout_handler(self, state, timeout):
+        """
+        Timeout handler decorator, see register_state_timeout.
+
+        Example:
+
+        @bot.timeout_handler(state='Order', timeout=600)
+        def order_timeout(chat_id, user_id, state):
+            bot.send_message(chat_id, 'Order is cancelled')
+
+        :param state: State
+        :param timeout: Seconds
+        """
+        def decorator(handler):
+            self.register_state_timeout(state, timeout, handler)
+            return handler
+
+        return decorator
+
+    def _deadline(self, state):
+        """
+        Get deadline of state set now
+        :param state: New state
+        :return: Unix time or None if state has no timeout
+        """
+        timeout = self._timeouts.get(state) if state else None
+        return time.time() + timeout[0] if timeout else None
+
+    def _arm(self, chat, user, state, deadline):
+        """
+        Arm timer of user in chat or cancel it if deadline is None
+        :param chat: Chat id
+        :param user: User id
+        :param state: State
+        :param deadline: Unix time or None
+        :return:
+        """
+        chat, user = self.storage.check_address(chat, user)
+        if deadline is None:
+            self._timers.cancel((str(chat), str(user)))
+        else:
+            self._timers.schedule((str(chat), str(user)), deadline, (chat, user, state))
+
+    def _on_timeout(self, key, value):
+        chat, _, _ = value
+        if self.threaded and isinstance(self.worker_pool, ChatExecutor):
+            self.worker_pool.submit(chat, self._expire, *value)
+        else:
+            self._exec_task(self._expire, *value)
+
+    def _expire(self, chat, user, state):
+        """
+        Reset timed out state and run timeout handler
+        :param chat: Chat id
+        :param user: User id
+        :param state: Timed out state
+        :return:
+        """
+        if (str(chat), str(user)) in self._timers:
+            # State was set again after timer fired
+            return
+        # Deadline is cleared with state in the same write
+        if not self.storage.transition(chat, user, expected=state, state=None):
+            # State was changed bypassing bot, deadline is stale
+            return
+        handler = self._timeouts.get(state, (None, None))[1]
+        if handler is not None:
+            self._run_in_context(chat, user, '', handler, chat, user, state)
+        else:
+            self.storage.flush(addresses=[(chat, user)])
+
+    def _build_handler_dict(self, handler, **filters):
+        self._check_state(filters.get('state'))
+        return super(TeleBot, self)._build_handler_dict(handler, **filters)
 
     def message_handler(self, state=None, commands=None, regexp=None, func=None, content_types=None, **kwargs):
         """
@@ -144,17 +320,204 @@ class TeleBot(telebot.TeleBot):
 
         return decorator
 
-    def _test_filter(self, filter, filter_value, message):
-        test_cases = {
-            'state': lambda msg: self.storage.get_state(msg.chat.id, msg.from_user.id, default='') == filter_value
-            if msg.from_user else self.storage.get_state(msg.chat.id, default='') == filter_value,
-            'content_types': lambda msg: msg.content_type in filter_value,
-            'regexp': lambda msg: msg.content_type == 'text' and re.search(filter_value, msg.text, re.IGNORECASE),
-            'commands': lambda msg: msg.content_type == 'text' and util.extract_command(msg.text) in filter_value,
-            'func': lambda msg: filter_value(msg)
-        }
+    def _build_handler_tests(self, filters):
+        """
+        Build filter callables of handler once, instead of building them on every test.
+        Tests are ordered by FILTER_COSTS, so cheap filters reject update before expensive ones run
+        :param filters: Handler filters
+        :return: List of (filter name, callable, which receives update and its dispatch context)
+        """
+        tests = []
+        for filter in sorted(filters, key=lambda filter: FILTER_COSTS.get(filter, UNKNOWN_FILTER_COST)):
+            filter_value = filters[filter]
+            if filter_value is None or filter == 'state':
+                continue
+            factory = FILTERS.get(filter)
+            if factory is None:
+                tests.append((filter, lambda update, context, filter=filter, filter_value=filter_value:
+                              self._test_filter(filter, filter_value, update)))
+            else:
+                tests.append((filter, factory(filter_value)))
+        return tests
+
+    def _test_handler(self, handler, update, context):
+        """
+        Test all handler filters except state, which is already checked by handler index
+        :param handler: Handler dict
+        :param update: Message, callback query, inline query, etc.
+        :param context: Update dispatch context
+        :return:
+        """
+        tests = self._handler_tests(handler)
+        if self.profiler is not None:
+            return self.profiler.test(handler, tests, update, context)
+        for _, test in tests:
+            if not test(update, context):
+                return False
+        return True
+
+    def _handler_tests(self, handler):
+        """
+        Get filter tests of handler, they are built on first use
+        :param handler: Handler dict
+        :return: List of (filter name, test)
+        """
+        tests = handler.get('tests')
+        if tests is None:
+            tests = handler['tests'] = self._build_handler_tests(handler['filters'])
+        return tests
 
-        return test_cases.get(filter, lambda msg: False)(message)
+    def _needs_state(self, handlers, update, context):
+        """
+        Whether any handler with state passes static filters (content_types, commands, regexp),
+        if none does, update is dispatched without reading state from storage
+        :param handlers: HandlerList
+        :param update: Message, callback query, inline query, etc.
+        :param context: Update dispatch context
+        :return:
+        """
+        for handler in handlers.stated_router().match(update, context):
+            # Tests are ordered by cost, static ones go first
+            for filter, test in self._handler_tests(handler):
+                if filter not in STATIC_FILTERS:
+                    return True
+                if not test(update, context):
+                    break
+            else:
+                return True
+        return False
+
+    def _notify_command_handlers(self, handlers, new_messages):
+        if not isinstance(handlers, HandlerList):
+            return super(TeleBot, self)._notify_command_handlers(handlers, new_messages)
+
+        if self.threaded and isinstance(self.worker_pool, ChatExecutor):
+            # State must be read after previous update of the chat is handled, so whole dispatch goes to executor
+            for message in new_messages:
+                chat, user = get_address(message)
+                self.worker_pool.submit(chat if chat is not None else user, self._dispatch, handlers, message)
+            return
+
+        for message in new_messages:
+            context = UpdateContext(message, self.storage)
+            handler = self._find_handler(handlers, message, context)
+            if handler is not None:
+                self._exec_task(self._run_handler, handler['function'], message, context.known_state)
+
+    def _find_handler(self, handlers, update, context=None):
+        """
+        Find first handler which can handle update
+        :param handlers: HandlerList
+        :param update: Message, callback query, inline query, etc.
+        :param context: Optional. Update dispatch context
+        :return: Handler dict or None
+        """
+        if context is None:
+            context = UpdateContext(update, self.storage)
+        if not handlers.has_states:
+            for handler in handlers.router().match(update, context):
+                if self._test_handler(handler, update, context):
+                    return handler
+            return None
+
+        # Stateless handlers registered before stated ones are tested before state is read from storage
+        leading = handlers.leading
+        for handler in handlers.router().match(update, context, stop=leading):
+            if self._test_handler(handler, update, context):
+                return handler
+        router = handlers.router(self._resolve_state(context)) if self._needs_state(handlers, update, context) \
+            else handlers.router()
+        for handler in router.match(update, context, start=leading):
+            if self._test_handler(handler, update, context):
+                return handler
+        return None
+
+    def _resolve_state(self, context):
+        """
+        Read state of update sender, time it if profiler is enabled
+        :param context: Update dispatch context
+        :return: State or ''
+        """
+        if self.profiler is None:
+            return context.state
+        start = time.perf_counter()
+        state = context.state
+        self.profiler.record(None, 'state', time.perf_counter() - start, True)
+        return state
+
+    def _dispatch(self, handlers, update):
+        """
+        Find first handler which can handle update and run it in current thread
+        :param handlers: HandlerList
+        :param update: Message, callback query, inline query, etc.
+        :return:
+        """
+        context = UpdateContext(update, self.storage)
+        handler = self._find_handler(handlers, update, context)
+        if handler is not None:
+            self._run_handler(handler['function'], update, context.known_state)
+
+    def _run_handler(self, function, update, state=None):
+        """
+        Run handler in FSM context of update sender, commit context if handler returns and flush storage
+        :param function: Handler function
+        :param update: Message, callback query, inline query, etc.
+        :param state: Optional. State of sender, if it was read by dispatcher
+        :return:
+        """
+        chat, user = get_address(update)
+        self._run_in_context(chat, user, state, function, update)
+
+    def _run_in_context(self, chat, user, state, function, *args):
+        """
+        Run function in FSM context of user in chat, commit context if function returns and flush storage
+        :param chat: Chat id
+        :param user: User id
+        :param state: State, if it's known, else None
+        :param function: Callable
+        :return:
+        """
+        context = None
+        if chat is not None or user is not None:
+            context = FSMContext(self.storage, chat, user, state=state,
+                                 deadline=self._deadline if self._timeouts else None)
+        previous = self.current_context()
+        self._contexts.context = context
+        try:
+            function(*args)
+            if context is not None:
+                record = context.commit()
+                if 'deadline' in record:
+                    self._arm(context.chat, context.user, record['state'], record['deadline'])
+        finally:
+            self._contexts.context = previous
+            self.storage.flush(addresses=[(context.chat, context.user)] if context is not None else [])
+
+    def current_context(self):
+        """
+        Get FSM context of update handled in current thread.
+        Bot methods called for sender of update read and write through it,
+        so all changes made by handler are written to storage with one call after handler returns,
+        and dropped if handler raises.
+        :return: FSMContext or None outside of handler
+        """
+        return getattr(self._contexts, 'context', None)
+
+    def _context(self, chat_id, user_id):
+        """
+        Get current FSM context if it belongs to user in chat
+        :param chat_id:
+        :param user_id:
+        :return: FSMContext or None
+        """
+        context = self.current_context()
+        return context if context is not None and context.owns(chat_id, user_id) else None
+
+    def _test_filter(self, filter, filter_value, message):
+        factory = FILTERS.get(filter)
+        if factory is None:
+            return False
+        return factory(filter_value)(message, UpdateContext(message, self.storage))
 
     def set_state(self, state, chat_id=None, user_id=None):
         """
@@ -165,7 +528,14 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional.
         :return:
         """
-        self.storage.set_state(chat_id, user_id, state)
+        self._check_state(state)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.set_state(state)
+        elif self._timeouts:
+            self._set_record(chat_id, user_id, {'state': state})
+        else:
+            self.storage.set_state(chat_id, user_id, state)
 
     def set_data(self, data, chat_id=None, user_id=None):
         """
@@ -176,7 +546,11 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional.
         :return:
         """
-        self.storage.set_data(chat_id, user_id, data)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.set_data(data)
+        else:
+            self.storage.set_data(chat_id, user_id, data)
 
     def get_state(self, chat_id=None, user_id=None, default=None):
         """
@@ -187,7 +561,10 @@ class TeleBot(telebot.TeleBot):
         :param default: Optional. Returns if no state
         :return:
         """
-        self.storage.get_state(chat_id, user_id, default=default)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            return context.get_state(default=default)
+        return self.storage.get_state(chat_id, user_id, default=default)
 
     def get_data(self, chat_id=None, user_id=None, default=None):
         """
@@ -198,7 +575,10 @@ class TeleBot(telebot.TeleBot):
         :param default: Optional. Returns if no data
         :return:
         """
-        self.storage.get_state(chat_id, user_id, default=default)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            return context.get_data(default=default)
+        return self.storage.get_data(chat_id, user_id, default=default)
 
     def update_data(self, data, chat_id=None, user_id=None):
         """
@@ -209,7 +589,89 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional.
         :return:
         """
-        self.storage.update_data(chat_id, user_id, data=data)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.update_data(data)
+        else:
+            self.storage.update_data(chat_id, user_id, data=data)
+
+    def _set_record(self, chat_id, user_id, record):
+        """
+        Write record with deadline of its state and arm timer
+        :param chat_id:
+        :param user_id:
+        :param record: Record with state, see BaseStorage.set_record
+        :return:
+        """
+        deadline = record['deadline'] = self._deadline(record['state'])
+        self.storage.set_record(chat_id, user_id, record)
+        self._arm(chat_id, user_id, record['state'], deadline)
+
+    def _sync_context(self, chat_id, user_id):
+        """
+        Commit current FSM context of user in chat before atomic storage operation, which bypasses it
+        :param chat_id:
+        :param user_id:
+        :return: FSMContext to invalidate after operation or None
+        """
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.commit()
+        return context
+
+    def transition(self, expected, state, chat_id=None, user_id=None):
+        """
+        Set state for user in chat, only if current state is expected.
+        At least chat_id or user_id must be passed.
+        :param expected: Expected current state, None means no state.
+        :param state: New state.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: True if state was set
+        """
+        self._check_state(state)
+        deadline = self._deadline(state)
+        context = self._sync_context(chat_id, user_id)
+        try:
+            done = self.storage.transition(chat_id, user_id, expected=expected, state=state, deadline=deadline)
+        finally:
+            if context is not None:
+                context.invalidate()
+        if done and self._timeouts:
+            self._arm(chat_id, user_id, state, deadline)
+        return done
+
+    def mutate_data(self, fn, chat_id=None, user_id=None):
+        """
+        Replace data for user in chat with result of function.
+        At least chat_id or user_id must be passed.
+        :param fn: Callable, which receives copy of current data and returns new data.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: New data
+        """
+        context = self._sync_context(chat_id, user_id)
+        try:
+            return self.storage.mutate_data(chat_id, user_id, fn=fn)
+        finally:
+            if context is not None:
+                context.invalidate()
+
+    def patch_data(self, ops, chat_id=None, user_id=None):
+        """
+        Apply patch operations to data for user in chat atomically, i.e. [('inc', 'counter'), ('append', 'cart', item)].
+        At least chat_id or user_id must be passed.
+        :param ops: Iterable of (operation, path) or (operation, path, value), see storage.base.apply_patch.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: New data
+        """
+        context = self._sync_context(chat_id, user_id)
+        try:
+            return self.storage.patch_data(chat_id, user_id, ops=ops)
+        finally:
+            if context is not None:
+                context.invalidate()
 
     def reset_state(self, chat_id=None, user_id=None):
         """
@@ -219,7 +681,13 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional
         :return:
         """
-        self.storage.reset_state(chat_id, user_id)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.reset_state()
+        elif self._timeouts:
+            self._set_record(chat_id, user_id, {'state': None, 'data': {}})
+        else:
+            self.storage.reset_state(chat_id, user_id)
 
     def reset_data(self, chat_id=None, user_id=None):
         """
@@ -229,7 +697,11 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional
         :return:
         """
-        self.storage.reset_data(chat_id, user_id)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.reset_data()
+        else:
+            self.storage.reset_data(chat_id, user_id)
 
     def finish_user(self, chat_id=None, user_id=None):
         """
@@ -239,4 +711,10 @@ class TeleBot(telebot.TeleBot):
         :param user_id: Optional
         :return:
         """
-        self.storage.finish(chat_id, user_id)
+        context = self._context(chat_id, user_id)
+        if context is not None:
+            context.finish()
+        elif self._timeouts:
+            self._set_record(chat_id, user_id, {'state': None, 'data': {}})
+        else:
+            self.storage.finish(chat_id, user_id)
@@ -0,0 +1,280 @@
+# -*- coding:utf-8; -*-
+
+import asyncio
+import functools
+import time
+
+import telebot
+
+from fsm_telebot import TeleBot
+from fsm_telebot.dispatch import HandlerList, UpdateContext, get_address
+from fsm_telebot.storage.base import AsyncBaseStorage, AsyncDisabledStorage
+
+
+class AsyncTeleBot(TeleBot):
+    """
+    Asyncio bot.
+    Handlers may be coroutines and states are awaited from AsyncBaseStorage.
+    Every update is dispatched in its own task, so slow conversation doesn't block others.
+    Bot API methods are still blocking, use `await bot.call(bot.send_message, ...)` to run them in executor.
+    State timeouts need synchronous storage, so register_state_timeout raises TypeError.
+    """
+    storage_class = AsyncBaseStorage
+
+    def __init__(self, token, storage=AsyncDisabledStorage(), skip_pending=False, loop=None):
+        super(AsyncTeleBot, self).__init__(token, storage=storage, threaded=False, skip_pending=skip_pending)
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self._tasks = set()
+        self._polling = False
+
+    def _spawn(self, coroutine):
+        """
+        Run coroutine in background task
+        :param coroutine:
+        :return: Task
+        """
+        task = asyncio.ensure_future(coroutine, loop=self.loop)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            telebot.logger.error('Exception in handler: {}'.format(task.exception()))
+
+    def _exec_task(self, task, *args, **kwargs):
+        result = task(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            self._spawn(result)
+
+    async def _dispatch(self, handlers, update):
+        """
+        Find first handler which can handle update and run it
+        :param handlers: HandlerList
+        :param update: Message, callback query, inline query, etc.
+        :return:
+        """
+        context = UpdateContext(update, self.storage)
+        leading = handlers.leading if handlers.has_states else None
+        handler = self._first_passed(handlers.router().match(update, context, stop=leading), update, context)
+
+        if handler is None and leading is not None and not self._needs_state(handlers, update, context):
+            handler = self._first_passed(handlers.router().match(update, context, start=leading), update, context)
+        elif handler is None and leading is not None:
+            chat, user = get_address(update)
+            start = time.perf_counter()
+            state = '' if chat is None and user is None else await self.storage.get_state(chat, user, default='')
+            if self.profiler is not None:
+                self.profiler.record(None, 'state', time.perf_counter() - start, True)
+            context = UpdateContext(update, self.storage, state=state)
+            handler = self._first_passed(handlers.router(state).match(update, context, start=leading), update, context)
+
+        if handler is not None:
+            result = handler['function'](update)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def _first_passed(self, handlers, update, context):
+        """
+        Get first handler which filters pass
+        :param handlers: Iterable of handler dicts
+        :param update: Message, callback query, inline query, etc.
+        :param context: Update dispatch context
+        :return: Handler dict or None
+        """
+        for handler in handlers:
+            if self._test_handler(handler, update, context):
+                return handler
+        return None
+
+    def _notify_command_handlers(self, handlers, new_messages):
+        if not isinstance(handlers, HandlerList):
+            return super(AsyncTeleBot, self)._notify_command_handlers(handlers, new_messages)
+
+        for message in new_messages:
+            self._spawn(self._dispatch(handlers, message))
+
+    async def join(self):
+        """
+        Wait until all running handlers are done
+        :return:
+        """
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def call(self, method, *args, **kwargs):
+        """
+        Run blocking method (i.e. Bot API call) in executor
+        :param method: Callable
+        :return: Method result
+        """
+        return await self.loop.run_in_executor(None, functools.partial(method, *args, **kwargs))
+
+    def _skip_pending_updates(self):
+        """
+        Get and discard all pending updates
+        :return: Total updates skipped
+        """
+        total = 0
+        updates = self.get_updates(offset=self.last_update_id, timeout=1)
+        while updates:
+            total += len(updates)
+            self.last_update_id = max(self.last_update_id, *(update.update_id for update in updates))
+            updates = self.get_updates(offset=self.last_update_id + 1, timeout=1)
+        return total
+
+    async def polling(self, none_stop=False, interval=0, timeout=20):
+        """
+        Get updates with long polling and dispatch them until stop_polling is called.
+        :param none_stop: Do not stop polling when an exception occurs.
+        :param interval: Delay between requests.
+        :param timeout: Timeout in seconds for long polling.
+        :return:
+        """
+        self._polling = True
+        error_interval = .25
+
+        if self.skip_pending:
+            telebot.logger.debug('Skipped {} pending messages'.format(await self.call(self._skip_pending_updates)))
+            self.skip_pending = False
+
+        while self._polling:
+            try:
+                updates = await self.call(self.get_updates, offset=self.last_update_id + 1, timeout=timeout)
+                self.process_new_updates(updates)
+                error_interval = .25
+            except Exception as e:
+                telebot.logger.error(e)
+                if not none_stop:
+                    break
+                await asyncio.sleep(error_interval)
+                error_interval *= 2
+            if interval:
+                await asyncio.sleep(interval)
+
+        self._polling = False
+        telebot.logger.info('Stopped polling.')
+
+    def stop_polling(self):
+        self._polling = False
+
+    async def set_state(self, state, chat_id=None, user_id=None):
+        """
+        Set state for user in chat.
+        At least chat_id or user_id must be passed.
+        :param state:
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return:
+        """
+        await self.storage.set_state(chat_id, user_id, state)
+
+    async def set_data(self, data, chat_id=None, user_id=None):
+        """
+        Set data for user in chat.
+        At least chat_id or user_id must be passed.
+        :param data:
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return:
+        """
+        await self.storage.set_data(chat_id, user_id, data)
+
+    async def get_state(self, chat_id=None, user_id=None, default=None):
+        """
+        Get state for user in chat.
+        At least chat_id or user_id must be passed.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :param default: Optional. Returns if no state
+        :return:
+        """
+        return await self.storage.get_state(chat_id, user_id, default=default)
+
+    async def get_data(self, chat_id=None, user_id=None, default=None):
+        """
+        Get data for user in chat.
+        At least chat_id or user_id must be passed.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :param default: Optional. Returns if no data
+        :return:
+        """
+        return await self.storage.get_data(chat_id, user_id, default=default)
+
+    async def update_data(self, data, chat_id=None, user_id=None):
+        """
+        Update data for user in chat.
+        At least chat_id or user_id must be passed.
+        :param data:
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return:
+        """
+        await self.storage.update_data(chat_id, user_id, data=data)
+
+    async def reset_state(self, chat_id=None, user_id=None):
+        """
+        Reset state for user in chat.
+        At least chat_id or user_id must be passed.
+        :param chat_id: Optional
+        :param user_id: Optional
+        :return:
+        """
+        await self.storage.reset_state(chat_id, user_id)
+
+    async def reset_data(self, chat_id=None, user_id=None):
+        """
+        Reset data for user in chat.
+        At least chat_id or user_id must be passed.
+        :param chat_id: Optional
+        :param user_id: Optional
+        :return:
+        """
+        await self.storage.reset_data(chat_id, user_id)
+
+    async def finish_user(self, chat_id=None, user_id=None):
+        """
+        Reset all for user in chat.
+        At least chat_id or user_id must be passed.
+        :param chat_id: Optional
+        :param user_id: Optional
+        :return:
+        """
+        await self.storage.finish(chat_id, user_id)
+
+    async def transition(self, expected, state, chat_id=None, user_id=None):
+        """
+        Set state for user in chat, only if current state is expected.
+        At least chat_id or user_id must be passed.
+        :param expected: Expected current state, None means no state.
+        :param state: New state.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: True if state was set
+        """
+        self._check_state(state)
+        return await self.storage.transition(chat_id, user_id, expected=expected, state=state)
+
+    async def mutate_data(self, fn, chat_id=None, user_id=None):
+        """
+        Replace data for user in chat with result of function.
+        At least chat_id or user_id must be passed.
+        :param fn: Callable, which receives copy of current data and returns new data.
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: New data
+        """
+        return await self.storage.mutate_data(chat_id, user_id, fn=fn)
+
+    async def patch_data(self, ops, chat_id=None, user_id=None):
+        """
+        Apply patch operations to data for user in chat, see storage.base.apply_patch.
+        At least chat_id or user_id must be passed.
+        :param ops: Iterable of (operation, path) or (operation, path, value).
+        :param chat_id: Optional.
+        :param user_id: Optional.
+        :return: New data
+        """
+        return await self.storage.patch_data(chat_id, user_id, ops=ops)
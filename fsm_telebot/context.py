@@ -0,0 +1,192 @@
+# -*- coding:utf-8; -*-
+
+import typing
+
+from fsm_telebot.storage.base import BaseStorage
+
+_UNKNOWN = object()
+
+
+class FSMContext:
+    """
+    Unit of work of one handler call for user in chat.
+    State and data are read from storage at most once, changes are kept in memory
+    and written to storage with single set_record on commit.
+    TeleBot creates context for every handled update, commits it when handler returns and drops it if handler raises.
+    """
+    def __init__(self,
+                 storage: BaseStorage,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 state: typing.Optional[str] = None,
+                 deadline: typing.Optional[typing.Callable] = None):
+        """
+        :param storage: Storage of state and data
+        :param chat: Chat id
+        :param user: User id
+        :param state: Optional. Already known state, '' means no state. If None, state is read on demand
+        :param deadline: Optional. Callable, which receives new state and returns its deadline,
+        deadline is written with state
+        """
+        self.storage = storage
+        self.deadline = deadline
+        self.chat, self.user = storage.check_address(chat, user)
+        self._state = _UNKNOWN if state is None else (state or None)
+        self._data = _UNKNOWN
+        self._updates = None
+        self._state_dirty = False
+        self._data_dirty = False
+
+    def owns(self,
+             chat: typing.Union[int, str, None] = None,
+             user: typing.Union[int, str, None] = None) -> bool:
+        """
+        Whether context belongs to user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+        chat, user = self.storage.check_address(chat, user)
+        return str(chat) == str(self.chat) and str(user) == str(self.user)
+
+    @property
+    def changed(self) -> bool:
+        """
+        Whether context has changes, which are not committed
+        :return:
+        """
+        return self._state_dirty or self._data_dirty or bool(self._updates)
+
+    def _load(self):
+        """
+        Read unknown state and data from storage with one call
+        :return:
+        """
+        if self._state is _UNKNOWN and self._data is _UNKNOWN:
+            record = self.storage.get_record(self.chat, self.user)
+            self._state, data = record['state'] or None, record['data']
+        elif self._data is _UNKNOWN:
+            data = self.storage.get_data(self.chat, self.user)
+        else:
+            self._state = self.storage.get_state(self.chat, self.user)
+            return
+        self._data = dict(data) if data else {}
+        if self._updates:
+            self._data.update(self._updates)
+
+    def get_state(self, default: typing.Optional[str] = None) -> typing.Optional[str]:
+        """
+        Get state
+        :param default: Returns if no state.
+        :return: State
+        """
+        if self._state is _UNKNOWN:
+            self._load()
+        return self._state or default
+
+    def get_data(self, default: typing.Optional[typing.Dict] = None) -> typing.Dict:
+        """
+        Get data
+        :param default: Returns if no data.
+        :return: Copy of data
+        """
+        if self._data is _UNKNOWN:
+            self._load()
+        return dict(self._data) or default
+
+    def set_state(self, state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set state, written on commit
+        :param state:
+        :return:
+        """
+        self._state = state or None
+        self._state_dirty = True
+
+    def set_data(self, data: typing.Dict = None):
+        """
+        Set data, written on commit
+        :param data:
+        :return:
+        """
+        self._data = dict(data) if data else {}
+        self._data_dirty = True
+        self._updates = None
+
+    def update_data(self, data: typing.Dict = None):
+        """
+        Update data, written on commit. Data is not read from storage for that
+        :param data: Data to update
+        :return:
+        """
+        if not data:
+            return
+        if self._data is not _UNKNOWN:
+            self._data.update(data)
+        if not self._data_dirty:
+            if self._updates is None:
+                self._updates = {}
+            self._updates.update(data)
+
+    def reset_data(self):
+        """
+        Reset data, written on commit
+        :return:
+        """
+        self.set_data({})
+
+    def reset_state(self, with_data: typing.Optional[bool] = True):
+        """
+        Reset state, written on commit
+        :param with_data: Optional. If true, resets data
+        :return:
+        """
+        self.set_state(None)
+        if with_data:
+            self.reset_data()
+
+    def finish(self):
+        """
+        Fully reset state and data, written on commit
+        :return:
+        """
+        self.reset_state(with_data=True)
+
+    def commit(self):
+        """
+        Write changes to storage with one call
+        :return: Written record, see BaseStorage.set_record
+        """
+        record = {}
+        if self._state_dirty:
+            record['state'] = self._state
+            if self.deadline is not None:
+                record['deadline'] = self.deadline(self._state)
+        if self._data_dirty:
+            record['data'] = dict(self._data)
+        elif self._updates:
+            record['update_data'] = self._updates
+        if record:
+            self.storage.set_record(self.chat, self.user, record)
+        self._state_dirty = self._data_dirty = False
+        self._updates = None
+        return record
+
+    def rollback(self):
+        """
+        Drop changes, next read gets state and data from storage
+        :return:
+        """
+        self._state_dirty = self._data_dirty = False
+        self._updates = None
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget state and data read from storage, i.e. after they were written bypassing the context
+        :return:
+        """
+        if not self._state_dirty:
+            self._state = _UNKNOWN
+        if not self._data_dirty:
+            self._data = _UNKNOWN
@@ -0,0 +1,388 @@
+# -*- coding:utf-8; -*-
+
+import collections
+import heapq
+import operator
+import re
+import threading
+import time
+
+from telebot import util
+
+_UNSET = object()
+# Inline flags anywhere in pattern would apply to all joined patterns, numbered backreferences break when joined
+_UNCOMBINABLE = re.compile(r'\(\?[aiLmsux]+\)|\\[1-9]')
+
+
+def get_address(update):
+    """
+    Get chat and user ids of update sender
+    :param update: Message, callback query, inline query, etc.
+    :return: (chat id, user id), any of them may be None
+    """
+    chat = getattr(update, 'chat', None)
+    if chat is None and getattr(update, 'message', None) is not None:
+        chat = update.message.chat
+    user = getattr(update, 'from_user', None)
+    return chat.id if chat else None, user.id if user else None
+
+
+class UpdateContext:
+    """
+    Per-update dispatch context.
+    Resolves sender address and state at most once and shares them between all handler tests of update.
+    """
+    __slots__ = ('update', 'storage', '_address', '_state', '_command')
+
+    def __init__(self, update, storage, state=None):
+        """
+        :param update: Message, callback query, inline query, etc.
+        :param storage: Storage to resolve state from
+        :param state: Optional. Already resolved state
+        """
+        self.update = update
+        self.storage = storage
+        self._address = None
+        self._state = state
+        self._command = _UNSET
+
+    @property
+    def address(self):
+        """
+        Sender (chat id, user id)
+        :return:
+        """
+        if self._address is None:
+            self._address = get_address(self.update)
+        return self._address
+
+    @property
+    def state(self):
+        """
+        Sender state or '' if no state
+        :return:
+        """
+        if self._state is None:
+            chat, user = self.address
+            if chat is None and user is None:
+                self._state = ''
+            else:
+                self._state = self.storage.get_state(chat, user, default='')
+        return self._state
+
+    @property
+    def known_state(self):
+        """
+        Sender state if it was already resolved, else None
+        :return:
+        """
+        return self._state
+
+    @property
+    def command(self):
+        """
+        Command of text message without '/' and bot name, None if update is not command
+        :return:
+        """
+        if self._command is _UNSET:
+            update = self.update
+            if getattr(update, 'content_type', None) == 'text' and update.text:
+                self._command = util.extract_command(update.text)
+            else:
+                self._command = None
+        return self._command
+
+
+def _state_filter(filter_value):
+    return lambda update, context: context.state == filter_value
+
+
+def _content_types_filter(filter_value):
+    return lambda update, context: update.content_type in filter_value
+
+
+def _compile(pattern):
+    return pattern if hasattr(pattern, 'search') else re.compile(pattern, re.IGNORECASE)
+
+
+def _regexp_filter(filter_value):
+    search = _compile(filter_value).search
+    return lambda update, context: update.content_type == 'text' and search(update.text)
+
+
+def _commands_filter(filter_value):
+    commands = frozenset(filter_value)
+    return lambda update, context: context.command in commands
+
+
+def _func_filter(filter_value):
+    return lambda update, context: filter_value(update)
+
+
+FILTERS = {
+    'state': _state_filter,
+    'content_types': _content_types_filter,
+    'regexp': _regexp_filter,
+    'commands': _commands_filter,
+    'func': _func_filter,
+}
+
+# Filters are tested from cheap to expensive, unknown filters are tested before state, which reads storage
+FILTER_COSTS = {
+    'content_types': 0,
+    'commands': 1,
+    'regexp': 2,
+    'func': 3,
+    'state': 5,
+}
+UNKNOWN_FILTER_COST = 4
+# Filters, which depend only on update, they are tested to find out whether state must be read at all
+STATIC_FILTERS = frozenset(['content_types', 'commands', 'regexp'])
+
+
+class FilterProfiler:
+    """
+    Collects time and rejections of every filter of every handler.
+    Enable it with `bot.profiler = FilterProfiler()`, it slows dispatch down a bit.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = collections.OrderedDict()
+
+    @staticmethod
+    def _name(handler_dict):
+        if handler_dict is None:
+            return '*'
+        function = handler_dict['function']
+        return '{}.{}'.format(getattr(function, '__module__', None), getattr(function, '__qualname__', repr(function)))
+
+    def record(self, handler_dict, filter, elapsed, passed):
+        """
+        Record filter test
+        :param handler_dict: Handler dict or None for dispatch itself (i.e. state lookup)
+        :param filter: Filter name
+        :param elapsed: Seconds
+        :param passed: Whether filter passed
+        :return:
+        """
+        key = (self._name(handler_dict), filter)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = self._records[key] = [0, 0, 0.0]
+            record[0] += 1
+            record[1] += not passed
+            record[2] += elapsed
+
+    def test(self, handler_dict, tests, update, context):
+        """
+        Test handler filters and record every test
+        :param handler_dict: Handler dict
+        :param tests: List of (filter name, test)
+        :param update: Message, callback query, inline query, etc.
+        :param context: Update dispatch context
+        :return: Whether all filters passed
+        """
+        for filter, test in tests:
+            start = time.perf_counter()
+            passed = bool(test(update, context))
+            self.record(handler_dict, filter, time.perf_counter() - start, passed)
+            if not passed:
+                return False
+        return True
+
+    def stats(self):
+        """
+        Get records, most expensive first
+        :return: List of dicts with handler, filter, calls, rejected, rejection_rate and time in seconds
+        """
+        with self._lock:
+            records = [{'handler': handler, 'filter': filter, 'calls': calls, 'rejected': rejected,
+                        'rejection_rate': rejected / calls, 'time': elapsed}
+                       for (handler, filter), (calls, rejected, elapsed) in self._records.items()]
+        return sorted(records, key=operator.itemgetter('time'), reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+
+
+class Router:
+    """
+    Finds handlers, whose regexp and commands filters can pass, without testing every handler.
+    Handlers with commands are found by command name.
+    Regexps are combined into one alternation, so text which matches none of them is rejected by single search.
+    Other filters are not checked by router.
+    """
+    def __init__(self, handlers):
+        """
+        :param handlers: Handler dicts in order they must be tested
+        """
+        self.handlers = handlers
+        self._free = []
+        self._commands = {}
+        self._regexps = []
+        self._combined = None
+
+        regexps = []
+        for position, handler_dict in enumerate(handlers):
+            filters = handler_dict['filters']
+            if filters.get('commands') is not None:
+                for command in filters['commands']:
+                    self._commands.setdefault(command, []).append(position)
+            elif isinstance(filters.get('regexp'), str):
+                regexps.append((position, filters['regexp']))
+            else:
+                self._free.append(position)
+
+        try:
+            if any(_UNCOMBINABLE.search(pattern) for _, pattern in regexps):
+                raise re.error('Patterns can not be combined')
+            if regexps:
+                self._combined = re.compile('|'.join('(?:{})'.format(pattern) for _, pattern in regexps), re.IGNORECASE)
+            self._regexps = [position for position, _ in regexps]
+        except re.error:
+            # Such regexps are tested for every update, like filters without router
+            self._free = sorted(self._free + [position for position, _ in regexps])
+
+    def match(self, update, context, start=0, stop=None):
+        """
+        Get handlers, which may handle update, in order
+        :param update: Message, callback query, inline query, etc.
+        :param context: Update dispatch context
+        :param start: Optional. Skip handlers before this position
+        :param stop: Optional. Skip handlers from this position
+        :return: Iterable of handler dicts
+        """
+        positions = [self._free]
+        command = context.command
+        if command is not None and command in self._commands:
+            positions.append(self._commands[command])
+        if self._combined is not None and getattr(update, 'content_type', None) == 'text' and update.text \
+                and self._combined.search(update.text):
+            positions.append(self._regexps)
+
+        handlers = self.handlers
+        positions = positions[0] if len(positions) == 1 else heapq.merge(*positions)
+        if start or stop is not None:
+            stop = len(handlers) if stop is None else stop
+            return (handlers[position] for position in positions if start <= position < stop)
+        return (handlers[position] for position in positions)
+
+
+class HandlerList(list):
+    """
+    List of handlers indexed by state.
+    Handlers registered with `state` are kept in per-state buckets, stateless handlers in separate one,
+    so dispatcher can get candidates for current state without testing state filter of every handler.
+    """
+    def __init__(self, *args):
+        super(HandlerList, self).__init__(*args)
+        self._reindex()
+
+    def _reindex(self):
+        """
+        Rebuild index from list contents
+        :return:
+        """
+        self._stated = {}
+        self._stateless = []
+        self._candidates = {}
+        self._routers = {}
+        self._stated_router = None
+        self._leading = 0
+        self._indexed = 0
+        for handler_dict in self:
+            self._index(handler_dict)
+
+    def _index(self, handler_dict):
+        """
+        Put handler into state bucket
+        :param handler_dict: Handler dict
+        :return:
+        """
+        entry = (self._indexed, handler_dict)
+        state = handler_dict['filters'].get('state')
+        if state is None:
+            self._stateless.append(entry)
+            if not self._stated:
+                self._leading += 1
+        else:
+            self._stated.setdefault(state, []).append(entry)
+        self._indexed += 1
+        self._candidates.clear()
+        self._routers.clear()
+        self._stated_router = None
+
+    def append(self, handler_dict):
+        super(HandlerList, self).append(handler_dict)
+        self._index(handler_dict)
+
+    @property
+    def has_states(self):
+        """
+        Whether any handler requires state
+        :return:
+        """
+        if self._indexed != len(self):
+            self._reindex()
+        return bool(self._stated)
+
+    @property
+    def leading(self):
+        """
+        Number of stateless handlers registered before first handler with state.
+        They are first candidates for any state, so they can be tested before state is known
+        :return:
+        """
+        if self._indexed != len(self):
+            self._reindex()
+        return self._leading
+
+    def candidates(self, state=None):
+        """
+        Get handlers which can handle update with given state, in registration order
+        :param state: Current state
+        :return: List of handler dicts
+        """
+        if self._indexed != len(self):
+            self._reindex()
+        if state not in self._stated:
+            state = None
+        try:
+            return self._candidates[state]
+        except KeyError:
+            pass
+        entries = self._stateless
+        if state is not None:
+            entries = sorted(entries + self._stated[state], key=operator.itemgetter(0))
+        candidates = self._candidates[state] = [handler_dict for _, handler_dict in entries]
+        return candidates
+
+    def router(self, state=None):
+        """
+        Get router of handlers, which can handle update with given state
+        :param state: Current state
+        :return: Router
+        """
+        if self._indexed != len(self):
+            self._reindex()
+        if state not in self._stated:
+            state = None
+        router = self._routers.get(state)
+        if router is None:
+            router = self._routers[state] = Router(self.candidates(state))
+        return router
+
+    def stated_router(self):
+        """
+        Get router of handlers with any state
+        :return: Router
+        """
+        if self._indexed != len(self):
+            self._reindex()
+        router = self._stated_router
+        if router is None:
+            entries = sorted(entry for entries in self._stated.values() for entry in entries)
+            router = self._stated_router = Router([handler_dict for _, handler_dict in entries])
+        return router
@@ -0,0 +1,135 @@
+# -*- coding:utf-8; -*-
+
+import itertools
+import queue
+import sys
+import threading
+import time
+import traceback
+import typing
+
+import telebot
+
+_STOP = object()
+
+
+class _Shard(threading.Thread):
+    """
+    Worker thread with its own bounded queue
+    """
+    def __init__(self, executor, index, max_queue):
+        super(_Shard, self).__init__(name='ChatExecutorShard{}'.format(index), daemon=True)
+        self.executor = executor
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.processed = 0
+        self.blocked = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.start()
+
+    @property
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'processed': self.processed, 'blocked': self.blocked,
+                'waited': self.waited, 'max_wait': self.max_wait}
+
+    def put(self, item, timeout=None):
+        if self.queue.full():
+            self.blocked += 1
+        self.queue.put(item, timeout=timeout)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            queued, task, args, kwargs = item
+            wait = time.monotonic() - queued
+            self.waited += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                telebot.logger.error('{} occurred, args={}\n{}'.format(type(e).__name__, e.args, traceback.format_exc()))
+                self.executor.on_exception(sys.exc_info())
+            finally:
+                self.processed += 1
+
+
+class ChatExecutor:
+    """
+    Executor, which runs tasks of one chat one by one in order they were put, and tasks of different chats in parallel.
+    Chats are spread over shards, every shard is thread with bounded queue.
+    When queue of shard is full, put blocks, so polling waits until bot catches up.
+    Can replace worker pool of TeleBot, see `ordered` parameter of TeleBot.
+    """
+    def __init__(self,
+                 num_shards: int = 2,
+                 max_queue: int = 1000,
+                 put_timeout: typing.Union[int, float, None] = None):
+        """
+        :param num_shards: Optional. Number of worker threads
+        :param max_queue: Optional. Maximum number of queued tasks per shard
+        :param put_timeout: Optional. Seconds to wait for free place in queue, then queue.Full is raised. Waits forever if None
+        """
+        self.num_shards = num_shards
+        self.put_timeout = put_timeout
+        self.exception_event = threading.Event()
+        self.exc_info = None
+        self._next_shard = itertools.cycle(range(num_shards))
+        self._shards = [_Shard(self, index, max_queue) for index in range(num_shards)]
+
+    @property
+    def stats(self) -> typing.List[typing.Dict]:
+        """
+        Shard counters
+        :return: List of dicts with queue depth, processed tasks, number of puts blocked by full queue,
+        total and maximum seconds tasks waited in queue
+        """
+        return [shard.stats for shard in self._shards]
+
+    def shard(self, key) -> int:
+        """
+        Get shard index of key
+        :param key: Chat id
+        :return: Shard index
+        """
+        return hash(str(key)) % self.num_shards
+
+    def submit(self, key, task, *args, **kwargs):
+        """
+        Run task after all tasks with same key
+        :param key: Chat id. If None, task is put to shards in turn
+        :param task: Callable
+        :return:
+        """
+        index = next(self._next_shard) if key is None else self.shard(key)
+        self._shards[index].put((time.monotonic(), task, args, kwargs), timeout=self.put_timeout)
+
+    def put(self, task, *args, **kwargs):
+        """
+        Run task without ordering, compatible with telebot.util.ThreadPool
+        :param task: Callable
+        :return:
+        """
+        self.submit(None, task, *args, **kwargs)
+
+    def on_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exc_info[1].with_traceback(self.exc_info[2])
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        """
+        Stop shards after queued tasks are done
+        :return:
+        """
+        for shard in self._shards:
+            shard.queue.put(_STOP)
+        for shard in self._shards:
+            shard.join()
@@ -0,0 +1,107 @@
+# -*- coding:utf-8; -*-
+
+import collections
+import typing
+
+_states = [None]  # id -> State, 0 means no state
+
+
+class State(str):
+    """
+    State declared in StatesGroup.
+    It's str, so it can be used everywhere plain states are used, and storages keep its name.
+    Every declared state gets small integer id, which is unique within process.
+    """
+    def __new__(cls, name: typing.Optional[str] = None):
+        """
+        :param name: Optional. State name, defaults to 'Group:attribute'
+        """
+        state = super(State, cls).__new__(cls, name or '')
+        state.explicit = bool(name)
+        state.id = None
+        state.group = None
+        return state
+
+    def __reduce__(self):
+        return str, (str(self),)
+
+    def __repr__(self):
+        return '<State {!r} id={}>'.format(str(self), self.id)
+
+
+class StatesGroupMeta(type):
+    """
+    Assigns names and ids to State attributes of group in declaration order
+    """
+    @classmethod
+    def __prepare__(mcs, name, bases, **kwargs):
+        return collections.OrderedDict()
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        cls = super(StatesGroupMeta, mcs).__new__(mcs, name, bases, dict(namespace))
+        states = []
+        for attribute, value in namespace.items():
+            if not isinstance(value, State):
+                continue
+            state = State(value if value.explicit else '{}:{}'.format(name, attribute))
+            state.id = len(_states)
+            state.group = cls
+            _states.append(state)
+            setattr(cls, attribute, state)
+            states.append(state)
+        cls.states = tuple(states)
+        cls._positions = {state: position for position, state in enumerate(states)}
+        return cls
+
+    def __iter__(cls):
+        return iter(cls.states)
+
+    def __len__(cls):
+        return len(cls.states)
+
+    def __contains__(cls, state):
+        return state in cls._positions
+
+
+class StatesGroup(metaclass=StatesGroupMeta):
+    """
+    Declarative group of states:
+
+    class Order(StatesGroup):
+        product = State()
+        address = State()
+        confirm = State()
+
+    Order.address == 'Order:address'
+    Order.next(Order.product) == Order.address
+    """
+    states = ()
+
+    @classmethod
+    def next(cls, state: typing.Optional[str] = None) -> typing.Optional[State]:
+        """
+        Get state declared after given one
+        :param state: Current state. If None, first state is returned
+        :return: Next state or None if state is last
+        """
+        position = cls._positions[state] + 1 if state else 0
+        return cls.states[position] if position < len(cls.states) else None
+
+    @classmethod
+    def previous(cls, state: typing.Optional[str] = None) -> typing.Optional[State]:
+        """
+        Get state declared before given one
+        :param state: Current state. If None, last state is returned
+        :return: Previous state or None if state is first
+        """
+        position = cls._positions[state] - 1 if state else len(cls.states) - 1
+        return cls.states[position] if position >= 0 else None
+
+
+def get_state(state_id: int) -> typing.Optional[State]:
+    """
+    Get declared state by id
+    :param state_id: State id
+    :return: State or None if id is 0
+    """
+    return _states[state_id]
@@ -1,7 +1,75 @@
 # -*- coding:utf-8; -*-
 
+import collections
+import itertools
 import typing
 
+PATCH_OPERATIONS = frozenset(['set', 'inc', 'append', 'remove'])
+
+
+def check_patch(ops: typing.Iterable[typing.Sequence]) -> typing.List[typing.Tuple]:
+    """
+    Validate patch operations and fill default values
+    :param ops: Iterable of (operation, path) or (operation, path, value),
+    path is key or tuple of keys of nested dicts
+    :return: List of (operation, path tuple, value)
+    """
+    checked = []
+    for op in ops:
+        operation, path = op[0], op[1]
+        if operation not in PATCH_OPERATIONS:
+            raise ValueError("Unknown patch operation '{}'.".format(operation))
+        path = tuple(path) if isinstance(path, (tuple, list)) else (path,)
+        if not path:
+            raise ValueError('Patch path must not be empty.')
+        if len(op) > 2:
+            value = op[2]
+        elif operation in ('inc', 'remove'):
+            value = 1 if operation == 'inc' else None
+        else:
+            raise ValueError("Patch operation '{}' needs value.".format(operation))
+        checked.append((operation, path, value))
+    return checked
+
+
+def apply_patch(data: typing.Dict, ops: typing.Iterable[typing.Sequence]) -> typing.Dict:
+    """
+    Apply patch operations to data:
+    ('set', path, value) sets value, missing dicts on path are created;
+    ('inc', path, amount) adds amount, 1 by default, to number, missing number is 0;
+    ('append', path, value) appends value to list, missing list is empty;
+    ('remove', path) removes key, if it exists.
+    Missing or null value on path is replaced with dict, other non-dict value raises TypeError
+    as RethinkDB does on the server.
+    Data is changed in place, nested dicts and lists on path are copied before they are changed
+    :param data: Data
+    :param ops: Operations, see check_patch
+    :return: Data
+    """
+    for operation, path, value in check_patch(ops):
+        parent = data
+        for key in path[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                if operation == 'remove':
+                    break
+                if child is not None:
+                    raise TypeError("Can't {} {}, value at '{}' isn't dict.".format(operation, path, key))
+                child = {}
+            parent[key] = child = dict(child)
+            parent = child
+        else:
+            key = path[-1]
+            if operation == 'set':
+                parent[key] = value
+            elif operation == 'inc':
+                parent[key] = parent.get(key, 0) + value
+            elif operation == 'append':
+                parent[key] = parent.get(key, []) + [value]
+            else:
+                parent.pop(key, None)
+    return data
+
 
 class BaseStorage:
     """
@@ -26,6 +94,16 @@ class BaseStorage:
         """
         raise NotImplementedError
 
+    def flush(self, addresses: typing.Optional[typing.Iterable[typing.Tuple]] = None):
+        """
+        Write buffered changes. TeleBot calls it after every handler with address of update sender.
+        Storages which buffer writes must override this method
+        :param addresses: Optional. Write only changes of these (chat, user) pairs and changes made by current thread.
+        All changes are written by default
+        :return:
+        """
+        pass
+
     def get_state(self,
                   chat: typing.Union[int, str, None] = None,
                   user: typing.Union[int, str, None] = None,
@@ -135,6 +213,227 @@ class BaseStorage:
         """
         self.reset_state(chat, user, with_data=True)
 
+    def get_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None) -> typing.Dict:
+        """
+        Get state and data of user in chat.
+        Subclasses should override this method with single read.
+        :param chat: Chat id
+        :param user: User id
+        :return: Dict with state and data
+        """
+        return {'state': self.get_state(chat, user), 'data': dict(self.get_data(chat, user) or {})}
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        """
+        Write several changes of user in chat.
+        Subclasses should override this method with single atomic write.
+        :param chat: Chat id
+        :param user: User id
+        :param record: Dict with any of state, data (replaces old data), update_data (merged into old data)
+        and deadline (see set_deadline)
+        :return:
+        """
+        if 'state' in record:
+            self.set_state(chat, user, record['state'])
+        if 'data' in record:
+            self.set_data(chat, user, record['data'])
+        elif record.get('update_data'):
+            self.update_data(chat, user, record['update_data'])
+        if 'deadline' in record:
+            self.set_deadline(chat, user, record['deadline'])
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        """
+        Store time when state of user in chat times out, so timers survive restart.
+        Storages which can't persist deadlines ignore it
+        :param chat: Chat id
+        :param user: User id
+        :param deadline: Unix time or None to clear
+        :return:
+        """
+        pass
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        """
+        Get all stored deadlines
+        :return: List of (chat, user, state, deadline), chat and user ids are strings
+        """
+        return []
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        """
+        Set state only if current state is expected, None and empty string both mean no state.
+        Subclasses should override this method with atomic implementation.
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state
+        :param state: New state
+        :param deadline: Optional. Deadline of new state, written with it. Deadline of old state is cleared
+        :return: True if state was set
+        """
+        if (self.get_state(chat, user) or None) != (expected or None):
+            return False
+        self.set_record(chat, user, {'state': state, 'deadline': deadline})
+        return True
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function.
+        Subclasses should override this method with atomic implementation.
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        data = fn(dict(self.get_data(chat, user) or {}))
+        self.set_data(chat, user, data)
+        return data
+
+    def patch_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        """
+        Apply patch operations to data atomically, see apply_patch.
+        This implementation uses mutate_data, subclasses should override it with single write.
+        :param chat: Chat id
+        :param user: User id
+        :param ops: Iterable of (operation, path) or (operation, path, value)
+        :return: New data
+        """
+        ops = check_patch(ops)
+        return self.mutate_data(chat, user, fn=lambda data: apply_patch(data, ops))
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over all records ordered by address as strings, i.e. to export them.
+        Every subclass(i.e storage), which can be exported, must override this method with streaming implementation
+        :param start_after: Optional. (chat, user) after which iteration starts, i.e. last exported address
+        :return: Iterator of (chat, user, record), record is dict with state, data and optional deadline
+        """
+        raise NotImplementedError('{} must override iter_records to export records.'.format(type(self).__name__))
+
+    def iter_chat_records(self, chat: typing.Union[int, str]) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over records of all users of chat ordered by user as string.
+        This implementation seeks iter_records to chat, subclasses, which can't seek, should override it.
+        :param chat: Chat id
+        :return: Iterator of (chat, user, record) like iter_records yields
+        """
+        chat = str(chat)
+        return itertools.takewhile(lambda item: item[0] == chat, self.iter_records(start_after=(chat, '')))
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records, i.e. to import them. Records replace existing ones.
+        Subclasses should override this method with batched implementation.
+        :param records: Iterable of (chat, user, record) like iter_records yields
+        :return: Number of written records
+        """
+        count = 0
+        for chat, user, record in records:
+            self.set_record(chat, user, dict(record, data=record.get('data') or {}))
+            count += 1
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over users in state.
+        Subclasses should override this method with indexed implementation, this one scans iter_records.
+        :param state: State
+        :return: Iterator of (chat, user)
+        """
+        for chat, user, record in self.iter_records():
+            if record.get('state') == state:
+                yield chat, user
+
+    def count_states(self) -> typing.Dict[str, int]:
+        """
+        Count users in every state.
+        Subclasses should override this method with indexed implementation, this one scans iter_records.
+        :return: Dict of state -> number of users
+        """
+        counts = collections.Counter(record.get('state') for _, _, record in self.iter_records())
+        counts.pop(None, None)
+        counts.pop('', None)
+        return dict(counts)
+
+    def get_states_many(self,
+                        addresses: typing.Iterable[typing.Tuple],
+                        default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get states of many users.
+        Subclasses should override this method with batched implementation.
+        :param addresses: Iterable of (chat, user) pairs, any of them may be None like in check_address
+        :param default: Returns if no state.
+        :return: List of states in order of addresses
+        """
+        return [self.get_state(chat, user, default=default) for chat, user in addresses]
+
+    def get_data_many(self,
+                      addresses: typing.Iterable[typing.Tuple],
+                      default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get data of many users.
+        Subclasses should override this method with batched implementation.
+        :param addresses: Iterable of (chat, user) pairs
+        :param default: Returns if no data.
+        :return: List of data in order of addresses
+        """
+        return [self.get_data(chat, user, default=default) for chat, user in addresses]
+
+    def set_state_many(self,
+                       addresses: typing.Iterable[typing.Tuple],
+                       state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set same state for many users.
+        Subclasses should override this method with batched implementation.
+        :param addresses: Iterable of (chat, user) pairs
+        :param state:
+        :return:
+        """
+        for chat, user in addresses:
+            self.set_state(chat, user, state=state)
+
+    def update_data_many(self,
+                         addresses: typing.Iterable[typing.Tuple],
+                         data: typing.Dict = None):
+        """
+        Update data of many users with same data.
+        Subclasses should override this method with batched implementation.
+        :param addresses: Iterable of (chat, user) pairs
+        :param data: Data to update
+        :return:
+        """
+        for chat, user in addresses:
+            self.update_data(chat, user, data=data)
+
+    def finish_many(self, addresses: typing.Iterable[typing.Tuple]):
+        """
+        Fully reset state and data of many users.
+        Subclasses should override this method with batched implementation.
+        :param addresses: Iterable of (chat, user) pairs
+        :return:
+        """
+        for chat, user in addresses:
+            self.finish(chat, user)
+
 
 class DisabledStorage(BaseStorage):
     """
@@ -155,6 +454,15 @@ class DisabledStorage(BaseStorage):
                  default: typing.Optional[str] = None) -> typing.Dict:
         return {} or default
 
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        return iter(())
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        return iter(())
+
+    def count_states(self) -> typing.Dict[str, int]:
+        return {}
+
     def set_state(self,
                   chat: typing.Union[int, str, None] = None,
                   user: typing.Union[int, str, None] = None,
@@ -172,3 +480,215 @@ class DisabledStorage(BaseStorage):
                     user: typing.Union[int, str, None] = None,
                     data: typing.Dict = None):
         pass
+
+
+class AsyncBaseStorage:
+    """
+    Parent class for all asyncio storages.
+    Has the same contract as BaseStorage, but every method is coroutine.
+    """
+    check_address = staticmethod(BaseStorage.check_address)
+
+    async def close(self):
+        """
+        Every subclass(i.e storage) must override this method
+        :return:
+        """
+        raise NotImplementedError
+
+    async def get_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Union[str]:
+        """
+        Every subclass(i.e storage) must override this method
+        :param chat:
+        :param user:
+        :param default:
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def get_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        """
+        Every subclass(i.e storage) must override this method
+        :param chat:
+        :param user:
+        :param default:
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def set_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        """
+        Every subclass(i.e storage) must override this method
+        :param chat:
+        :param user:
+        :param state:
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def set_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       data: typing.Dict = None):
+        """
+        Every subclass(i.e storage) must override this method
+        :param chat:
+        :param user:
+        :param data:
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def update_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          data: typing.Dict = None):
+        """
+        Every subclass(i.e storage) must override this method
+        :param chat:
+        :param user:
+        :param data:
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def reset_data(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None):
+        """
+        Reset data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+
+        await self.set_data(chat, user, data={})
+
+    async def reset_state(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+
+        await self.set_state(chat, user, state=None)
+        if with_data:
+            await self.reset_data(chat, user)
+
+    async def finish(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None):
+        """
+        Fully resets state and data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+        await self.reset_state(chat, user, with_data=True)
+
+    async def transition(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None,
+                         expected: typing.Optional[typing.AnyStr] = None,
+                         state: typing.Optional[typing.AnyStr] = None) -> bool:
+        """
+        Set state only if current state is expected, None and empty string both mean no state.
+        Subclasses should override this method with atomic implementation.
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state
+        :param state: New state
+        :return: True if state was set
+        """
+        if (await self.get_state(chat, user) or None) != (expected or None):
+            return False
+        await self.set_state(chat, user, state)
+        return True
+
+    async def mutate_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function.
+        Subclasses should override this method with atomic implementation.
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        data = fn(dict(await self.get_data(chat, user) or {}))
+        await self.set_data(chat, user, data)
+        return data
+
+    async def patch_data(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None,
+                         ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        """
+        Apply patch operations to data, see apply_patch.
+        This implementation uses mutate_data, subclasses should override it with single write.
+        :param chat: Chat id
+        :param user: User id
+        :param ops: Iterable of (operation, path) or (operation, path, value)
+        :return: New data
+        """
+        ops = check_patch(ops)
+        return await self.mutate_data(chat, user, fn=lambda data: apply_patch(data, ops))
+
+
+class AsyncDisabledStorage(AsyncBaseStorage):
+    """
+    Use that storage with asyncio bot when you don't need to store any state.
+    """
+    async def close(self):
+        pass
+
+    async def get_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Union[str]:
+        return '' or default
+
+    async def get_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        return {} or default
+
+    async def set_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        pass
+
+    async def set_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       data: typing.Dict = None):
+        pass
+
+    async def update_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          data: typing.Dict = None):
+        pass
@@ -0,0 +1,533 @@
+# -*- coding:utf-8; -*-
+
+import collections
+import threading
+import typing
+
+from .base import BaseStorage
+
+_UNKNOWN = object()
+
+
+class _Entry:
+    """
+    Cached state and data of user in chat with writes, which are not flushed yet
+    """
+    __slots__ = ('address', 'state', 'data', 'deadline', 'state_dirty', 'data_dirty', 'deadline_dirty', 'updates',
+                 'flushing')
+
+    def __init__(self, address):
+        self.address = address
+        self.state = _UNKNOWN
+        self.data = _UNKNOWN
+        self.deadline = None
+        self.state_dirty = False
+        self.data_dirty = False
+        self.deadline_dirty = False
+        self.updates = None
+        self.flushing = None
+
+    @property
+    def dirty(self):
+        return self.state_dirty or self.data_dirty or self.deadline_dirty or bool(self.updates)
+
+    def take_writes(self):
+        """
+        Mark entry clean. Data updates are kept in flushing until they are written,
+        so data read from storage meanwhile can be completed with them
+        :return: Record with pending writes, see BaseStorage.set_record
+        """
+        record = {}
+        if self.state_dirty:
+            record['state'] = self.state
+        if self.data_dirty:
+            record['data'] = dict(self.data)
+        elif self.updates:
+            record['update_data'] = self.updates
+        if self.deadline_dirty:
+            record['deadline'] = self.deadline
+        self.flushing = self.updates
+        self.updates = None
+        self.state_dirty = self.data_dirty = self.deadline_dirty = False
+        return record
+
+    def restore_writes(self, record):
+        """
+        Mark writes taken by take_writes pending again, because they were not written.
+        Writes made since then take precedence
+        :param record: Record returned by take_writes
+        :return:
+        """
+        if 'state' in record:
+            self.state_dirty = True
+        if 'data' in record:
+            self.data_dirty = True
+            self.updates = None
+        elif 'update_data' in record and not self.data_dirty:
+            updates = dict(self.flushing or {})
+            updates.update(self.updates or {})
+            self.updates = updates
+        if 'deadline' in record:
+            self.deadline_dirty = True
+
+
+class CachedStorage(BaseStorage):
+    """
+    Read-through, write-behind cache in front of any storage.
+    Reads are served from memory after first one, writes are kept in memory and several writes
+    of one record are sent to storage as one set_record on flush().
+    TeleBot flushes only writes of update sender and writes made by handler thread after every handler.
+    reset_state and finish are written to storage at once.
+    """
+    def __init__(self,
+                 storage: BaseStorage,
+                 max_entries: typing.Optional[int] = 10000):
+        """
+        :param storage: Storage to cache
+        :param max_entries: Optional. Maximum number of cached conversations, least recently used are dropped after flush
+        """
+        assert isinstance(storage, BaseStorage)
+        self.storage = storage
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.writes = 0
+        self.evicted = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.RLock()
+        self._written = threading.local()
+
+    @property
+    def stats(self) -> typing.Dict:
+        """
+        Cache statistics
+        :return: Dict with number of cached entries, hits, misses, flushes, writes to storage and evicted entries
+        """
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'flushes': self.flushes, 'writes': self.writes, 'evicted': self.evicted}
+
+    @property
+    def data(self):
+        """
+        Flush and return all data from cached storage
+        :return: Records
+        """
+        self.flush()
+        return self.storage.data
+
+    def _entry(self, chat, user):
+        """
+        Get or create cache entry. Must be called with lock held
+        :param chat: Chat id
+        :param user: User id
+        :return: _Entry
+        """
+        chat, user = self.check_address(chat, user)
+        key = (str(chat), str(user))
+        entry = self._entries.get(key)
+        if entry is None:
+            self._evict(reserve=1)
+            entry = self._entries[key] = _Entry((chat, user))
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _dirty_entry(self, chat, user):
+        """
+        Get or create cache entry, which is going to be written, and remember it's written by current thread.
+        Must be called with lock held
+        :param chat: Chat id
+        :param user: User id
+        :return: _Entry
+        """
+        entry = self._entry(chat, user)
+        self._thread_keys().add(tuple(map(str, entry.address)))
+        return entry
+
+    def _thread_keys(self):
+        """
+        Keys of entries written by current thread since its last flush
+        :return: Set of (chat, user) as strings
+        """
+        keys = getattr(self._written, 'keys', None)
+        if keys is None:
+            keys = self._written.keys = set()
+        return keys
+
+    def _evict(self, reserve=0):
+        """
+        Drop least recently used entries over max_entries. Must be called with lock held.
+        Entries with pending writes are kept until they are flushed.
+        :param reserve: Number of entries, which are going to be added
+        :return:
+        """
+        excess = len(self._entries) + reserve - self.max_entries if self.max_entries is not None else 0
+        if excess <= 0:
+            return
+        keys = []
+        for key, entry in self._entries.items():
+            if not entry.dirty and not entry.flushing:
+                keys.append(key)
+                if len(keys) == excess:
+                    break
+        for key in keys:
+            del self._entries[key]
+        self.evicted += len(keys)
+
+    def _write(self, address, record):
+        """
+        Send writes of one record to storage with single set_record
+        :param address: (chat, user)
+        :param record: Record with pending writes
+        :return:
+        """
+        if record:
+            self.storage.set_record(address[0], address[1], record)
+            self.writes += 1
+
+    def flush(self, addresses: typing.Optional[typing.Iterable[typing.Tuple]] = None):
+        """
+        Send pending writes to storage
+        :param addresses: Optional. Send only writes of these (chat, user) pairs and writes made by current thread.
+        All pending writes are sent by default
+        :return:
+        """
+        with self._flush_lock:
+            with self._lock:
+                if addresses is None:
+                    entries = [entry for entry in self._entries.values() if entry.dirty]
+                else:
+                    keys = self._thread_keys()
+                    keys.update(tuple(map(str, self.check_address(chat, user))) for chat, user in addresses)
+                    entries = [self._entries.get(key) for key in keys]
+                    entries = [entry for entry in entries if entry is not None and entry.dirty]
+                    keys.clear()
+                writes = [entry.take_writes() for entry in entries]
+            written = 0
+            try:
+                for entry, write in zip(entries, writes):
+                    self._write(entry.address, write)
+                    written += 1
+            except Exception:
+                with self._lock:
+                    keys = self._thread_keys()
+                    for entry, write in zip(entries[written:], writes[written:]):
+                        entry.restore_writes(write)
+                        keys.add(tuple(map(str, entry.address)))
+                raise
+            finally:
+                with self._lock:
+                    for entry in entries:
+                        entry.flushing = None
+                    self._evict()
+            if entries:
+                self.flushes += 1
+            self.storage.flush(addresses=addresses)
+
+    def invalidate(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None):
+        """
+        Flush and drop cached record, so next read gets it from storage.
+        Use it when record is changed bypassing the cache.
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+        chat, user = self.check_address(chat, user)
+        key = (str(chat), str(user))
+        with self._flush_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    return
+                write = entry.take_writes()
+            try:
+                self._write(entry.address, write)
+            except Exception:
+                with self._lock:
+                    entry.restore_writes(write)
+                raise
+            else:
+                with self._lock:
+                    if self._entries.get(key) is entry and not entry.dirty:
+                        del self._entries[key]
+            finally:
+                with self._lock:
+                    entry.flushing = None
+
+    def close(self):
+        """
+        Flush pending writes and close storage
+        :return:
+        """
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+        self.storage.close()
+
+    def get_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  default: typing.Optional[str] = None) -> typing.Union[str]:
+        """
+        Get state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no state.
+        :return: User state
+        """
+        with self._lock:
+            entry = self._entry(chat, user)
+            state = entry.state
+            if state is not _UNKNOWN:
+                self.hits += 1
+                return state or default
+            self.misses += 1
+
+        state = self.storage.get_state(*entry.address)
+        with self._lock:
+            # Record may be written by other thread while it was read from storage
+            if entry.state is _UNKNOWN:
+                entry.state = state
+            state = entry.state
+        return state or default
+
+    def get_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 default: typing.Optional[str] = None) -> typing.Dict:
+        """
+        Get data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no data.
+        :return: Copy of user data
+        """
+        with self._lock:
+            entry = self._entry(chat, user)
+            data = entry.data
+            if data is not _UNKNOWN:
+                self.hits += 1
+                return dict(data) or default
+            self.misses += 1
+
+        data = dict(self.storage.get_data(*entry.address) or {})
+        with self._lock:
+            if entry.data is _UNKNOWN:
+                # Updates may be not written to storage yet
+                for updates in (entry.flushing, entry.updates):
+                    if updates:
+                        data.update(updates)
+                entry.data = data
+            data = dict(entry.data)
+        return data or default
+
+    def set_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set state for user in chat, written to storage on flush
+        :param chat: Chat id
+        :param user: User id
+        :param state:
+        :return:
+        """
+        with self._lock:
+            entry = self._dirty_entry(chat, user)
+            entry.state = state
+            entry.state_dirty = True
+
+    def set_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 data: typing.Dict = None):
+        """
+        Set data for user in chat, written to storage on flush
+        :param chat: Chat id
+        :param user: User id
+        :param data:
+        :return:
+        """
+        with self._lock:
+            entry = self._dirty_entry(chat, user)
+            entry.data = dict(data) if data else {}
+            entry.data_dirty = True
+            entry.updates = None
+
+    def update_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    data: typing.Dict = None):
+        """
+        Update user data, several updates are written to storage as one on flush
+        :param chat: Chat id
+        :param user: User id
+        :param data: Data to update
+        :return:
+        """
+        if not data:
+            return
+        with self._lock:
+            entry = self._dirty_entry(chat, user)
+            if entry.data is not _UNKNOWN:
+                entry.data.update(data)
+            if not entry.data_dirty:
+                if entry.updates is None:
+                    entry.updates = {}
+                entry.updates.update(data)
+
+    def reset_state(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat. Pending writes it overrides are dropped and reset is written at once
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        with self._flush_lock:
+            with self._lock:
+                entry = self._entry(chat, user)
+                entry.state, entry.state_dirty = None, False
+                if with_data:
+                    entry.data, entry.data_dirty, entry.updates = {}, False, None
+            self.storage.reset_state(*entry.address, with_data=with_data)
+            self.writes += 1
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        """
+        Store state deadline, written to storage with state on flush
+        :param chat: Chat id
+        :param user: User id
+        :param deadline: Unix time or None to clear
+        :return:
+        """
+        with self._lock:
+            entry = self._dirty_entry(chat, user)
+            entry.deadline = deadline
+            entry.deadline_dirty = True
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        """
+        Write several changes of user in chat, they are written to storage as one on flush
+        :param chat: Chat id
+        :param user: User id
+        :param record: Dict with any of state, data (replaces old data), update_data (merged into old data)
+        and deadline
+        :return:
+        """
+        with self._lock:
+            if 'state' in record:
+                self.set_state(chat, user, record['state'])
+            if 'data' in record:
+                self.set_data(chat, user, record['data'])
+            elif record.get('update_data'):
+                self.update_data(chat, user, record['update_data'])
+            if 'deadline' in record:
+                self.set_deadline(chat, user, record['deadline'])
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        """
+        Flush and get all stored deadlines
+        :return: List of (chat, user, state, deadline)
+        """
+        self.flush()
+        return self.storage.get_deadlines()
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Flush and iterate over all records of storage
+        :param start_after: Optional. (chat, user) after which iteration starts
+        :return: Iterator of (chat, user, record)
+        """
+        self.flush()
+        return self.storage.iter_records(start_after=start_after)
+
+    def iter_chat_records(self, chat: typing.Union[int, str]) -> typing.Iterator[typing.Tuple]:
+        """
+        Flush and iterate over records of all users of chat in storage
+        :param chat: Chat id
+        :return: Iterator of (chat, user, record)
+        """
+        self.flush()
+        return self.storage.iter_chat_records(chat)
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records to storage and drop cache, so loaded records are read from storage
+        :param records: Iterable of (chat, user, record) like iter_records yields
+        :return: Number of written records
+        """
+        with self._flush_lock:
+            self.flush()
+            count = self.storage.load_records(records)
+            with self._lock:
+                self._entries.clear()
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        """
+        Flush and iterate over users in state of storage
+        :param state: State
+        :return: Iterator of (chat, user)
+        """
+        self.flush()
+        return self.storage.iter_addresses_in_state(state)
+
+    def count_states(self) -> typing.Dict[str, int]:
+        """
+        Flush and count users in every state of storage
+        :return: Dict of state -> number of users
+        """
+        self.flush()
+        return self.storage.count_states()
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        """
+        Set state only if cached state is expected, atomic for threads sharing the cache
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state, None and empty string both mean no state
+        :param state: New state
+        :param deadline: Optional. Deadline of new state, written with it. Deadline of old state is cleared
+        :return: True if state was set
+        """
+        with self._lock:
+            if (self.get_state(chat, user) or None) != (expected or None):
+                return False
+            self.set_state(chat, user, state)
+            self.set_deadline(chat, user, deadline)
+        return True
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace cached data with result of function, atomic for threads sharing the cache
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        with self._lock:
+            data = fn(dict(self.get_data(chat, user) or {}))
+            self.set_data(chat, user, data)
+        return data
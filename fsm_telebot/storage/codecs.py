@@ -0,0 +1,194 @@
+# -*- coding:utf-8; -*-
+
+import json
+import pickle
+import typing
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+class DataTooLargeError(ValueError):
+    """
+    Encoded data is larger than size cap of codec
+    """
+    def __init__(self, size, max_size):
+        super(DataTooLargeError, self).__init__(
+            'Encoded data is {} bytes, which is more than limit of {} bytes.'.format(size, max_size))
+        self.size = size
+        self.max_size = max_size
+
+
+class Serializer:
+    """
+    Parent class of data serializers. Tag is stored before payload, so payload can be decoded
+    even after storage switched to other serializer
+    """
+    tag = None
+
+    def dumps(self, data: typing.Dict) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, payload: bytes) -> typing.Dict:
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    tag = b'j'
+
+    def dumps(self, data: typing.Dict) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def loads(self, payload: bytes) -> typing.Dict:
+        return json.loads(payload.decode('utf-8'))
+
+
+class PickleSerializer(Serializer):
+    """
+    Keeps any picklable values, i.e. tuples, sets and non-string keys. Use only with storage you trust
+    """
+    tag = b'p'
+
+    def dumps(self, data: typing.Dict) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, payload: bytes) -> typing.Dict:
+        return pickle.loads(payload)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    Compact binary JSON, needs msgpack package
+    """
+    tag = b'm'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack package is required for msgpack serializer.')
+
+    def dumps(self, data: typing.Dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, payload: bytes) -> typing.Dict:
+        return msgpack.unpackb(payload, raw=False)
+
+
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def _lz4_compressor(level):
+    if lz4 is None:
+        raise ImportError('lz4 package is required for lz4 compression.')
+    return lambda payload: lz4.compress(payload, compression_level=level)
+
+
+def _lz4_decompress(payload):
+    if lz4 is None:
+        raise ImportError('lz4 package is required to decode lz4 compressed data.')
+    return lz4.decompress(payload)
+
+
+# Name -> (tag, compressor factory, decompress)
+COMPRESSIONS = {
+    'zlib': (b'z', lambda level: lambda payload: zlib.compress(payload, level), zlib.decompress),
+    'lz4': (b'4', _lz4_compressor, _lz4_decompress),
+}
+_RAW = b'-'
+_DECOMPRESS = dict((tag, decompress) for tag, _, decompress in COMPRESSIONS.values())
+_DECOMPRESS[_RAW] = lambda payload: payload
+_SERIALIZERS = {}
+
+
+def decode(payload: typing.Union[bytes, str, None]) -> typing.Dict:
+    """
+    Decode data encoded by any DataCodec, serializer and compression are read from payload header.
+    Strings are JSON written by storages without codec
+    :param payload: Encoded data
+    :return: Data
+    """
+    if not payload:
+        return {}
+    if isinstance(payload, str):
+        return json.loads(payload)
+    payload = bytes(payload)
+    serializer = _SERIALIZERS.get(payload[:1])
+    if serializer is None:
+        for serializer_class in SERIALIZERS.values():
+            if serializer_class.tag == payload[:1]:
+                serializer = _SERIALIZERS[serializer_class.tag] = serializer_class()
+                break
+        else:
+            raise ValueError('Unknown serializer of encoded data.')
+    try:
+        decompress = _DECOMPRESS[payload[1:2]]
+    except KeyError:
+        raise ValueError('Unknown compression of encoded data.')
+    return serializer.loads(decompress(payload[2:]))
+
+
+class DataCodec:
+    """
+    Encodes user data into bytes for storages: serializes it, compresses payloads above threshold
+    and rejects payloads above size cap.
+    Encoded data starts with tags of serializer and compression, see decode.
+    """
+    def __init__(self,
+                 serializer: typing.Union[str, Serializer] = 'json',
+                 compression: typing.Optional[str] = 'zlib',
+                 compress_above: int = 1024,
+                 level: int = 6,
+                 max_size: typing.Optional[int] = None):
+        """
+        :param serializer: Optional. 'json', 'msgpack', 'pickle' or Serializer instance
+        :param compression: Optional. 'zlib', 'lz4' or None to disable compression
+        :param compress_above: Optional. Serialized payloads up to this size in bytes are not compressed
+        :param level: Optional. Compression level
+        :param max_size: Optional. Maximum size of encoded data in bytes, larger data raises DataTooLargeError
+        """
+        self.serializer = SERIALIZERS[serializer]() if isinstance(serializer, str) else serializer
+        self.compression = compression
+        self.compress_above = compress_above
+        self.max_size = max_size
+        if compression is None:
+            self._tag, self._compress = _RAW, None
+        else:
+            self._tag, factory, _ = COMPRESSIONS[compression]
+            self._compress = factory(level)
+
+    def encode(self, data: typing.Dict, check_size: bool = True) -> bytes:
+        """
+        Encode data
+        :param data: Data
+        :param check_size: Optional. Whether to raise DataTooLargeError above max_size
+        :return: Encoded data
+        """
+        payload, tag = self.serializer.dumps(data), _RAW
+        if self._compress is not None and len(payload) > self.compress_above:
+            compressed = self._compress(payload)
+            if len(compressed) < len(payload):
+                payload, tag = compressed, self._tag
+        payload = self.serializer.tag + tag + payload
+        if check_size and self.max_size is not None and len(payload) > self.max_size:
+            raise DataTooLargeError(len(payload), self.max_size)
+        return payload
+
+    @staticmethod
+    def decode(payload: typing.Union[bytes, str, None]) -> typing.Dict:
+        """
+        Decode data, see decode
+        :param payload: Encoded data
+        :return: Data
+        """
+        return decode(payload)
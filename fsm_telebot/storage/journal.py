@@ -0,0 +1,220 @@
+# -*- coding:utf-8; -*-
+
+import atexit
+import mmap
+import os
+import pickle
+import struct
+import threading
+import typing
+
+_FRAME = struct.Struct('<I')
+
+
+def _frame(entry):
+    """
+    Serialize journal entry into length-prefixed frame
+    :param entry: Tuple
+    :return: Bytes
+    """
+    payload = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+    return _FRAME.pack(len(payload)) + payload
+
+
+def _read_frames(path):
+    """
+    Read all complete frames of file with mmap
+    :param path: File path
+    :return: (list of entries, size of complete frames in bytes)
+    """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return [], 0
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        entries, offset, size = [], 0, len(buffer)
+        while offset + _FRAME.size <= size:
+            length, = _FRAME.unpack_from(buffer, offset)
+            end = offset + _FRAME.size + length
+            if end > size:
+                break
+            try:
+                entries.append(pickle.loads(buffer[offset + _FRAME.size:end]))
+            except Exception:
+                break
+            offset = end
+        return entries, offset
+
+
+def _fsync_directory(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        descriptor = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+class Journal:
+    """
+    Append-only journal of storage records with periodic compacted snapshots.
+    Entries are (key, state, data) or (key, state, data, deadline) for writes and (key,) for deletes,
+    snapshot stores them in chunks.
+    Appends are buffered and written with one fsync per fsync_interval (group commit).
+    """
+    LOG, OLD_LOG, SNAPSHOT = 'journal.log', 'journal.log.old', 'snapshot'
+    SNAPSHOT_CHUNK = 10000
+
+    def __init__(self,
+                 path: str,
+                 source: typing.Callable,
+                 fsync_interval: typing.Union[int, float] = 0.05,
+                 snapshot_every: typing.Optional[int] = 100000):
+        """
+        :param path: Directory of journal and snapshot files, created if missing
+        :param source: Callable, which returns list of (key, state, data) of all records for snapshot
+        :param fsync_interval: Optional. Seconds between group commits. If 0, every append is written and synced at once
+        :param snapshot_every: Optional. Number of appended entries after which snapshot is taken. None disables snapshots
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self._source = source
+        self._buffer = []
+        self._appended = 0
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._log = None
+        self._thread = None
+
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def recover(self) -> typing.List:
+        """
+        Load snapshot and journal tail and open journal for appends.
+        Call start() after entries are applied.
+        :return: List of entries in replay order
+        """
+        chunks, _ = _read_frames(self._file(self.SNAPSHOT))
+        entries = [entry for chunk in chunks for entry in chunk]
+        old_entries, _ = _read_frames(self._file(self.OLD_LOG))
+        log_entries, log_size = _read_frames(self._file(self.LOG))
+        entries.extend(old_entries)
+        entries.extend(log_entries)
+
+        self._log = open(self._file(self.LOG), 'ab')
+        self._log.truncate(log_size)
+        self._appended = len(old_entries) + len(log_entries)
+        return entries
+
+    def start(self):
+        """
+        Start group commit writer
+        :return:
+        """
+        if self.fsync_interval:
+            self._thread = threading.Thread(target=self._run, name='JournalWriter', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, key, state, data, deadline=None):
+        """
+        Journal record write
+        :param key: Record key
+        :param state: State
+        :param data: Data
+        :param deadline: Optional. State deadline
+        :return:
+        """
+        self._append(_frame((key, state, data) if deadline is None else (key, state, data, deadline)))
+
+    def delete(self, key):
+        """
+        Journal record delete
+        :param key: Record key
+        :return:
+        """
+        self._append(_frame((key,)))
+
+    def _append(self, frame):
+        with self._lock:
+            if self._closed:
+                return
+            self._buffer.append(frame)
+            self._appended += 1
+            if not self.fsync_interval:
+                self._write()
+        if not self.fsync_interval and self.snapshot_every and self._appended >= self.snapshot_every:
+            self.snapshot()
+
+    def _write(self):
+        """
+        Write buffered frames and fsync. Must be called with lock held
+        :return:
+        """
+        if not self._buffer:
+            return
+        self._log.write(b''.join(self._buffer))
+        self._buffer = []
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def flush(self):
+        """
+        Write and fsync all buffered entries now
+        :return:
+        """
+        with self._lock:
+            if not self._closed:
+                self._write()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.fsync_interval)
+            self._wakeup.clear()
+            self.flush()
+            if self.snapshot_every and self._appended >= self.snapshot_every:
+                self.snapshot()
+
+    def snapshot(self):
+        """
+        Write all records to new snapshot and drop journal entries it contains.
+        Journal is rotated first, so appends are not blocked while snapshot is written.
+        :return:
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                self._write()
+                self._log.close()
+                os.replace(self._file(self.LOG), self._file(self.OLD_LOG))
+                self._log = open(self._file(self.LOG), 'ab')
+                self._appended = 0
+
+            temporary = self._file(self.SNAPSHOT + '.tmp')
+            entries = self._source()
+            with open(temporary, 'wb') as file:
+                for start in range(0, len(entries), self.SNAPSHOT_CHUNK):
+                    file.write(_frame(entries[start:start + self.SNAPSHOT_CHUNK]))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self._file(self.SNAPSHOT))
+            os.remove(self._file(self.OLD_LOG))
+            _fsync_directory(self.path)
+
+    def close(self):
+        """
+        Flush buffered entries and stop writer
+        :return:
+        """
+        with self._lock:
+            if self._closed or self._log is None:
+                return
+            self._write()
+            self._closed = True
+            self._log.close()
+        self._wakeup.set()
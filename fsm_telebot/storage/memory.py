@@ -1,41 +1,375 @@
 # -*- coding:utf-8; -*-
 
+import collections
+import gc
+import sys
+import threading
+import time
 import typing
 
-from .base import BaseStorage
+from .base import AsyncBaseStorage, BaseStorage, apply_patch, check_patch
+from .journal import Journal
+
+
+def _pack(value):
+    """
+    Convert chat or user id to int if it's numeric string, so records are keyed by small int tuples
+    :param value: Chat or user id
+    :return: int or str
+    """
+    if isinstance(value, int):
+        return value
+    value = str(value)
+    try:
+        packed = int(value)
+    except ValueError:
+        return value
+    return packed if str(packed) == value else value
+
+
+class _Record:
+    """
+    State and data of user in chat
+    """
+    __slots__ = ('state', 'data', 'accessed', 'deadline')
+
+    def __init__(self, state=None, data=None, accessed=None, deadline=None):
+        self.state = state
+        self.data = data
+        self.accessed = accessed
+        self.deadline = deadline
+
+    def as_dict(self):
+        return {'state': self.state, 'data': self.data if self.data is not None else {}}
 
 
 class MemoryStorage(BaseStorage):
     """
-    Memory storage. Not recommended for production due to losing states after restart.
+    Memory storage. States are lost after restart, unless path is passed.
+    Can be bounded: keeps at most max_entries least recently used conversations
+    and forgets conversations idle for more than ttl seconds.
+    With path, every write is appended to journal and recovered on start, see Journal.
+    Writes of one record are serialized by lock, records share lock_stripes locks by hash of address,
+    so transition, mutate_data and patch_data are atomic without one global lock.
+    Eviction and expiry drop records only under their locks and skip records in use,
+    so bounds are kept lazily while other threads write.
+    Addresses are indexed by state, so users in state are found without scanning all records.
     """
-    def __init__(self):
-        self.data = {}
+    def __init__(self,
+                 max_entries: typing.Optional[int] = None,
+                 ttl: typing.Union[int, float, None] = None,
+                 expire_interval: typing.Union[int, float, None] = None,
+                 path: typing.Optional[str] = None,
+                 fsync_interval: typing.Union[int, float] = 0.05,
+                 snapshot_every: typing.Optional[int] = 100000,
+                 lock_stripes: int = 64):
+        """
+        :param max_entries: Optional. Maximum number of stored conversations
+        :param ttl: Optional. Seconds since last access, after which conversation is forgotten
+        :param expire_interval: Optional. How often writes sweep idle conversations. Defaults to ttl
+        :param path: Optional. Directory of journal and snapshots. Storage is not durable if not passed
+        :param fsync_interval: Optional. Seconds between journal group commits, 0 syncs every write
+        :param snapshot_every: Optional. Number of journal entries after which snapshot is taken
+        :param lock_stripes: Optional. Number of record locks
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.expire_interval = expire_interval if expire_interval is not None else ttl
+        self.evicted = 0
+        self.expired = 0
+        self._records = collections.OrderedDict()
+        self._index = {}
+        self._members = {}
+        self._next_expire = self._now() + self.expire_interval if ttl else None
+        self._journal = None
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+        if path:
+            journal = Journal(path, self._dump, fsync_interval=fsync_interval, snapshot_every=snapshot_every)
+            # Loading creates millions of objects, which don't need to be tracked by garbage collector meanwhile
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._load(journal.recover())
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            self._journal = journal
+            self._evict()
+            journal.start()
+
+    _now = staticmethod(time.monotonic)
+
+    def _load(self, entries):
+        """
+        Replay journal entries
+        :param entries: List of (key, state, data[, deadline]) or (key,) for deleted records
+        :return:
+        """
+        records, now, states = self._records, self._now(), {}
+        for entry in entries:
+            key = entry[0]
+            if len(entry) == 1:
+                records.pop(key, None)
+                continue
+            state = entry[1]
+            if state not in states:
+                states[state] = sys.intern(str(state)) if isinstance(state, str) else state
+            deadline = entry[3] if len(entry) > 3 else None
+            record = records.get(key)
+            if record is None:
+                records[key] = _Record(states[state], entry[2], now, deadline)
+            else:
+                record.state, record.data, record.deadline = states[state], entry[2], deadline
+                records.move_to_end(key)
+
+        index, members = self._index, self._members = {}, {}
+        for key, record in records.items():
+            if record.state:
+                index.setdefault(record.state, set()).add(key)
+            if key[0] != key[1]:
+                members.setdefault(key[0], set()).add(key[1])
 
-    def _get_chat(self, chat_id):
+    def _dump(self):
         """
-        Get chat data if exists, else create ones
-        :param chat_id:
-        :return: Chat data
+        Copy all records for snapshot
+        :return: List of (key, state, data[, deadline])
         """
-        chat_id = str(chat_id)
-        if chat_id not in self.data:
-            self.data[chat_id] = {}
-        return self.data[chat_id]
+        return [(key, record.state, dict(record.data) if record.data else None) +
+                ((record.deadline,) if record.deadline is not None else ())
+                for key, record in list(self._records.items())]
 
-    def _get_user(self, chat_id, user_id):
+    @property
+    def data(self):
         """
-        Get user state and data if exists, else create ones
-        :param chat_id:
-        :param user_id:
-        :return: User data
+        All records as {chat: {user: {'state': state, 'data': data}}}
+        :return:
+        """
+        self.expire()
+        data = {}
+        for (chat, user), record in list(self._records.items()):
+            data.setdefault(str(chat), {})[str(user)] = record.as_dict()
+        return data
+
+    @property
+    def stats(self):
+        """
+        Storage counters
+        :return: Dict with number of entries, evicted by LRU and expired by TTL conversations
+        """
+        return {'entries': len(self._records), 'evicted': self.evicted, 'expired': self.expired}
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat, user)
+        return _pack(chat), _pack(user)
+
+    def _lock(self, key):
+        """
+        Get lock of record
+        :param key: Record key
+        :return: Lock
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _write(self, key, record):
+        """
+        Journal record after it's changed and sweep idle records, if it's time.
+        Must be called with record lock held
+        :param key: Record key
+        :param record: Record
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.append(key, record.state, record.data, record.deadline)
+        if self.ttl and self._now() >= self._next_expire:
+            self._expire(self._lock(key), key)
+
+    def _set_state(self, key, record, state):
+        """
+        Change state of record and move it in state index. Must be called with record lock held
+        :param key: Record key
+        :param record: Record
+        :param state: New state
+        :return:
+        """
+        state = sys.intern(str(state)) if isinstance(state, str) else state
+        if record.state != state:
+            if record.state:
+                self._index.get(record.state, set()).discard(key)
+            if state:
+                # Sets are never removed from index, so add can't race with removal
+                self._index.setdefault(state, set()).add(key)
+        record.state = state
+
+    def _drop(self, key):
+        """
+        Forget record. Must be called with record lock held
+        :param key: Record key
+        :return: True if record was stored
+        """
+        record = self._records.pop(key, None)
+        if record is None:
+            return False
+        if record.state:
+            self._index.get(record.state, set()).discard(key)
+        if key[0] != key[1]:
+            self._members.get(key[0], set()).discard(key[1])
+        if self._journal is not None:
+            self._journal.delete(key)
+        return True
+
+    def _drop_if(self, key, held, condition):
+        """
+        Forget record under its lock, if it's still stored and condition is true.
+        Record, whose lock is taken by other thread, is in use, so it's skipped
+        :param key: Record key
+        :param held: Lock, which is already held by current thread, or None
+        :param condition: Callable, which receives record
+        :return: True if record was dropped, False if it wasn't, None if lock is busy
+        """
+        lock = self._lock(key)
+        if lock is not held and not lock.acquire(blocking=False):
+            return None
+        try:
+            record = self._records.get(key)
+            return record is not None and bool(condition(record)) and self._drop(key)
+        finally:
+            if lock is not held:
+                lock.release()
+
+    def _find_record(self, key, locked=False):
+        """
+        Get record if exists, record is marked as recently used
+        :param key: Record key
+        :param locked: Optional. Whether record lock is held by caller
+        :return: Record or None
+        """
+        record = self._records.get(key)
+        if record is None:
+            return None
+        if self.ttl:
+            now = self._now()
+            if now - record.accessed > self.ttl:
+                stale = lambda stored: now - stored.accessed > self.ttl
+                dropped = self._drop_if(key, self._lock(key) if locked else None, stale)
+                if dropped:
+                    self.expired += 1
+                if dropped is not None:
+                    return None
+            record.accessed = now
+        try:
+            self._records.move_to_end(key)
+        except KeyError:
+            pass
+        return record
+
+    def _get_record(self, key):
+        """
+        Get record if exists, else create one
+        :param key: Record key
+        :return: Record
+        """
+        record = self._find_record(key, locked=True)
+        if record is not None:
+            return record
+
+        record = self._records.setdefault(key, _Record())
+        if key[0] != key[1]:
+            # Users of group chats are indexed by chat. Sets are never removed, so add can't race with removal
+            self._members.setdefault(key[0], set()).add(key[1])
+        if self.ttl:
+            record.accessed = self._now()
+        self._evict(self._lock(key), key)
+        return record
+
+    def _oldest(self, keep):
+        """
+        Get least recently used record
+        :param keep: Key, which is skipped
+        :return: (key, record) or None
+        """
+        try:
+            for key, record in self._records.items():
+                if key != keep:
+                    return key, record
+        except RuntimeError:
+            pass
+        return None
+
+    def _skip(self, key):
+        """
+        Mark record, which is in use, as recently used, so sweeps look at next one
+        :param key: Record key
+        :return:
+        """
+        try:
+            self._records.move_to_end(key)
+        except KeyError:
+            pass
+
+    def _evict(self, held=None, keep=None):
         """
-        self._get_chat(chat_id)
-        chat_id = str(chat_id)
-        user_id = str(user_id)
-        if user_id not in self.data[chat_id]:
-            self.data[chat_id][user_id] = {'state': None, 'data': {}}
-        return self.data[chat_id][user_id]
+        Forget least recently used records above max_entries. Records in use by other threads are kept
+        :param held: Optional. Record lock held by caller
+        :param keep: Optional. Key of record, which caller is writing
+        :return:
+        """
+        if self.max_entries is None:
+            return
+        attempts = len(self._records)
+        while len(self._records) > self.max_entries and attempts > 0:
+            attempts -= 1
+            oldest = self._oldest(keep)
+            if oldest is None:
+                break
+            key, record = oldest
+            dropped = self._drop_if(key, held, lambda stored: stored is record)
+            if dropped:
+                self.evicted += 1
+            elif dropped is None:
+                self._skip(key)
+
+    def _expire(self, held=None, keep=None):
+        """
+        Forget conversations idle for more than ttl seconds. Records in use by other threads are kept
+        :param held: Optional. Record lock held by caller
+        :param keep: Optional. Key of record, which caller is writing
+        :return: Number of expired conversations
+        """
+        now = self._now()
+        self._next_expire = now + self.expire_interval
+        stale = lambda stored: now - stored.accessed > self.ttl
+        expired, attempts = 0, len(self._records)
+        while attempts > 0:
+            attempts -= 1
+            oldest = self._oldest(keep)
+            if oldest is None or not stale(oldest[1]):
+                break
+            key = oldest[0]
+            dropped = self._drop_if(key, held, stale)
+            if dropped:
+                expired += 1
+            elif dropped is None:
+                self._skip(key)
+        self.expired += expired
+        return expired
+
+    def expire(self):
+        """
+        Forget all conversations idle for more than ttl seconds. Writes call it every expire_interval
+        :return: Number of expired conversations
+        """
+        if not self.ttl:
+            return 0
+        return self._expire()
+
+    def snapshot(self):
+        """
+        Write snapshot of all records and truncate journal now
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.snapshot()
 
     def set_state(self,
                   chat: typing.Union[int, str, None] = None,
@@ -48,9 +382,11 @@ class MemoryStorage(BaseStorage):
         :param state:
         :return:
         """
-        chat, user = self.check_address(chat, user)
-        user = self._get_user(chat, user)
-        user['state'] = state
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            self._set_state(key, record, state)
+            self._write(key, record)
 
     def set_data(self,
                  chat: typing.Union[int, str, None] = None,
@@ -63,9 +399,11 @@ class MemoryStorage(BaseStorage):
         :param data:
         :return:
         """
-        chat, user = self.check_address(chat, user)
-        user = self._get_user(chat, user)
-        user['data'] = data
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            record.data = data if data else None
+            self._write(key, record)
 
     def get_state(self,
                   chat: typing.Union[int, str, None] = None,
@@ -78,24 +416,22 @@ class MemoryStorage(BaseStorage):
         :param default: Returns if no state.
         :return: User state
         """
-        chat, user = self.check_address(chat, user)
-        user = self._get_user(chat, user)
-        return user['state'] or default
+        record = self._find_record(self._key(chat, user))
+        return (record.state or default) if record else default
 
     def get_data(self,
                  chat: typing.Union[int, str, None] = None,
                  user: typing.Union[int, str, None] = None,
                  default: typing.Optional[str] = None) -> typing.Dict:
         """
-        Get state for user in chat
+        Get data for user in chat
         :param chat: Chat id
         :param user: User id
         :param default: Returns if no data.
         :return: User data
-                """
-        chat, user = self.check_address(chat, user)
-        user = self._get_user(chat, user)
-        return user['data']
+        """
+        record = self._find_record(self._key(chat, user))
+        return record.data if record and record.data is not None else {}
 
     def update_data(self,
                     chat: typing.Union[int, str, None] = None,
@@ -108,13 +444,451 @@ class MemoryStorage(BaseStorage):
         :param data: Data to update
         :return:
         """
-        chat, user = self.check_address(chat, user)
-        user = self._get_user(chat, user)
-        user['data'].update(data)
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            if record.data is None:
+                record.data = dict(data) if data else None
+            else:
+                record.data.update(data)
+            self._write(key, record)
+
+    def reset_state(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            self._set_state(key, record, None)
+            if with_data:
+                record.data = None
+            self._write(key, record)
+
+    def get_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None) -> typing.Dict:
+        """
+        Get state and data of user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return: Dict with state and copy of data
+        """
+        record = self._find_record(self._key(chat, user))
+        if record is None:
+            return {'state': None, 'data': {}}
+        return {'state': record.state, 'data': dict(record.data) if record.data else {}}
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        """
+        Write several changes of user in chat atomically, journaled as one entry
+        :param chat: Chat id
+        :param user: User id
+        :param record: Dict with any of state, data (replaces old data) and update_data (merged into old data)
+        :return:
+        """
+        key = self._key(chat, user)
+        with self._lock(key):
+            stored = self._get_record(key)
+            if 'state' in record:
+                self._set_state(key, stored, record['state'])
+            if 'data' in record:
+                stored.data = dict(record['data']) if record['data'] else None
+            elif record.get('update_data'):
+                data = dict(stored.data or {})
+                data.update(record['update_data'])
+                stored.data = data
+            if 'deadline' in record:
+                stored.deadline = record['deadline']
+            self._write(key, stored)
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        """
+        Store time when state of user in chat times out, it's journaled with record
+        :param chat: Chat id
+        :param user: User id
+        :param deadline: Unix time or None to clear
+        :return:
+        """
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._find_record(key, locked=True) if deadline is None else self._get_record(key)
+            if record is not None and record.deadline != deadline:
+                record.deadline = deadline
+                self._write(key, record)
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        """
+        Get all stored deadlines
+        :return: List of (chat, user, state, deadline)
+        """
+        return [(str(chat), str(user), record.state, record.deadline)
+                for (chat, user), record in list(self._records.items()) if record.deadline is not None]
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        """
+        Set state only if current state is expected, atomically
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state, None and empty string both mean no state
+        :param state: New state
+        :param deadline: Optional. Deadline of new state, written with it. Deadline of old state is cleared
+        :return: True if state was set
+        """
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._find_record(key, locked=True)
+            if ((record.state if record else None) or None) != (expected or None):
+                return False
+            if record is None:
+                record = self._get_record(key)
+            self._set_state(key, record, state)
+            record.deadline = deadline
+            self._write(key, record)
+        return True
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function, atomically
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            data = fn(dict(record.data) if record.data else {})
+            record.data = dict(data) if data else None
+            self._write(key, record)
+        return data
+
+    def patch_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        """
+        Apply patch operations to data under record lock, see apply_patch.
+        Only dicts on paths of operations are copied, so failed operation leaves data unchanged
+        :param chat: Chat id
+        :param user: User id
+        :param ops: Iterable of (operation, path) or (operation, path, value)
+        :return: New data
+        """
+        ops = check_patch(ops)
+        key = self._key(chat, user)
+        with self._lock(key):
+            record = self._get_record(key)
+            record.data = apply_patch(dict(record.data) if record.data else {}, ops) or None
+            self._write(key, record)
+            return dict(record.data) if record.data else {}
+
+    def get_states_many(self,
+                        addresses: typing.Iterable[typing.Tuple],
+                        default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get states of many users, missing users are not created
+        :param addresses: Iterable of (chat, user) pairs
+        :param default: Returns if no state.
+        :return: List of states in order of addresses
+        """
+        return [self.get_state(chat, user, default=default) for chat, user in addresses]
+
+    def get_data_many(self,
+                      addresses: typing.Iterable[typing.Tuple],
+                      default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get data of many users, missing users are not created
+        :param addresses: Iterable of (chat, user) pairs
+        :param default: Returns if no data.
+        :return: List of data in order of addresses
+        """
+        return [self.get_data(chat, user, default=default) for chat, user in addresses]
+
+    def set_state_many(self,
+                       addresses: typing.Iterable[typing.Tuple],
+                       state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set same state for many users
+        :param addresses: Iterable of (chat, user) pairs
+        :param state:
+        :return:
+        """
+        for chat, user in addresses:
+            self.set_state(chat, user, state)
+
+    def update_data_many(self,
+                         addresses: typing.Iterable[typing.Tuple],
+                         data: typing.Dict = None):
+        """
+        Update data of many users with same data
+        :param addresses: Iterable of (chat, user) pairs
+        :param data: Data to update
+        :return:
+        """
+        for chat, user in addresses:
+            self.update_data(chat, user, data)
+
+    def finish_many(self, addresses: typing.Iterable[typing.Tuple]):
+        """
+        Fully reset state and data of many users, missing users are skipped
+        :param addresses: Iterable of (chat, user) pairs
+        :return:
+        """
+        for chat, user in addresses:
+            key = self._key(chat, user)
+            with self._lock(key):
+                record = self._find_record(key, locked=True)
+                if record:
+                    self._set_state(key, record, None)
+                    record.data = None
+                    self._write(key, record)
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over all records ordered by address as strings. Only sorted addresses are copied,
+        records are copied one by one while iterating. Addresses are sorted up front,
+        so it takes memory for all addresses, O(N), before first record is returned
+        :param start_after: Optional. (chat, user) after which iteration starts
+        :return: Iterator of (chat, user, record), record is dict with state, data and optional deadline
+        """
+        start_after = tuple(map(str, start_after)) if start_after else None
+        addresses = sorted((str(chat), str(user), (chat, user)) for chat, user in list(self._records))
+        for chat, user, key in addresses:
+            if start_after is not None and (chat, user) <= start_after:
+                continue
+            exported = self._export(key)
+            if exported is not None:
+                yield chat, user, exported
+
+    def iter_chat_records(self, chat: typing.Union[int, str]) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over records of all users of chat ordered by user as string, found by chat index
+        :param chat: Chat id
+        :return: Iterator of (chat, user, record)
+        """
+        chat = _pack(chat)
+        users = sorted((str(user), user) for user in set([chat]) | set(self._members.get(chat, ())))
+        for name, user in users:
+            exported = self._export((chat, user))
+            if exported is not None:
+                yield str(chat), name, exported
+
+    def _export(self, key):
+        """
+        Copy record for export
+        :param key: Record key
+        :return: Dict with state, data and optional deadline or None if there is no record
+        """
+        with self._lock(key):
+            record = self._records.get(key)
+            if record is None:
+                return None
+            exported = record.as_dict()
+            exported['data'] = dict(exported['data'])
+            if record.deadline is not None:
+                exported['deadline'] = record.deadline
+        return exported
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records, they replace existing ones
+        :param records: Iterable of (chat, user, record) like iter_records yields
+        :return: Number of written records
+        """
+        count = 0
+        for chat, user, record in records:
+            self.set_record(chat, user, {'state': record.get('state'), 'data': record.get('data') or {},
+                                         'deadline': record.get('deadline')})
+            count += 1
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over users in state, found by state index
+        :param state: State
+        :return: Iterator of (chat, user)
+        """
+        for chat, user in list(self._index.get(state, ())):
+            yield str(chat), str(user)
+
+    def count_states(self) -> typing.Dict[str, int]:
+        """
+        Count users in every state by state index
+        :return: Dict of state -> number of users
+        """
+        return {state: len(keys) for state, keys in list(self._index.items()) if keys}
 
     def close(self):
+        """
+        Delete all data from memory. Journal is flushed and closed, so data is recovered on next start
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._records.clear()
+        self._index.clear()
+        self._members.clear()
+
+
+class AsyncMemoryStorage(AsyncBaseStorage):
+    """
+    Asyncio version of MemoryStorage. Not recommended for production due to losing states after restart.
+    """
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: MemoryStorage parameters
+        """
+        self._storage = MemoryStorage(**kwargs)
+
+    @property
+    def data(self):
+        return self._storage.data
+
+    async def set_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param state:
+        :return:
+        """
+        self._storage.set_state(chat, user, state)
+
+    async def set_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       data: typing.Dict = None):
+        """
+        Set data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param data:
+        :return:
+        """
+        self._storage.set_data(chat, user, data)
+
+    async def get_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Union[str]:
+        """
+        Get state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no state.
+        :return: User state
+        """
+        return self._storage.get_state(chat, user, default=default)
+
+    async def get_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        """
+        Get data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no data.
+        :return: User data
+        """
+        return self._storage.get_data(chat, user, default=default)
+
+    async def update_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          data: typing.Dict = None):
+        """
+        Update user data
+        :param chat: Chat id
+        :param user: User id
+        :param data: Data to update
+        :return:
+        """
+        self._storage.update_data(chat, user, data)
+
+    async def reset_state(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        self._storage.reset_state(chat, user, with_data=with_data)
+
+    async def transition(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None,
+                         expected: typing.Optional[typing.AnyStr] = None,
+                         state: typing.Optional[typing.AnyStr] = None) -> bool:
+        """
+        Set state only if current state is expected, atomically
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state, None and empty string both mean no state
+        :param state: New state
+        :return: True if state was set
+        """
+        return self._storage.transition(chat, user, expected=expected, state=state)
+
+    async def mutate_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function, atomically
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        return self._storage.mutate_data(chat, user, fn=fn)
+
+    async def patch_data(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None,
+                         ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        """
+        Apply patch operations to data atomically, see apply_patch
+        :param chat: Chat id
+        :param user: User id
+        :param ops: Iterable of (operation, path) or (operation, path, value)
+        :return: New data
+        """
+        return self._storage.patch_data(chat, user, ops=ops)
+
+    async def close(self):
         """
         Delete all data
         :return:
         """
-        self.data.clear()
+        self._storage.close()
@@ -0,0 +1,62 @@
+# -*- coding:utf-8; -*-
+
+import itertools
+import time
+import typing
+
+import telebot
+
+from .base import BaseStorage
+
+
+def _log_progress(progress):
+    telebot.logger.info('Migrated {records} records, {rate:.0f} records/s, last {last}'.format(**progress))
+
+
+def migrate(source: BaseStorage,
+            target: BaseStorage,
+            batch_size: int = 1000,
+            start_after: typing.Optional[typing.Tuple] = None,
+            progress: typing.Optional[typing.Callable[[typing.Dict], None]] = _log_progress,
+            progress_every: int = 10000) -> typing.Dict:
+    """
+    Copy all records from one storage to another in chunks.
+    Records are streamed with source.iter_records and written with target.load_records,
+    so only one chunk of records is held in memory whatever number of records is.
+    Source may need more memory to iterate, i.e. MemoryStorage sorts all addresses first.
+    Every progress report has address of last copied record, pass it as start_after to resume interrupted migration.
+
+    Example:
+
+    migrate(RethinkDBStorage(), SQLiteStorage('states.sqlite3'), start_after=('12345', '12345'))
+
+    :param source: Storage to copy from
+    :param target: Storage to copy to
+    :param batch_size: Optional. Number of records per chunk
+    :param start_after: Optional. (chat, user) of last copied record, migration starts after it
+    :param progress: Optional. Callable, which receives progress dict, progress is logged by default
+    :param progress_every: Optional. Number of records between progress reports
+    :return: Progress dict with number of copied records, elapsed seconds, records per second and last copied address
+    """
+    records = source.iter_records(start_after=start_after)
+    started = time.monotonic()
+    stats = {'records': 0, 'elapsed': 0.0, 'rate': 0.0, 'last': tuple(start_after) if start_after else None}
+    reported = 0
+    while True:
+        chunk = list(itertools.islice(records, batch_size))
+        if not chunk:
+            break
+        target.load_records(chunk)
+        target.flush()
+
+        chat, user, _ = chunk[-1]
+        elapsed = time.monotonic() - started
+        stats.update(records=stats['records'] + len(chunk), elapsed=elapsed, last=(chat, user))
+        stats['rate'] = stats['records'] / elapsed if elapsed else 0.0
+        if progress is not None and stats['records'] - reported >= progress_every:
+            reported = stats['records']
+            progress(dict(stats))
+
+    if progress is not None and stats['records'] != reported:
+        progress(dict(stats))
+    return stats
@@ -0,0 +1,180 @@
+# -*- coding:utf-8; -*-
+
+import collections
+import contextlib
+import threading
+import time
+import typing
+
+
+class ConnectionPool:
+    """
+    Bounded thread-safe connection pool.
+    Every thread checks out its own connection, nested checkouts in the same thread reuse it.
+    """
+    def __init__(self,
+                 connect: typing.Callable,
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 timeout: typing.Union[int, float, None] = None,
+                 check: typing.Optional[typing.Callable] = None,
+                 close: typing.Optional[typing.Callable] = None):
+        """
+        :param connect: Callable, which creates new connection
+        :param min_size: Optional. Connections opened at start and kept open
+        :param max_size: Optional. Maximum number of open connections
+        :param timeout: Optional. How long to wait for free connection, None means forever
+        :param check: Optional. Callable, which receives connection and returns False if it's broken
+        :param close: Optional. Callable, which closes connection. Calls connection.close() by default
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Pool size must satisfy 0 <= min_size <= max_size and max_size >= 1.')
+        self._connect = connect
+        self._check = check
+        self._close = close if close else lambda connection: connection.close()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def checked_out(self):
+        """
+        Whether current thread has checked out connection, so next checkout is nested and reuses it
+        :return:
+        """
+        return getattr(self._local, 'connection', None) is not None
+
+    @property
+    def stats(self):
+        """
+        Pool counters
+        :return: Dict with size, idle, in_use, waits and wait_time (total seconds spent waiting for connection)
+        """
+        with self._condition:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': self._in_use,
+                    'waits': self._waits, 'wait_time': self._wait_time}
+
+    def _checkout(self):
+        """
+        Take idle connection, open new one or wait for release
+        :return: Connection
+        """
+        with self._condition:
+            started = None
+            while True:
+                if self._closed:
+                    raise RuntimeError('Connection pool is closed.')
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    connection = None
+                    self._size += 1
+                    break
+                if started is None:
+                    started = time.monotonic()
+                    self._waits += 1
+                remaining = None if self.timeout is None else self.timeout - (time.monotonic() - started)
+                if remaining is not None and remaining <= 0:
+                    self._wait_time += time.monotonic() - started
+                    raise TimeoutError('No free connection in pool after {} seconds.'.format(self.timeout))
+                self._condition.wait(remaining)
+            if started is not None:
+                self._wait_time += time.monotonic() - started
+            self._in_use += 1
+
+        try:
+            if connection is not None and self._check and not self._check(connection):
+                self._close_quietly(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        return connection
+
+    def _checkin(self, connection, discard=False):
+        """
+        Return connection to pool
+        :param connection: Connection
+        :param discard: If true, connection is closed instead of reusing
+        :return:
+        """
+        with self._condition:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+        if discard or self._closed:
+            self._close_quietly(connection)
+
+    def _close_quietly(self, connection):
+        try:
+            self._close(connection)
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out connection for current thread
+        :return: Context manager, which yields connection
+        """
+        local = self._local
+        if self.checked_out:
+            yield local.connection
+            return
+
+        local.connection = self._checkout()
+        local.discard = False
+        try:
+            yield local.connection
+        finally:
+            connection, discard = local.connection, local.discard
+            local.connection = None
+            self._checkin(connection, discard=discard)
+
+    def discard(self):
+        """
+        Mark connection of current thread as broken, so it's closed on release
+        :return:
+        """
+        if self.checked_out:
+            self._local.discard = True
+
+    def close(self):
+        """
+        Close all idle connections, connections in use are closed on release
+        :return:
+        """
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._close_quietly(connection)
@@ -1,17 +1,214 @@
 # -*- coding:utf-8; -*-
 
+import asyncio
+import collections
+import importlib.util
+import os
+import sys
+import threading
+import time
 import typing
 import atexit
 
 import rethinkdb as r
+import telebot
+from rethinkdb import net
 
-from .base import BaseStorage
+from .base import AsyncBaseStorage, BaseStorage, apply_patch, check_patch
+from .codecs import DataCodec
+from .pool import ConnectionPool
+
+_UNSET = object()
+
+
+def _set_record_query(table, chat, user, state=_UNSET, data=_UNSET, update_data=None, deadline=_UNSET):
+    """
+    Build atomic upsert of user record.
+    Record is inserted if chat has no document, otherwise it's merged into existing one on the server.
+    :param table: Table name
+    :param chat: Chat id
+    :param user: User id
+    :param state: Optional. New state
+    :param data: Optional. New data, rewrites old one
+    :param update_data: Optional. Data to merge into old one, key by key
+    :param deadline: Optional. State deadline
+    :return: Query
+    """
+    chat, user = str(chat), str(user)
+
+    record, patch = {'state': None, 'data': {}}, {}
+    if state is not _UNSET:
+        record['state'] = patch['state'] = state
+    if data is not _UNSET:
+        record['data'] = data if data else {}
+        patch['data'] = r.literal(record['data'])
+    elif update_data:
+        record['data'] = update_data
+        patch['data'] = {key: r.literal(value) for key, value in update_data.items()}
+    if deadline is not _UNSET:
+        record['deadline'] = patch['deadline'] = deadline
+
+    return r.table(table).insert({'id': chat, user: record},
+                                 conflict=lambda key, old, new: old.merge({user: patch}))
+
+
+def _nested(path, value):
+    """
+    Build nested object with value at path
+    :param path: Tuple of keys
+    :param value: Value
+    :return: Object
+    """
+    for key in reversed(path):
+        value = {key: value}
+    return value
+
+
+def _patch_step(operation, path, value):
+    """
+    Build function, which applies one patch operation to data on the server
+    :param operation: Operation, see apply_patch
+    :param path: Tuple of keys
+    :param value: Operation value
+    :return: Function of data
+    """
+    def step(data):
+        if operation == 'remove':
+            return data.without(_nested(path, True))
+        current = data
+        for key in path:
+            current = current[key]
+        if operation == 'inc':
+            new = current.default(0).add(value)
+        elif operation == 'append':
+            new = current.default([]).append(value)
+        else:
+            new = value
+        merged = data.merge(_nested(path, r.literal(new)))
+        if operation != 'set' or len(path) == 1:
+            return merged
+        # merge would silently replace non-object value on path, inc and append fail on reading it, so set checks it
+        parent = data
+        for key in path[:-1]:
+            parent = parent[key]
+        return r.branch(parent.default({}).type_of().eq('OBJECT'), merged,
+                        r.error("Can't set {}, value on path isn't object.".format(path)))
+    return step
+
+
+def _patch_data_query(table, chat, user, ops):
+    """
+    Build atomic patch of user data, all operations are applied on the server with single query.
+    Every operation gets result of previous one as variable, so query grows linearly with number of operations
+    :param table: Table name
+    :param chat: Chat id
+    :param user: User id
+    :param ops: Checked patch operations
+    :return: Query, which returns new data of user only, not whole chat document
+    """
+    chat, user = str(chat), str(user)
+
+    def patch(old):
+        data = old[user]['data'].default({})
+        for operation, path, value in ops:
+            data = data.do(_patch_step(operation, path, value))
+        return old.merge({user: {'data': r.literal(data)}})
+
+    return r.table(table).insert({'id': chat, user: {'state': None, 'data': apply_patch({}, ops)}},
+                                 conflict=lambda key, old, new: patch(old)) \
+        .do(lambda result: r.branch(result['errors'].eq(0),
+                                    r.table(table).get(chat)[user]['data'].default({}),
+                                    r.error(result['first_error'])))
+
+
+def _user_states(document):
+    """
+    States of users in chat document, it's function of state index
+    :param document: Chat document
+    :return: Array of states
+    """
+    return document.without('id').coerce_to('array').map(lambda pair: pair[1]['state'].default(None)) \
+        .filter(lambda state: state.ne(None)).distinct()
+
+
+def _get_record_query(table, chat, user, fields=('state', 'data')):
+    """
+    Build query of user record. Fields are picked on the server,
+    so other users of chat and other fields are not sent however big chat document is
+    :param table: Table name
+    :param chat: Chat id
+    :param user: User id
+    :param fields: Optional. Fields of user record
+    :return: Query
+    """
+    return r.table(table).get(str(chat))[str(user)].pluck(*fields).default({})
+
+
+def _get_field_query(table, chat, user, field):
+    """
+    Build query of one field of user record, only its value is sent
+    :param table: Table name
+    :param chat: Chat id
+    :param user: User id
+    :param field: Field name
+    :return: Query, which returns null if user or field is missing
+    """
+    return r.table(table).get(str(chat))[str(user)][field].default(None)
+
+
+def _replace_users(old, new, build):
+    """
+    Replace user sub-documents of chat document, which are present in new document
+    :param old: Old chat document
+    :param new: New chat document
+    :param build: Callable, which receives user id and returns new user record
+    :return: Merged chat document
+    """
+    users = new.without('id').keys()
+    return old.without(r.args(users)).merge(users.map(lambda user: [user, build(user)]).coerce_to('object'))
+
+
+def _chunks(iterable, size):
+    """
+    Split iterable into lists of given size
+    :param iterable:
+    :param size: Chunk size
+    :return: Generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _make_record(record):
+    """
+    Fill missing fields of user record
+    :param record: Record from RethinkDB
+    :return: Record
+    """
+    return {'state': record.get('state'), 'data': record.get('data', {})}
 
 
 class RethinkDBStorage(BaseStorage):
     """
-    Storage based on RethinkDB
+    Storage based on RethinkDB.
+    With cache_size, recently read chats are cached locally. Cache follows changefeed of the table in background,
+    so writes of other processes invalidate it, and entries older than cache_ttl are read again anyway.
+    While changefeed is down, cache is not used.
+    With codec, data is stored as binary and decoded only when it's read, state reads never decode it.
+    Encoded data can't be merged on the server, so update_data and patch_data become optimistic
+    read-modify-write like mutate_data.
     """
+    batch_size = 1000
+    mutate_attempts = 10
+    feed_retry_interval = 1
+    feed_poll_interval = 1
+
     def __init__(self,
                  host: typing.Optional[typing.AnyStr] = 'localhost',
                  port: typing.Optional[int] = 28015,
@@ -21,7 +218,22 @@ class RethinkDBStorage(BaseStorage):
                  password: typing.Optional[typing.AnyStr] = 'FSMBot',
                  timeout: typing.Union[int, float] = 20,
                  ssl: typing.Dict = None,
+                 pool_min_size: int = 1,
+                 pool_max_size: int = 10,
+                 pool_timeout: typing.Union[int, float, None] = None,
+                 cache_size: typing.Optional[int] = None,
+                 cache_ttl: typing.Union[int, float] = 5,
+                 codec: typing.Optional[DataCodec] = None,
                  **kwargs):
+        """
+        :param pool_min_size: Optional. Connections opened at start
+        :param pool_max_size: Optional. Maximum number of connections
+        :param pool_timeout: Optional. Seconds to wait for free connection
+        :param cache_size: Optional. Number of chats cached locally, cache is disabled if not passed
+        :param cache_ttl: Optional. Maximum age of cached chat in seconds
+        :param codec: Optional. Codec of data. Data written before codec was set is still read
+        """
+        self.codec = codec
         self._host = host
         self._port = port
         self._db = db
@@ -32,8 +244,22 @@ class RethinkDBStorage(BaseStorage):
         self._timeout = timeout
         self._ssl = ssl if ssl else {}
         self._kwargs = kwargs
-        self._connection = self._connect()
         self._initialize()
+        self._pool = ConnectionPool(self._connect, min_size=pool_min_size, max_size=pool_max_size,
+                                    timeout=pool_timeout, check=lambda connection: connection.is_open())
+
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'subscriptions': 0}
+        self._loading = {}
+        self._feed_ready = threading.Event()
+        self._feed_connection = None
+        self._feed_thread = None
+        if cache_size:
+            self._feed_thread = threading.Thread(target=self._follow_changes, name='RethinkDBChangefeed', daemon=True)
+            self._feed_thread.start()
         atexit.register(self.close)
 
     def _initialize(self):
@@ -41,58 +267,234 @@ class RethinkDBStorage(BaseStorage):
         Initialize DB and table
         :return:
         """
+        connection = r.connect(host=self._host, port=self._port,
+                               user=self._user, password=self._password,
+                               timeout=self._timeout, ssl=self._ssl, **self._kwargs)
+        try:
+            if self._db not in r.db_list().run(connection):
+                r.db_create(self._db).run(connection)
 
-        if self._db not in r.db_list().run(self._connection):
-            r.db_create(self._db).run(self._connection)
+            connection.use(self._db)
 
-        self._connection.use(self._db)
+            if self._table not in r.table_list().run(connection):
+                r.table_create(self._table).run(connection)
 
-        if self._table not in r.table_list().run(self._connection):
-            r.table_create(self._table)
+            table = r.table(self._table)
+            if 'state' not in table.index_list().run(connection):
+                table.index_create('state', _user_states, multi=True).run(connection)
+                table.index_wait('state').run(connection)
+        finally:
+            connection.close()
 
     def _connect(self):
         """
         Connect to RethinkDB
         :return: RethinkDB connection
         """
-        return r.connect(host=self._host, port=self._port,
+        return r.connect(host=self._host, port=self._port, db=self._db,
                          user=self._user, password=self._password,
                          timeout=self._timeout, ssl=self._ssl, **self._kwargs)
 
+    def _run(self, query, retry=True, **kwargs):
+        """
+        Run query on pooled connection of current thread.
+        If connection is broken, it's replaced and query is retried once.
+        Nested query, i.e. run while current thread has connection checked out, isn't retried,
+        since it would reuse the same broken connection
+        :param query: RethinkDB query
+        :param retry: Optional. If false, query isn't retried. Use it for queries, which mustn't be applied twice,
+        since server may have applied query before connection was broken
+        :return: Query result
+        """
+        nested = self._pool.checked_out
+        for attempt in range(2):
+            with self._pool.connection() as connection:
+                try:
+                    return query.run(connection, **kwargs)
+                except r.ReqlDriverError:
+                    self._pool.discard()
+                    if attempt or nested or not retry:
+                        raise
+
+    @property
+    def pool_stats(self):
+        """
+        Connection pool counters
+        :return: Dict with size, idle, in_use, waits and wait_time
+        """
+        return self._pool.stats
+
+    @property
+    def cache_stats(self):
+        """
+        Cache counters
+        :return: Dict with size, hits, misses, invalidations, changefeed subscriptions and whether changefeed is ready
+        """
+        with self._cache_lock:
+            return dict(self._cache_stats, size=len(self._cache), ready=self._feed_ready.is_set())
+
     def close(self):
         """
-        Close connection with RethinkDB
+        Close connections with RethinkDB
+        :return:
+        """
+        self._pool.close()
+        connection = self._feed_connection
+        if connection is not None:
+            connection.close(noreply_wait=False)
+
+    def _follow_changes(self):
+        """
+        Invalidate cache with changefeed of the table, resubscribe if it breaks
+        :return:
+        """
+        while not self._pool.closed:
+            try:
+                self._feed_connection = self._connect()
+                cursor = r.table(self._table).changes(include_states=True).run(self._feed_connection)
+                while not self._pool.closed:
+                    try:
+                        change = cursor.next(wait=self.feed_poll_interval)
+                    except r.ReqlTimeoutError:
+                        continue
+                    if change.get('state') == 'ready':
+                        # Changes made before subscription are not in feed, so everything cached before is dropped
+                        self._reset_cache(ready=True)
+                    elif 'new_val' in change or 'old_val' in change:
+                        self._apply_change(change.get('old_val'), change.get('new_val'))
+            except Exception as e:
+                if not self._pool.closed:
+                    telebot.logger.error('RethinkDB changefeed is broken: {}'.format(e))
+            finally:
+                self._reset_cache(ready=False)
+                if self._feed_connection is not None:
+                    self._feed_connection.close(noreply_wait=False)
+                    self._feed_connection = None
+            if not self._pool.closed:
+                time.sleep(self.feed_retry_interval)
+
+    def _reset_cache(self, ready):
+        """
+        Drop all cached chats
+        :param ready: Whether changefeed is subscribed, cache is used only if it is
+        :return:
+        """
+        with self._cache_lock:
+            self._cache.clear()
+            self._loading.clear()
+            if ready:
+                self._feed_ready.set()
+                self._cache_stats['subscriptions'] += 1
+            else:
+                self._feed_ready.clear()
+
+    def _apply_change(self, old, new):
+        """
+        Put chat document from changefeed into cache, if chat is cached
+        :param old: Old chat document or None
+        :param new: New chat document or None
+        :return:
+        """
+        chat = (new or old)['id']
+        with self._cache_lock:
+            self._loading.pop(chat, None)
+            if chat in self._cache:
+                self._cache[chat] = (new or {}, time.monotonic())
+                self._cache_stats['invalidations'] += 1
+
+    def _invalidate(self, chats):
+        """
+        Drop chats from cache after local write, so it's read again
+        :param chats: Iterable of chat ids
         :return:
         """
-        self._connection.close()
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            for chat in chats:
+                chat = str(chat)
+                self._loading.pop(chat, None)
+                if self._cache.pop(chat, None) is not None:
+                    self._cache_stats['invalidations'] += 1
+
+    def _get_document(self, chat):
+        """
+        Get chat document from cache or RethinkDB
+        :param chat: Chat id
+        :return: Chat document, empty if chat is missing
+        """
+        chat, token = str(chat), object()
+        with self._cache_lock:
+            cached = self._cache.get(chat)
+            if cached is not None and time.monotonic() - cached[1] <= self.cache_ttl:
+                self._cache.move_to_end(chat)
+                self._cache_stats['hits'] += 1
+                return cached[0]
+            self._cache_stats['misses'] += 1
+            self._loading[chat] = token
+
+        document = self._run(r.table(self._table).get(chat).default({}))
+        with self._cache_lock:
+            # Chat may be changed while it was read, then document is not cached
+            if self._loading.get(chat) is token:
+                del self._loading[chat]
+                self._cache[chat] = (document, time.monotonic())
+                self._cache.move_to_end(chat)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return document
 
     def _set_record(self,
                     chat: typing.Union[int, str, None] = None,
                     user: typing.Union[int, str, None] = None,
-                    state=None,
-                    data=None,
-                    update_data: typing.Optional[bool] = None):
+                    state=_UNSET,
+                    data=_UNSET,
+                    update_data: typing.Optional[typing.Dict] = None,
+                    deadline=_UNSET):
         """
-        Make record in RethinkDB
+        Make record in RethinkDB with single atomic upsert
         :param chat: Chat id
         :param user: User id
-        :param state: New state
-        :param data: New data
-        :param update_data: If true, updates data in DB, else rewrites data
+        :param state: Optional. New state
+        :param data: Optional. New data, rewrites old one
+        :param update_data: Optional. Data to merge into old one, key by key
+        :param deadline: Optional. State deadline
         :return:
         """
+        chat, user = self.check_address(chat, user)
+        if self.codec is not None:
+            if update_data:
+                def merge(old):
+                    old.update(update_data)
+                    return old
 
-        if not data:
-            data = {}
+                self.mutate_data(chat, user, merge)
+                if state is _UNSET and deadline is _UNSET:
+                    return
+                update_data = None
+            if data is not _UNSET:
+                data = self._encode(data)
+        self._run(_set_record_query(self._table, chat, user, state=state, data=data, update_data=update_data,
+                                    deadline=deadline))
+        self._invalidate([chat])
 
-        chat, user = map(str, self.check_address(chat, user))
-        if r.table('states').get(chat).run(self._connection):
-            if update_data:
-                r.table('states').get(chat).update({user: {'data': data}}).run(self._connection)
-            else:
-                r.table('states').get(chat).update({user: {'state': state, 'data': r.literal(data)}}).run(self._connection)
-        else:
-            r.table('states').insert({'id': chat, user: {'state': state, 'data': data}}).run(self._connection)
+    def _encode(self, data):
+        """
+        Encode data with codec
+        :param data: Data
+        :return: Binary or empty object if no data
+        """
+        return r.binary(self.codec.encode(data)) if data and self.codec is not None else (data or {})
+
+    def _decode(self, data):
+        """
+        Decode data read from RethinkDB, it's binary if it was encoded with codec
+        :param data: Stored data
+        :return: Copy of data
+        """
+        if isinstance(data, bytes):
+            return DataCodec.decode(data)
+        return dict(data) if data else {}
 
     def _get_record(self,
                     chat: typing.Union[int, str, None] = None,
@@ -103,8 +505,29 @@ class RethinkDBStorage(BaseStorage):
         :param user: User id
         :return: Record
         """
-        chat, user = map(str, self.check_address(chat, user))
-        return r.table('states').get(chat).default({})[user].default({'state': None, 'data': {}}).run(self._connection)
+        chat, user = self.check_address(chat, user)
+        if self._feed_ready.is_set():
+            record = _make_record(self._get_document(chat).get(str(user), {}))
+        else:
+            record = _make_record(self._run(_get_record_query(self._table, chat, user)))
+        record['data'] = self._decode(record['data'])
+        return record
+
+    def _get_field(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   field: str = 'state'):
+        """
+        Get one field of user record from cache or RethinkDB, only that field is sent by the server
+        :param chat: Chat id
+        :param user: User id
+        :param field: Field name
+        :return: Stored value or None
+        """
+        chat, user = self.check_address(chat, user)
+        if self._feed_ready.is_set():
+            return self._get_document(chat).get(str(user), {}).get(field)
+        return self._run(_get_field_query(self._table, chat, user, field))
 
     @property
     def data(self):
@@ -112,11 +535,14 @@ class RethinkDBStorage(BaseStorage):
         Return all data from RethinkDB
         :return: Records
         """
-        if not self._connection.is_open():
+        if self._pool.closed:
             return {}
-        records = list(r.table('states').run(self._connection))
+        records = self._run(r.table(self._table).coerce_to('array'))
         result = {}
         for chat in records:
+            for record in chat.values():
+                if isinstance(record, dict) and 'data' in record:
+                    record['data'] = self._decode(record['data'])
             result[chat.pop('id')] = chat
         return result
 
@@ -131,8 +557,7 @@ class RethinkDBStorage(BaseStorage):
         :param state:
         :return:
         """
-        record = self._get_record(chat, user)
-        self._set_record(chat, user, state=state, data=record['data'])
+        self._set_record(chat, user, state=state)
 
     def set_data(self,
                  chat: typing.Union[int, str, None] = None,
@@ -145,8 +570,7 @@ class RethinkDBStorage(BaseStorage):
         :param data:
         :return:
         """
-        record = self._get_record(chat, user)
-        self._set_record(chat, user, state=record['state'], data=data)
+        self._set_record(chat, user, data=data)
 
     def get_state(self,
                   chat: typing.Union[int, str, None] = None,
@@ -159,7 +583,7 @@ class RethinkDBStorage(BaseStorage):
         :param default: Returns if no state.
         :return: User state
         """
-        return self._get_record(chat, user)['state'] or default
+        return self._get_field(chat, user, 'state') or default
 
     def get_data(self,
                  chat: typing.Union[int, str, None] = None,
@@ -172,7 +596,7 @@ class RethinkDBStorage(BaseStorage):
         :param default: Returns if no data.
         :return: User data
         """
-        return self._get_record(chat, user)['data'] or default
+        return self._decode(self._get_field(chat, user, 'data')) or default
 
     def update_data(self,
                     chat: typing.Union[int, str, None] = None,
@@ -185,4 +609,610 @@ class RethinkDBStorage(BaseStorage):
         :param data: Data to update
         :return:
         """
-        self._set_record(chat, user, data=data, update_data=True)
+        self._set_record(chat, user, update_data=data)
+
+    def get_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None) -> typing.Dict:
+        """
+        Get state and data of user in chat with single query
+        :param chat: Chat id
+        :param user: User id
+        :return: Dict with state and data
+        """
+        return self._get_record(chat, user)
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        """
+        Write several changes of user in chat with single atomic upsert
+        :param chat: Chat id
+        :param user: User id
+        :param record: Dict with any of state, data (replaces old data) and update_data (merged into old data)
+        :return:
+        """
+        self._set_record(chat, user, state=record.get('state', _UNSET), data=record.get('data', _UNSET),
+                         update_data=record.get('update_data'), deadline=record.get('deadline', _UNSET))
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        """
+        Store time when state of user in chat times out
+        :param chat: Chat id
+        :param user: User id
+        :param deadline: Unix time or None to clear
+        :return:
+        """
+        self._set_record(chat, user, deadline=deadline)
+
+    def _iter(self, query):
+        """
+        Run query and stream results with cursor. Cursor gets its own pooled connection, which isn't bound
+        to current thread, so queries made while results are read get another one, and abandoned iterator
+        releases it from any thread
+        :param query: RethinkDB query
+        :return: Iterator of results
+        """
+        connection = self._pool._checkout()
+        discard = False
+        try:
+            cursor = query.run(connection)
+            try:
+                for item in cursor:
+                    yield item
+            finally:
+                cursor.close()
+        except r.ReqlDriverError:
+            discard = True
+            raise
+        finally:
+            self._pool._checkin(connection, discard=discard)
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over all records ordered by address. Chats are read by primary index and streamed with cursor,
+        so only cursor batch is held in memory
+        :param start_after: Optional. (chat, user) after which iteration starts
+        :return: Iterator of (chat, user, record), record is dict with state, data and optional deadline
+        """
+        table = r.table(self._table)
+        if start_after:
+            chat, user = map(str, start_after)
+            documents = table.between(chat, r.maxval, left_bound='closed').order_by(index='id')
+            keep = lambda document, pair: document['id'].ne(chat).or_(pair[0].gt(user))
+        else:
+            documents = table.order_by(index='id')
+            keep = lambda document, pair: True
+        query = documents.concat_map(
+            lambda document: document.without('id').coerce_to('array')
+            .filter(lambda pair: keep(document, pair))
+            .order_by(lambda pair: pair[0])
+            .map(lambda pair: [document['id'], pair[0], pair[1]]))
+        for chat, user, record in self._iter(query):
+            exported = _make_record(record)
+            exported['data'] = self._decode(exported['data'])
+            if record.get('deadline') is not None:
+                exported['deadline'] = record['deadline']
+            yield chat, user, exported
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records, they replace existing ones. One insert per batch_size records
+        :param records: Iterable of (chat, user, record) like iter_records yields
+        :return: Number of written records
+        """
+        count = 0
+        for chunk in _chunks(records, self.batch_size):
+            documents = {}
+            for chat, user, record in chunk:
+                chat, user = self.check_address(chat, user)
+                documents.setdefault(str(chat), {'id': str(chat)})[str(user)] = {
+                    'state': record.get('state'), 'data': self._encode(record.get('data')),
+                    'deadline': record.get('deadline')}
+            self._run(r.table(self._table).insert(
+                list(documents.values()),
+                conflict=lambda key, old, new: _replace_users(old, new, lambda user: new[user])))
+            self._invalidate(documents)
+            count += len(chunk)
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over users in state. Chats are found by secondary index on states of their users
+        and streamed with cursor, only addresses are sent
+        :param state: State
+        :return: Iterator of (chat, user)
+        """
+        query = r.table(self._table).get_all(state, index='state').concat_map(
+            lambda document: document.without('id').coerce_to('array')
+            .filter(lambda pair: pair[1]['state'].default(None).eq(state))
+            .map(lambda pair: [document['id'], pair[0]]))
+        for chat, user in self._iter(query):
+            yield chat, user
+
+    def count_states(self) -> typing.Dict[str, int]:
+        """
+        Count users in every state, counted on the server
+        :return: Dict of state -> number of users
+        """
+        counts = self._run(r.table(self._table).concat_map(
+            lambda document: document.without('id').coerce_to('array').map(lambda pair: pair[1]['state'].default(None))
+        ).filter(lambda state: state.ne(None).and_(state.ne(''))).group(lambda state: state).count().ungroup())
+        return {count['group']: count['reduction'] for count in counts}
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        """
+        Get all stored deadlines. Records are filtered on the server, only deadlines are sent
+        :return: List of (chat, user, state, deadline)
+        """
+        return [tuple(deadline) for deadline in self._run(r.table(self._table).concat_map(
+            lambda document: document.without('id').coerce_to('array')
+            .filter(lambda pair: pair[1]['deadline'].default(None).ne(None))
+            .map(lambda pair: [document['id'], pair[0], pair[1]['state'].default(None), pair[1]['deadline']])
+        ).coerce_to('array'))]
+
+    def reset_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None):
+        """
+        Reset data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+        self._set_record(chat, user, data={})
+
+    def reset_state(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat with single query
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        if with_data:
+            self._set_record(chat, user, state=None, data={})
+        else:
+            self._set_record(chat, user, state=None)
+
+    def _set_record_if(self, chat, user, field, expected, value, record, extra=None):
+        """
+        Set field of user record with single query, only if it's equal to expected value on the server
+        :param chat: Chat id
+        :param user: User id
+        :param field: 'state' or 'data'
+        :param expected: Expected value of field, missing field is null for state and empty object for data
+        :param value: New value of field
+        :param record: User record to insert, if chat has no document and missing field is expected
+        :param extra: Optional. Other fields of user record to set with field
+        :return: True if field was set
+        """
+        empty = '' if field == 'state' else {}
+        patch = {user: dict(extra or {}, **{field: r.literal(value) if field == 'data' else value})}
+
+        def matches(document):
+            return document[user][field].default(empty).eq(expected if expected else empty)
+
+        if expected:
+            query = r.table(self._table).get(chat).update(lambda document: r.branch(matches(document), patch, {}))
+        else:
+            query = r.table(self._table).insert({'id': chat, user: record},
+                                                conflict=lambda key, old, new: r.branch(matches(old), old.merge(patch), old))
+        result = self._run(query)
+        self._invalidate([chat])
+        return result['inserted'] + result['replaced'] == 1
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        """
+        Set state only if current state is expected, with single conditional query
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state, None and empty string both mean no state
+        :param state: New state
+        :param deadline: Optional. Deadline of new state, written with it. Deadline of old state is cleared
+        :return: True if state was set
+        """
+        chat, user = self.check_address(chat, user)
+        chat, user = str(chat), str(user)
+        record = {'state': state, 'data': {}}
+        if deadline is not None:
+            record['deadline'] = deadline
+        if (state or None) == (expected or None):
+            # Query of unchanged state can't tell whether it matched, so it's checked beforehand
+            if (self._get_field(chat, user, 'state') or None) != (expected or None):
+                return False
+            self._set_record_if(chat, user, 'state', expected, state, record, extra={'deadline': deadline})
+            return True
+        return self._set_record_if(chat, user, 'state', expected, state, record, extra={'deadline': deadline})
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function.
+        Function runs locally, data is written only if it's not changed on the server meanwhile, else it's retried
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        chat, user = self.check_address(chat, user)
+        chat, user = str(chat), str(user)
+        for _ in range(self.mutate_attempts):
+            stored = self._run(_get_field_query(self._table, chat, user, 'data'))
+            old = self._decode(stored)
+            data = fn(dict(old))
+            data = dict(data) if data else {}
+            if data == old:
+                return data
+            encoded = self._encode(data)
+            if self._set_record_if(chat, user, 'data', stored, encoded, {'state': None, 'data': encoded}):
+                return data
+        raise RuntimeError('Data of user {} in chat {} is changed concurrently too often.'.format(user, chat))
+
+    def patch_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        """
+        Apply patch operations to data on the server with single query, see apply_patch.
+        Patch with inc or append isn't retried on broken connection, since it may be already applied
+        :param chat: Chat id
+        :param user: User id
+        :param ops: Iterable of (operation, path) or (operation, path, value)
+        :return: New data
+        """
+        if self.codec is not None:
+            return super(RethinkDBStorage, self).patch_data(chat, user, ops)
+        chat, user = self.check_address(chat, user)
+        ops = check_patch(ops)
+        retry = not any(operation in ('inc', 'append') for operation, _, _ in ops)
+        try:
+            return self._run(_patch_data_query(self._table, chat, user, ops), retry=retry) or {}
+        finally:
+            self._invalidate([chat])
+
+    def _addresses(self, addresses):
+        """
+        Normalize addresses to (chat, user) pairs of strings
+        :param addresses: Iterable of (chat, user) pairs
+        :return: Generator of pairs
+        """
+        for chat, user in addresses:
+            chat, user = self.check_address(chat, user)
+            yield str(chat), str(user)
+
+    def _get_records_many(self, addresses, fields=('state', 'data')):
+        """
+        Get records of many users, one query per batch_size addresses.
+        Only requested fields of requested users are sent
+        :param addresses: Iterable of (chat, user) pairs
+        :param fields: Optional. Fields of user records
+        :return: Generator of records in order of addresses
+        """
+        for chunk in _chunks(self._addresses(addresses), self.batch_size):
+            chats = list({chat for chat, _ in chunk})
+            selector = {user: list(fields) for _, user in chunk}
+            documents = {document['id']: document
+                         for document in self._run(r.table(self._table).get_all(*chats).pluck('id', selector).coerce_to('array'))}
+            for chat, user in chunk:
+                yield _make_record(documents.get(chat, {}).get(user, {}))
+
+    def _set_records_many(self, addresses, record, build):
+        """
+        Upsert records of many users, one query per batch_size addresses
+        :param addresses: Iterable of (chat, user) pairs
+        :param record: Record of new users
+        :param build: Callable, which receives old chat document and user id and returns new user record
+        :return:
+        """
+        for chunk in _chunks(self._addresses(addresses), self.batch_size):
+            documents = {}
+            for chat, user in chunk:
+                documents.setdefault(chat, {'id': chat})[user] = record
+            self._run(r.table(self._table).insert(
+                list(documents.values()),
+                conflict=lambda key, old, new: _replace_users(old, new, lambda user: build(old, user))))
+            self._invalidate(documents)
+
+    def get_states_many(self,
+                        addresses: typing.Iterable[typing.Tuple],
+                        default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get states of many users with batched get_all queries
+        :param addresses: Iterable of (chat, user) pairs
+        :param default: Returns if no state.
+        :return: List of states in order of addresses
+        """
+        return [record['state'] or default for record in self._get_records_many(addresses, fields=('state',))]
+
+    def get_data_many(self,
+                      addresses: typing.Iterable[typing.Tuple],
+                      default: typing.Optional[str] = None) -> typing.List:
+        """
+        Get data of many users with batched get_all queries
+        :param addresses: Iterable of (chat, user) pairs
+        :param default: Returns if no data.
+        :return: List of data in order of addresses
+        """
+        return [self._decode(record['data']) or default
+                for record in self._get_records_many(addresses, fields=('data',))]
+
+    def set_state_many(self,
+                       addresses: typing.Iterable[typing.Tuple],
+                       state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set same state for many users with batched inserts
+        :param addresses: Iterable of (chat, user) pairs
+        :param state:
+        :return:
+        """
+        self._set_records_many(addresses, {'state': state, 'data': {}},
+                               lambda old, user: old[user].default({'data': {}}).merge({'state': state}))
+
+    def update_data_many(self,
+                         addresses: typing.Iterable[typing.Tuple],
+                         data: typing.Dict = None):
+        """
+        Update data of many users with same data with batched inserts
+        :param addresses: Iterable of (chat, user) pairs
+        :param data: Data to update
+        :return:
+        """
+        if not data:
+            return
+        if self.codec is not None:
+            return super(RethinkDBStorage, self).update_data_many(addresses, data)
+        keys = list(data.keys())
+        self._set_records_many(addresses, {'state': None, 'data': data},
+                               lambda old, user: r.expr({'state': None}).merge(old[user].default({}).without('data')).merge(
+                                   {'data': old[user]['data'].default({}).without(r.args(keys)).merge(data)}))
+
+    def finish_many(self, addresses: typing.Iterable[typing.Tuple]):
+        """
+        Fully reset state and data of many users with batched inserts
+        :param addresses: Iterable of (chat, user) pairs
+        :return:
+        """
+        self._set_records_many(addresses, {'state': None, 'data': {}},
+                               lambda old, user: {'state': None, 'data': {}})
+
+
+def _async_connection_type():
+    """
+    Get asyncio connection class of RethinkDB driver. Global loop type of the driver isn't switched,
+    so sync connections opened meanwhile by other threads are not affected.
+    Driver 2.3 module can't be imported by its package path, so it's loaded by file under the name
+    set_loop_type gives it
+    :return: Connection class
+    """
+    try:
+        from rethinkdb.asyncio_net.net_asyncio import Connection
+        return Connection
+    except ImportError:
+        pass
+    module = sys.modules.get('rethinkdb.net_asyncio')
+    if module is None:
+        path = os.path.join(os.path.dirname(net.__file__), 'asyncio_net', 'net_asyncio.py')
+        spec = importlib.util.spec_from_file_location('rethinkdb.net_asyncio', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[spec.name] = module
+    return module.Connection
+
+
+class AsyncRethinkDBStorage(AsyncBaseStorage):
+    """
+    Asyncio storage based on RethinkDB.
+    Uses one connection, queries are multiplexed over it by the driver.
+    """
+    def __init__(self,
+                 host: typing.Optional[typing.AnyStr] = 'localhost',
+                 port: typing.Optional[int] = 28015,
+                 db: typing.Optional[typing.AnyStr] = 'FSMBot',
+                 table: typing.Optional[typing.AnyStr] = 'states',
+                 user: typing.Optional[typing.AnyStr] = 'FSMBot',
+                 password: typing.Optional[typing.AnyStr] = 'FSMBot',
+                 timeout: typing.Union[int, float] = 20,
+                 ssl: typing.Dict = None,
+                 **kwargs):
+        self._host = host
+        self._port = port
+        self._db = db
+        self._table = table
+        self._user = user
+        self._password = password
+        self._timeout = timeout
+        self._ssl = ssl if ssl else {}
+        self._kwargs = kwargs
+        self._connection = None
+        self._connecting = None
+
+    async def _initialize(self, connection):
+        """
+        Initialize DB and table
+        :param connection: RethinkDB connection
+        :return:
+        """
+        if self._db not in await r.db_list().run(connection):
+            await r.db_create(self._db).run(connection)
+
+        connection.use(self._db)
+
+        if self._table not in await r.table_list().run(connection):
+            await r.table_create(self._table).run(connection)
+
+    async def _connect(self):
+        """
+        Connect to RethinkDB
+        :return: RethinkDB connection
+        """
+        connection = _async_connection_type()(self._host, self._port, None, None, self._user, self._password,
+                                              self._timeout, self._ssl, 10, **self._kwargs)
+        await connection.reconnect(timeout=self._timeout)
+        await self._initialize(connection)
+        return connection
+
+    async def _get_connection(self):
+        """
+        Get open connection, connect if needed
+        :return: RethinkDB connection
+        """
+        if self._connection is not None and self._connection.is_open():
+            return self._connection
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            self._connection = await asyncio.shield(self._connecting)
+        finally:
+            self._connecting = None
+        return self._connection
+
+    async def _run(self, query, **kwargs):
+        """
+        Run query, reconnect and retry once if connection is broken
+        :param query: RethinkDB query
+        :return: Query result
+        """
+        for attempt in range(2):
+            connection = await self._get_connection()
+            try:
+                return await query.run(connection, **kwargs)
+            except r.ReqlDriverError:
+                self._connection = None
+                if attempt:
+                    raise
+
+    async def close(self):
+        """
+        Close connection with RethinkDB
+        :return:
+        """
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _set_record(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          state=_UNSET,
+                          data=_UNSET,
+                          update_data: typing.Optional[typing.Dict] = None):
+        """
+        Make record in RethinkDB with single atomic upsert
+        :param chat: Chat id
+        :param user: User id
+        :param state: Optional. New state
+        :param data: Optional. New data, rewrites old one
+        :param update_data: Optional. Data to merge into old one, key by key
+        :return:
+        """
+        chat, user = self.check_address(chat, user)
+        await self._run(_set_record_query(self._table, chat, user, state=state, data=data, update_data=update_data))
+
+    async def set_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param state:
+        :return:
+        """
+        await self._set_record(chat, user, state=state)
+
+    async def set_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       data: typing.Dict = None):
+        """
+        Set data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param data:
+        :return:
+        """
+        await self._set_record(chat, user, data=data)
+
+    async def get_state(self,
+                        chat: typing.Union[int, str, None] = None,
+                        user: typing.Union[int, str, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Union[str]:
+        """
+        Get state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no state.
+        :return: User state
+        """
+        chat, user = self.check_address(chat, user)
+        return await self._run(_get_field_query(self._table, chat, user, 'state')) or default
+
+    async def get_data(self,
+                       chat: typing.Union[int, str, None] = None,
+                       user: typing.Union[int, str, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        """
+        Get data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no data.
+        :return: User data
+        """
+        chat, user = self.check_address(chat, user)
+        return await self._run(_get_field_query(self._table, chat, user, 'data')) or default
+
+    async def update_data(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          data: typing.Dict = None):
+        """
+        Update user data
+        :param chat: Chat id
+        :param user: User id
+        :param data: Data to update
+        :return:
+        """
+        await self._set_record(chat, user, update_data=data)
+
+    async def reset_data(self,
+                         chat: typing.Union[int, str, None] = None,
+                         user: typing.Union[int, str, None] = None):
+        """
+        Reset data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return:
+        """
+        await self._set_record(chat, user, data={})
+
+    async def reset_state(self,
+                          chat: typing.Union[int, str, None] = None,
+                          user: typing.Union[int, str, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat with single query
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        if with_data:
+            await self._set_record(chat, user, state=None, data={})
+        else:
+            await self._set_record(chat, user, state=None)
@@ -0,0 +1,403 @@
+# -*- coding:utf-8; -*-
+
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+import typing
+
+from .base import BaseStorage
+
+
+def _hash(value):
+    """
+    Hash, which is stable between processes
+    :param value: String
+    :return: int
+    """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class _Ring:
+    """
+    Consistent hash ring of shard names
+    """
+    def __init__(self, names, replicas):
+        points = sorted((_hash('{}#{}'.format(name, replica)), name) for name in names for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, key):
+        position = bisect.bisect(self._hashes, _hash(key))
+        return self._names[position % len(self._names)]
+
+
+class ShardedStorage(BaseStorage):
+    """
+    Storage, which spreads records over several storages by consistent hashing.
+    By default, all users of chat are kept in one shard. With per_user, every (chat, user) is placed separately.
+    New shard can be added while storage is used: records are moved to it on first access
+    or by rebalance(), which can run in background.
+    Moves are serialized with writes through ShardedStorage only, so shards must not be written directly
+    until rebalance() is done, else such writes may be lost or left in old shard.
+    """
+    def __init__(self,
+                 storages: typing.Union[typing.Sequence[BaseStorage], typing.Dict[str, BaseStorage]],
+                 per_user: bool = False,
+                 replicas: int = 100,
+                 lock_stripes: int = 64):
+        """
+        :param storages: Shards. Names of shards place them on hash ring, list items are named by their positions,
+        so shards must be passed in the same order every time
+        :param per_user: Optional. Shard by (chat, user) instead of chat
+        :param replicas: Optional. Number of ring points per shard
+        :param lock_stripes: Optional. Number of locks, which serialize moves of records between shards
+        """
+        if not isinstance(storages, dict):
+            storages = collections.OrderedDict(('shard{}'.format(index), storage) for index, storage in enumerate(storages))
+        assert storages and all(isinstance(storage, BaseStorage) for storage in storages.values())
+        self.per_user = per_user
+        self.replicas = replicas
+        self._storages = collections.OrderedDict(storages)
+        self._ring = _Ring(self._storages, replicas)
+        self._old_ring = None
+        self._moved = set()
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._rebalance_lock = threading.Lock()
+
+    @property
+    def shards(self) -> typing.Dict[str, BaseStorage]:
+        """
+        Shards by name
+        :return:
+        """
+        return dict(self._storages)
+
+    def _address(self, chat, user):
+        chat, user = self.check_address(chat, user)
+        return str(chat), str(user)
+
+    def _key(self, address):
+        return '{}:{}'.format(*address) if self.per_user else address[0]
+
+    def _owner(self, address):
+        """
+        Get name of shard, which owns record, move record to it if it's still in old shard
+        :param address: (chat, user) as strings
+        :return: Shard name
+        """
+        key = self._key(address)
+        name = self._ring.get(key)
+        old_ring = self._old_ring
+        if old_ring is not None and key not in self._moved:
+            old_name = old_ring.get(key)
+            if old_name != name:
+                self._move(key, old_name, name, address=address)
+        return name
+
+    def _move(self, key, old_name, name, address=None, records=None):
+        """
+        Move records of shard key from old shard to new one, once.
+        Records are written to new shard and reset in old one, all users of chat move together unless per_user
+        :param key: Shard key
+        :param old_name: Shard name before rebalance
+        :param name: Shard name after rebalance
+        :param address: Optional. (chat, user) as strings, records of key are read from old shard
+        :param records: Optional. (chat, user, record) of key as iter_records yields them,
+        state and data are read again, deadline is taken from them
+        :return:
+        """
+        with self._locks[hash(key) % len(self._locks)]:
+            if key in self._moved:
+                return
+            old, new = self._storages[old_name], self._storages[name]
+            if records is None:
+                # Only iter_records returns deadline
+                records = [(chat, user, record) for chat, user, record in old.iter_chat_records(address[0])
+                           if self._key((chat, user)) == key]
+            else:
+                records = [(chat, user, dict(old.get_record(chat, user), deadline=record.get('deadline')))
+                           for chat, user, record in records]
+            for chat, user, record in records:
+                if record.get('state') or record.get('data') or record.get('deadline') is not None:
+                    new.set_record(chat, user, {'state': record.get('state'), 'data': record.get('data') or {},
+                                                'deadline': record.get('deadline')})
+                    old.set_record(chat, user, {'state': None, 'data': {}, 'deadline': None})
+            new.flush()
+            old.flush()
+            self._moved.add(key)
+
+    def _shard(self, chat, user):
+        """
+        Get shard of user in chat
+        :param chat: Chat id
+        :param user: User id
+        :return: Storage
+        """
+        return self._storages[self._owner(self._address(chat, user))]
+
+    def add_shard(self, storage: BaseStorage, name: typing.Optional[str] = None):
+        """
+        Add shard. Records, which belong to it now, are moved on first access or by rebalance().
+        Don't write to shards directly until rebalance() is done
+        :param storage: Shard
+        :param name: Optional. Shard name, defaults to next position
+        :return:
+        """
+        assert isinstance(storage, BaseStorage)
+        with self._rebalance_lock:
+            if self._old_ring is not None:
+                raise RuntimeError('Previous rebalance is not finished.')
+            name = name if name is not None else 'shard{}'.format(len(self._storages))
+            if name in self._storages:
+                raise ValueError("Shard '{}' already exists.".format(name))
+            storages = collections.OrderedDict(self._storages)
+            storages[name] = storage
+            self._old_ring, self._moved = self._ring, set()
+            self._storages = storages
+            self._ring = _Ring(storages, self.replicas)
+
+    def rebalance(self, batch_size: int = 1000) -> int:
+        """
+        Move all records, which belong to other shards after add_shard. Storage can be used meanwhile.
+        Every shard is read in chunks, so no cursor is open while records are moved
+        :param batch_size: Optional. Number of records per chunk
+        :return: Number of moved shard keys
+        """
+        with self._rebalance_lock:
+            old_ring = self._old_ring
+            if old_ring is None:
+                return 0
+            moved = 0
+            for old_name, storage in list(self._storages.items()):
+                last = None
+                while True:
+                    records = storage.iter_records(start_after=last)
+                    chunk = list(itertools.islice(records, batch_size))
+                    if not chunk:
+                        break
+                    if not self.per_user:
+                        # Don't split users of chat between chunks
+                        chunk.extend(itertools.takewhile(lambda item: item[0] == chunk[-1][0], records))
+                    del records
+                    last = chunk[-1][:2]
+                    for key, group in itertools.groupby(chunk, lambda item: self._key(item[:2])):
+                        name = self._ring.get(key)
+                        if old_ring.get(key) != old_name or name == old_name or key in self._moved:
+                            continue
+                        self._move(key, old_name, name, records=list(group))
+                        moved += 1
+            self._old_ring, self._moved = None, set()
+            return moved
+
+    def _owns(self, name, address):
+        """
+        Whether record of shard is actual one, records left in old shard during rebalance are skipped
+        :param name: Shard name
+        :param address: (chat, user) as strings
+        :return:
+        """
+        key = self._key(address)
+        if self._ring.get(key) == name:
+            return True
+        old_ring = self._old_ring
+        return old_ring is not None and key not in self._moved and old_ring.get(key) == name
+
+    def _group(self, addresses):
+        """
+        Group addresses by shard
+        :param addresses: Iterable of (chat, user) pairs
+        :return: (list of shard names in order of addresses, dict of shard name -> list of addresses)
+        """
+        names, groups = [], collections.OrderedDict()
+        for chat, user in addresses:
+            name = self._owner(self._address(chat, user))
+            names.append(name)
+            groups.setdefault(name, []).append((chat, user))
+        return names, groups
+
+    def _get_many(self, addresses, method, **kwargs):
+        """
+        Call batched getter of every shard once and put results in order of addresses
+        :param addresses: Iterable of (chat, user) pairs
+        :param method: Getter name
+        :return: List of results
+        """
+        names, groups = self._group(addresses)
+        results = {name: iter(getattr(self._storages[name], method)(group, **kwargs)) for name, group in groups.items()}
+        return [next(results[name]) for name in names]
+
+    @property
+    def data(self):
+        """
+        Return all data from shards
+        :return: Records
+        """
+        result = {}
+        for chat, user, record in self.iter_records():
+            result.setdefault(chat, {})[user] = {'state': record['state'], 'data': record['data']}
+        return result
+
+    def flush(self, addresses: typing.Optional[typing.Iterable[typing.Tuple]] = None):
+        addresses = list(addresses) if addresses is not None else None
+        for storage in self._storages.values():
+            storage.flush(addresses=addresses)
+
+    def close(self):
+        for storage in self._storages.values():
+            storage.close()
+
+    def get_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  default: typing.Optional[str] = None) -> typing.Union[str]:
+        return self._shard(chat, user).get_state(chat, user, default=default)
+
+    def get_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 default: typing.Optional[str] = None) -> typing.Dict:
+        return self._shard(chat, user).get_data(chat, user, default=default)
+
+    def set_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  state: typing.Optional[typing.AnyStr] = None):
+        self._shard(chat, user).set_state(chat, user, state)
+
+    def set_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 data: typing.Dict = None):
+        self._shard(chat, user).set_data(chat, user, data)
+
+    def update_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    data: typing.Dict = None):
+        self._shard(chat, user).update_data(chat, user, data)
+
+    def reset_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None):
+        self._shard(chat, user).reset_data(chat, user)
+
+    def reset_state(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    with_data: typing.Optional[bool] = True):
+        self._shard(chat, user).reset_state(chat, user, with_data=with_data)
+
+    def finish(self,
+               chat: typing.Union[int, str, None] = None,
+               user: typing.Union[int, str, None] = None):
+        self._shard(chat, user).finish(chat, user)
+
+    def get_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None) -> typing.Dict:
+        return self._shard(chat, user).get_record(chat, user)
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        self._shard(chat, user).set_record(chat, user, record)
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        self._shard(chat, user).set_deadline(chat, user, deadline)
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        return self._shard(chat, user).transition(chat, user, expected=expected, state=state, deadline=deadline)
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        return self._shard(chat, user).mutate_data(chat, user, fn=fn)
+
+    def patch_data(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   ops: typing.Iterable[typing.Sequence] = ()) -> typing.Dict:
+        return self._shard(chat, user).patch_data(chat, user, ops=ops)
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        return [deadline for name, storage in self._storages.items() for deadline in storage.get_deadlines()
+                if self._owns(name, (str(deadline[0]), str(deadline[1])))]
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over records of all shards, merged in address order
+        :param start_after: Optional. (chat, user) after which iteration starts
+        :return: Iterator of (chat, user, record)
+        """
+        def iterate(name, storage):
+            for chat, user, record in storage.iter_records(start_after=start_after):
+                if self._owns(name, (chat, user)):
+                    yield (chat, user), chat, user, record
+
+        for _, chat, user, record in heapq.merge(*(iterate(name, storage) for name, storage in self._storages.items())):
+            yield chat, user, record
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records to their shards, batched per shard
+        :param records: Iterable of (chat, user, record)
+        :return: Number of written records
+        """
+        groups = collections.defaultdict(list)
+        count = 0
+        for chat, user, record in records:
+            groups[self._owner(self._address(chat, user))].append((chat, user, record))
+            count += 1
+        for name, group in groups.items():
+            self._storages[name].load_records(group)
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        for storage in self._storages.values():
+            for address in storage.iter_addresses_in_state(state):
+                yield address
+
+    def count_states(self) -> typing.Dict[str, int]:
+        counts = collections.Counter()
+        for storage in self._storages.values():
+            counts.update(storage.count_states())
+        return dict(counts)
+
+    def get_states_many(self,
+                        addresses: typing.Iterable[typing.Tuple],
+                        default: typing.Optional[str] = None) -> typing.List:
+        return self._get_many(addresses, 'get_states_many', default=default)
+
+    def get_data_many(self,
+                      addresses: typing.Iterable[typing.Tuple],
+                      default: typing.Optional[str] = None) -> typing.List:
+        return self._get_many(addresses, 'get_data_many', default=default)
+
+    def set_state_many(self,
+                       addresses: typing.Iterable[typing.Tuple],
+                       state: typing.Optional[typing.AnyStr] = None):
+        for name, group in self._group(addresses)[1].items():
+            self._storages[name].set_state_many(group, state)
+
+    def update_data_many(self,
+                         addresses: typing.Iterable[typing.Tuple],
+                         data: typing.Dict = None):
+        for name, group in self._group(addresses)[1].items():
+            self._storages[name].update_data_many(group, data)
+
+    def finish_many(self, addresses: typing.Iterable[typing.Tuple]):
+        for name, group in self._group(addresses)[1].items():
+            self._storages[name].finish_many(group)
@@ -0,0 +1,661 @@
+# -*- coding:utf-8; -*-
+
+import atexit
+import collections
+import json
+import sqlite3
+import threading
+import time
+import typing
+
+import telebot
+
+from .base import BaseStorage
+from .codecs import DataCodec, decode
+
+_STATE, _DATA, _UPDATE, _DEADLINE = range(4)
+
+
+def _is_transient(error):
+    """
+    Whether commit error may go away on retry, i.e. database is locked by other process
+    :param error: Exception
+    :return:
+    """
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Storage based on SQLite in WAL mode.
+    State and data are kept in separate columns, so state reads never decode data.
+    Data is stored as JSON text, or as bytes of codec if it's passed.
+    Writes are queued and committed by background writer in batches, reads use connection of current thread
+    and see queued writes. Data is encoded before write is queued, so data, which can't be encoded, raises at once.
+    Batch, which failed to commit because database is locked, stays queued and is retried with backoff,
+    the error is raised by sync and close until it's committed. Batch, which failed for other reason, is dropped,
+    its error is logged and raised once by next sync or close.
+    """
+    retry_interval = 0.1
+    max_retry_interval = 10
+
+    def __init__(self,
+                 path: str = 'states.sqlite3',
+                 table: str = 'states',
+                 max_batch: int = 1000,
+                 timeout: typing.Union[int, float] = 20,
+                 codec: typing.Optional[DataCodec] = None):
+        """
+        :param path: Database file
+        :param table: Optional. Table name
+        :param max_batch: Optional. Maximum number of writes committed in one transaction
+        :param timeout: Optional. Seconds to wait for database lock
+        :param codec: Optional. Codec of data. Data written before codec was set is still read.
+        With size cap of codec, update_data reads data to check merged size
+        """
+        self.codec = codec
+        self._path = path
+        self._table = table
+        self._timeout = timeout
+        self.max_batch = max_batch
+
+        self._select_state = 'SELECT state FROM {} WHERE chat = ? AND user = ?'.format(table)
+        self._select_data = 'SELECT data FROM {} WHERE chat = ? AND user = ?'.format(table)
+        self._select_record = 'SELECT state, data FROM {} WHERE chat = ? AND user = ?'.format(table)
+        self._insert = 'INSERT OR IGNORE INTO {} (chat, user) VALUES (?, ?)'.format(table)
+        self._update_state = 'UPDATE {} SET state = ? WHERE chat = ? AND user = ?'.format(table)
+        self._update_data = 'UPDATE {} SET data = ? WHERE chat = ? AND user = ?'.format(table)
+        self._update_deadline = 'UPDATE {} SET deadline = ? WHERE chat = ? AND user = ?'.format(table)
+
+        self._local = threading.local()
+        self._connections = []
+        self._queue = collections.deque()
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._queued = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._writing = 0
+        self._closed = False
+        self._error = None
+        self._dropped = None
+
+        self._initialize()
+        self._writer = threading.Thread(target=self._run, name='SQLiteStorageWriter', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        """
+        Open connection to database
+        :return: SQLite connection
+        """
+        connection = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        return connection
+
+    def _initialize(self):
+        """
+        Create table, add columns missing in tables of older versions
+        :return:
+        """
+        connection = self._connection
+        connection.execute('CREATE TABLE IF NOT EXISTS {} (chat TEXT NOT NULL, user TEXT NOT NULL, state TEXT, data TEXT, '
+                           'deadline REAL, PRIMARY KEY (chat, user)) WITHOUT ROWID'.format(self._table))
+        columns = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(self._table))]
+        if 'deadline' not in columns:
+            connection.execute('ALTER TABLE {} ADD COLUMN deadline REAL'.format(self._table))
+        connection.execute('CREATE INDEX IF NOT EXISTS {0}_deadline ON {0} (deadline) '
+                           'WHERE deadline IS NOT NULL'.format(self._table))
+        connection.execute('CREATE INDEX IF NOT EXISTS {0}_state ON {0} (state) WHERE state IS NOT NULL'.format(self._table))
+
+    @property
+    def _connection(self):
+        """
+        Connection of current thread
+        :return: SQLite connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat, user)
+        return str(chat), str(user)
+
+    def _encode(self, data):
+        """
+        Encode data for data column, size is checked before write is queued
+        :param data: Data
+        :return: JSON text, bytes or None if no data
+        """
+        if not data:
+            return None
+        return self.codec.encode(data, check_size=False) if self.codec else json.dumps(data)
+
+    def _check_data(self, key, data, update=False):
+        """
+        Encode data before write is queued, so error is raised to caller instead of background writer.
+        Raises DataTooLargeError if encoded data is above size cap of codec
+        :param key: Record key
+        :param data: New data
+        :param update: Optional. Whether data is merged into old one
+        :return:
+        """
+        if not data:
+            return
+        if self.codec is None:
+            json.dumps(data)
+            return
+        if update and self.codec.max_size is not None:
+            data, update = dict(self.get_data(*key) or {}), data
+            data.update(update)
+        self.codec.encode(data)
+
+    def _enqueue(self, operations):
+        """
+        Queue writes for background writer
+        :param operations: Iterable of (key, kind, value)
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Storage is closed.')
+            for operation in operations:
+                self._queue.append(operation)
+                self._pending.setdefault(operation[0], collections.deque()).append(operation)
+            self._queued.notify()
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._queued.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+                self._writing = len(batch)
+
+            try:
+                self._commit(batch)
+            except Exception as e:
+                if not _is_transient(e):
+                    telebot.logger.error('Failed to commit {} writes to SQLite, they are dropped: {}'.format(len(batch), e))
+                    self._done(batch, dropped=e)
+                    continue
+                telebot.logger.error('Failed to commit {} writes to SQLite, they will be retried: {}'.format(len(batch), e))
+                with self._lock:
+                    # Writes stay pending, so reads still see them
+                    self._queue.extendleft(reversed(batch))
+                    self._error = e
+                    self._writing = 0
+                    self._flushed.notify_all()
+                    failures += 1
+                    if self._closed:
+                        return
+                    deadline = time.monotonic() + min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+                    while not self._closed and time.monotonic() < deadline:
+                        self._queued.wait(deadline - time.monotonic())
+                continue
+
+            failures = 0
+            self._done(batch)
+
+    def _done(self, batch, dropped=None):
+        """
+        Remove written or dropped batch from pending writes
+        :param batch: List of (key, kind, value)
+        :param dropped: Optional. Error, because of which batch is dropped
+        :return:
+        """
+        with self._lock:
+            for key, _, _ in batch:
+                pending = self._pending[key]
+                pending.popleft()
+                if not pending:
+                    del self._pending[key]
+            self._error = None
+            if dropped is not None:
+                self._dropped = dropped
+            self._writing = 0
+            self._flushed.notify_all()
+
+    def _commit(self, batch):
+        """
+        Write batch in one transaction, several writes of one record are merged into one
+        :param batch: List of (key, kind, value)
+        :return:
+        """
+        records = collections.OrderedDict()
+        for key, kind, value in batch:
+            record = records.setdefault(key, {})
+            if kind == _STATE:
+                record['state'] = value
+            elif kind == _DEADLINE:
+                record['deadline'] = value
+            elif kind == _DATA:
+                record['data'], record['merge'] = value, False
+            elif 'data' in record:
+                record['data'] = dict(record['data'] or {})
+                record['data'].update(value)
+            else:
+                record['data'], record['merge'] = dict(value), True
+
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key, record in records.items():
+                connection.execute(self._insert, key)
+                if 'state' in record:
+                    connection.execute(self._update_state, (record['state'],) + key)
+                if 'deadline' in record:
+                    connection.execute(self._update_deadline, (record['deadline'],) + key)
+                if 'data' in record:
+                    data = record['data']
+                    if record['merge']:
+                        row = connection.execute(self._select_data, key).fetchone()
+                        data, update = dict(decode(row[0]) if row else {}), data
+                        data.update(update)
+                    connection.execute(self._update_data, (self._encode(data),) + key)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _read(self, key, query, columns=1):
+        """
+        Read columns of record and queued writes of it
+        :param key: Record key
+        :param query: Select query
+        :param columns: Optional. Number of selected columns
+        :return: (row or tuple of None, list of queued writes)
+        """
+        connection = self._connection
+        empty = (None,) * columns
+        with self._lock:
+            pending = list(self._pending.get(key, ()))
+            if pending:
+                # No writes can be queued while lock is held, so row is never newer than queued writes.
+                # Writer may commit some of them meanwhile, but applying them again over row gives the same result.
+                return connection.execute(query, key).fetchone() or empty, pending
+        return connection.execute(query, key).fetchone() or empty, pending
+
+    @staticmethod
+    def _apply(state, data, pending):
+        """
+        Apply queued writes over stored state and data
+        :param state: Stored state
+        :param data: Stored data, decoded
+        :param pending: List of queued writes
+        :return: (state, data)
+        """
+        for _, kind, value in pending:
+            if kind == _STATE:
+                state = value
+            elif kind == _DATA:
+                data = dict(value) if value else {}
+            elif kind == _UPDATE:
+                data.update(value)
+        return state, data
+
+    def sync(self):
+        """
+        Wait until all queued writes are committed.
+        Raises error of last failed commit, if writes are still queued after it, or error of dropped batch once
+        :return:
+        """
+        with self._lock:
+            while (self._queue or self._writing) and self._writer.is_alive():
+                if self._error is not None:
+                    raise self._error
+                self._flushed.wait()
+            if self._queue and self._error is not None:
+                raise self._error
+            dropped, self._dropped = self._dropped, None
+        if dropped is not None:
+            raise dropped
+
+    def close(self):
+        """
+        Commit queued writes and close connections
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queued.notify()
+        self._writer.join()
+        with self._lock:
+            connections, self._connections = self._connections, []
+            error = self._error if self._queue else self._dropped
+            self._dropped = None
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+        if error is not None:
+            raise error
+
+    @property
+    def data(self):
+        """
+        Return all data from SQLite
+        :return: Records
+        """
+        if self._closed:
+            return {}
+        self.sync()
+        result = {}
+        for chat, user, state, data in self._connection.execute('SELECT chat, user, state, data FROM {}'.format(self._table)):
+            result.setdefault(chat, {})[user] = {'state': state, 'data': decode(data)}
+        return result
+
+    def set_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param state:
+        :return:
+        """
+        self._enqueue([(self._key(chat, user), _STATE, state)])
+
+    def set_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 data: typing.Dict = None):
+        """
+        Set data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param data:
+        :return:
+        """
+        key = self._key(chat, user)
+        self._check_data(key, data)
+        self._enqueue([(key, _DATA, dict(data) if data else None)])
+
+    def get_state(self,
+                  chat: typing.Union[int, str, None] = None,
+                  user: typing.Union[int, str, None] = None,
+                  default: typing.Optional[str] = None) -> typing.Union[str]:
+        """
+        Get state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no state.
+        :return: User state
+        """
+        (state,), pending = self._read(self._key(chat, user), self._select_state)
+        for _, kind, value in pending:
+            if kind == _STATE:
+                state = value
+        return state or default
+
+    def get_data(self,
+                 chat: typing.Union[int, str, None] = None,
+                 user: typing.Union[int, str, None] = None,
+                 default: typing.Optional[str] = None) -> typing.Dict:
+        """
+        Get data for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param default: Returns if no data.
+        :return: User data
+        """
+        (data,), pending = self._read(self._key(chat, user), self._select_data)
+        _, data = self._apply(None, decode(data), pending)
+        return data or default
+
+    def get_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None) -> typing.Dict:
+        """
+        Get state and data of user in chat with single select
+        :param chat: Chat id
+        :param user: User id
+        :return: Dict with state and data
+        """
+        (state, data), pending = self._read(self._key(chat, user), self._select_record, columns=2)
+        state, data = self._apply(state, decode(data), pending)
+        return {'state': state, 'data': data}
+
+    def set_record(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   record: typing.Dict = None):
+        """
+        Write several changes of user in chat, they are queued together
+        :param chat: Chat id
+        :param user: User id
+        :param record: Dict with any of state, data (replaces old data) and update_data (merged into old data)
+        :return:
+        """
+        key = self._key(chat, user)
+        operations = []
+        if 'state' in record:
+            operations.append((key, _STATE, record['state']))
+        if 'data' in record:
+            self._check_data(key, record['data'])
+            operations.append((key, _DATA, dict(record['data']) if record['data'] else None))
+        elif record.get('update_data'):
+            self._check_data(key, record['update_data'], update=True)
+            operations.append((key, _UPDATE, dict(record['update_data'])))
+        if 'deadline' in record:
+            operations.append((key, _DEADLINE, record['deadline']))
+        self._enqueue(operations)
+
+    def set_deadline(self,
+                     chat: typing.Union[int, str, None] = None,
+                     user: typing.Union[int, str, None] = None,
+                     deadline: typing.Optional[float] = None):
+        """
+        Store time when state of user in chat times out
+        :param chat: Chat id
+        :param user: User id
+        :param deadline: Unix time or None to clear
+        :return:
+        """
+        self._enqueue([(self._key(chat, user), _DEADLINE, deadline)])
+
+    def _iter(self, query, parameters=()):
+        """
+        Run select on connection of current thread and fetch rows while iterating
+        :param query: Select query
+        :param parameters: Optional. Query parameters
+        :return: Iterator of rows
+        """
+        self.sync()
+        cursor = self._connection.execute(query, parameters)
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def iter_records(self, start_after: typing.Optional[typing.Tuple] = None) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over all records in primary key order, rows are fetched while iterating
+        :param start_after: Optional. (chat, user) after which iteration starts
+        :return: Iterator of (chat, user, record), record is dict with state, data and optional deadline
+        """
+        query = 'SELECT chat, user, state, data, deadline FROM {}'.format(self._table)
+        parameters = ()
+        if start_after:
+            chat, user = map(str, start_after)
+            query += ' WHERE chat > ? OR (chat = ? AND user > ?)'
+            parameters = (chat, chat, user)
+        for chat, user, state, data, deadline in self._iter(query + ' ORDER BY chat, user', parameters):
+            record = {'state': state, 'data': decode(data)}
+            if deadline is not None:
+                record['deadline'] = deadline
+            yield chat, user, record
+
+    def load_records(self, records: typing.Iterable[typing.Tuple]) -> int:
+        """
+        Write records, they replace existing ones.
+        Records are queued by max_batch and every batch is committed before next one is queued,
+        so queue doesn't grow with number of records
+        :param records: Iterable of (chat, user, record) like iter_records yields
+        :return: Number of written records
+        """
+        count, operations = 0, []
+        for chat, user, record in records:
+            key = self._key(chat, user)
+            self._check_data(key, record.get('data'))
+            operations.extend([(key, _STATE, record.get('state')), (key, _DATA, record.get('data') or None),
+                               (key, _DEADLINE, record.get('deadline'))])
+            count += 1
+            if len(operations) >= self.max_batch:
+                self._enqueue(operations)
+                self.sync()
+                operations = []
+        if operations:
+            self._enqueue(operations)
+            self.sync()
+        return count
+
+    def iter_addresses_in_state(self, state: str) -> typing.Iterator[typing.Tuple]:
+        """
+        Iterate over users in state, found by state index. Rows are fetched while iterating
+        :param state: State
+        :return: Iterator of (chat, user)
+        """
+        return self._iter('SELECT chat, user FROM {} WHERE state = ?'.format(self._table), (state,))
+
+    def count_states(self) -> typing.Dict[str, int]:
+        """
+        Count users in every state by state index
+        :return: Dict of state -> number of users
+        """
+        self.sync()
+        return dict(self._connection.execute('SELECT state, COUNT(*) FROM {} WHERE state IS NOT NULL AND state != \'\' '
+                                             'GROUP BY state'.format(self._table)))
+
+    def get_deadlines(self) -> typing.List[typing.Tuple]:
+        """
+        Get all stored deadlines, read by partial index of records with deadline
+        :return: List of (chat, user, state, deadline)
+        """
+        self.sync()
+        return self._connection.execute('SELECT chat, user, state, deadline FROM {} '
+                                        'WHERE deadline IS NOT NULL'.format(self._table)).fetchall()
+
+    def update_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    data: typing.Dict = None):
+        """
+        Update user data
+        :param chat: Chat id
+        :param user: User id
+        :param data: Data to update
+        :return:
+        """
+        if data:
+            key = self._key(chat, user)
+            self._check_data(key, data, update=True)
+            self._enqueue([(key, _UPDATE, dict(data))])
+
+    def reset_state(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    with_data: typing.Optional[bool] = True):
+        """
+        Reset state for user in chat
+        :param chat: Chat id
+        :param user: User id
+        :param with_data: Optional. If true, resets user data
+        :return:
+        """
+        key = self._key(chat, user)
+        self._enqueue([(key, _STATE, None), (key, _DATA, None)] if with_data else [(key, _STATE, None)])
+
+    def transition(self,
+                   chat: typing.Union[int, str, None] = None,
+                   user: typing.Union[int, str, None] = None,
+                   expected: typing.Optional[typing.AnyStr] = None,
+                   state: typing.Optional[typing.AnyStr] = None,
+                   deadline: typing.Optional[float] = None) -> bool:
+        """
+        Set state only if current state is expected.
+        Check and write are atomic among threads, queued writes are taken into account
+        :param chat: Chat id
+        :param user: User id
+        :param expected: Expected current state, None and empty string both mean no state
+        :param state: New state
+        :param deadline: Optional. Deadline of new state, written with it. Deadline of old state is cleared
+        :return: True if state was set
+        """
+        with self._lock:
+            if (self.get_state(chat, user) or None) != (expected or None):
+                return False
+            self.set_record(chat, user, {'state': state, 'deadline': deadline})
+        return True
+
+    def mutate_data(self,
+                    chat: typing.Union[int, str, None] = None,
+                    user: typing.Union[int, str, None] = None,
+                    fn: typing.Callable[[typing.Dict], typing.Dict] = None) -> typing.Dict:
+        """
+        Replace data with result of function.
+        Other threads can't write to storage while function runs
+        :param chat: Chat id
+        :param user: User id
+        :param fn: Callable, which receives copy of current data and returns new data
+        :return: New data
+        """
+        with self._lock:
+            data = fn(dict(self.get_data(chat, user) or {}))
+            self.set_data(chat, user, data)
+        return data
+
+    def set_state_many(self,
+                       addresses: typing.Iterable[typing.Tuple],
+                       state: typing.Optional[typing.AnyStr] = None):
+        """
+        Set same state for many users
+        :param addresses: Iterable of (chat, user) pairs
+        :param state:
+        :return:
+        """
+        self._enqueue([(self._key(chat, user), _STATE, state) for chat, user in addresses])
+
+    def update_data_many(self,
+                         addresses: typing.Iterable[typing.Tuple],
+                         data: typing.Dict = None):
+        """
+        Update data of many users with same data
+        :param addresses: Iterable of (chat, user) pairs
+        :param data: Data to update
+        :return:
+        """
+        if data:
+            keys = [self._key(chat, user) for chat, user in addresses]
+            if self.codec is not None and self.codec.max_size is not None:
+                for key in keys:
+                    self._check_data(key, data, update=True)
+            elif keys:
+                # Merged data is encodable if update is, so it's checked once
+                self._check_data(keys[0], data, update=True)
+            self._enqueue([(key, _UPDATE, dict(data)) for key in keys])
+
+    def finish_many(self, addresses: typing.Iterable[typing.Tuple]):
+        """
+        Fully reset state and data of many users
+        :param addresses: Iterable of (chat, user) pairs
+        :return:
+        """
+        operations = []
+        for chat, user in addresses:
+            key = self._key(chat, user)
+            operations.extend([(key, _STATE, None), (key, _DATA, None)])
+        self._enqueue(operations)
@@ -0,0 +1,131 @@
+# -*- coding:utf-8; -*-
+
+import math
+import threading
+import time
+import traceback
+import typing
+
+import telebot
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel.
+    Timer is kept in slot of its deadline tick, so schedule and cancel are O(1) and every tick looks only at one slot.
+    Timers further than one turn of wheel stay in their slot for several turns.
+    Timers fire at most one tick late, never early.
+    """
+    def __init__(self,
+                 callback: typing.Callable,
+                 tick: typing.Union[int, float] = 1,
+                 slots: int = 512,
+                 clock: typing.Callable[[], float] = time.time):
+        """
+        :param callback: Callable, which receives key and value of expired timer
+        :param tick: Optional. Seconds per slot
+        :param slots: Optional. Number of slots
+        :param clock: Optional. Clock of deadlines, wall clock by default, so deadlines can be persisted
+        """
+        self.callback = callback
+        self.tick = tick
+        self.clock = clock
+        self._slots = [{} for _ in range(slots)]
+        self._timers = {}
+        self._position = int(clock() // tick)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def _remove(self, key):
+        """
+        Remove timer. Must be called with lock held
+        :param key: Timer key
+        :return: True if timer existed
+        """
+        index = self._timers.pop(key, None)
+        if index is None:
+            return False
+        del self._slots[index][key]
+        return True
+
+    def schedule(self, key, deadline: float, value=None):
+        """
+        Arm timer, previous timer with same key is cancelled
+        :param key: Timer key
+        :param deadline: Time by clock when timer fires. Timers in the past fire on next tick
+        :param value: Optional. Passed to callback
+        :return:
+        """
+        with self._lock:
+            self._remove(key)
+            tick = max(int(math.ceil(deadline / self.tick)), self._position + 1)
+            index = tick % len(self._slots)
+            self._slots[index][key] = (tick, value)
+            self._timers[key] = index
+
+    def cancel(self, key) -> bool:
+        """
+        Cancel timer
+        :param key: Timer key
+        :return: True if timer was armed
+        """
+        with self._lock:
+            return self._remove(key)
+
+    def advance(self, now: typing.Optional[float] = None) -> int:
+        """
+        Fire all timers due by now
+        :param now: Optional. Current time by clock
+        :return: Number of fired timers
+        """
+        current = int((self.clock() if now is None else now) // self.tick)
+        expired = []
+        with self._lock:
+            steps = min(current - self._position, len(self._slots))
+            for step in range(1, steps + 1):
+                slot = self._slots[(self._position + step) % len(self._slots)]
+                for key, (tick, value) in list(slot.items()):
+                    if tick <= current:
+                        del slot[key]
+                        del self._timers[key]
+                        expired.append((key, value))
+            self._position = max(self._position, current)
+
+        for key, value in expired:
+            try:
+                self.callback(key, value)
+            except Exception as e:
+                telebot.logger.error('{} occurred in timer callback, args={}\n{}'.format(
+                    type(e).__name__, e.args, traceback.format_exc()))
+        return len(expired)
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.advance()
+
+    def start(self):
+        """
+        Advance wheel every tick in background thread
+        :return:
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='TimerWheel', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop background thread, armed timers are kept
+        :return:
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
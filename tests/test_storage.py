@@ -1,9 +1,22 @@
 # -*- coding:utf-8; -*-
 
+import asyncio
+import collections
+import sqlite3
+import sys
+import threading
+import time
+
 import pytest
 
-from fsm_telebot.storage.base import BaseStorage
+from fsm_telebot.storage.base import AsyncBaseStorage, BaseStorage
+from fsm_telebot.storage.cached import CachedStorage
+from fsm_telebot.storage.codecs import DataCodec, DataTooLargeError, decode
 from fsm_telebot.storage.memory import MemoryStorage
+from fsm_telebot.storage.migrate import migrate
+from fsm_telebot.storage.pool import ConnectionPool
+from fsm_telebot.storage.sharded import ShardedStorage
+from fsm_telebot.storage.sqlite import SQLiteStorage
 
 USER, CHAT = '10100101', '10010101'  # random
 STATE, DATA, DATA_UPDATE = 'TEST', {'1': '2'}, {'3': '4'}
@@ -42,6 +55,567 @@ class TestStorage:
         memory_storage.close()
         assert memory_storage.data == {}
 
+    def test_memory_transition(self):
+        memory_storage = MemoryStorage(lock_stripes=4)
+        assert not memory_storage.transition(CHAT, USER, expected=STATE, state='Next')
+        assert memory_storage.get_state(CHAT, USER) is None
+        assert memory_storage.transition(CHAT, USER, expected=None, state=STATE)
+        assert memory_storage.transition(CHAT, USER, expected=STATE, state='Next')
+        assert memory_storage.get_state(CHAT, USER) == 'Next'
+
+        def increment(data):
+            data['counter'] = data.get('counter', 0) + 1
+            return data
+
+        won = []
+
+        def work():
+            for _ in range(1000):
+                memory_storage.mutate_data(CHAT, USER, increment)
+            won.append(memory_storage.transition(CHAT, USER, expected='Next', state='Done'))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert memory_storage.get_data(CHAT, USER) == {'counter': 4000}
+        assert sorted(won) == [False, False, False, True]
+        assert memory_storage.get_state(CHAT, USER) == 'Done'
+
+    def test_memory_patch(self):
+        memory_storage = MemoryStorage()
+        memory_storage.set_data(CHAT, USER, {'cart': ['a'], 'form': {'name': 'x'}, 'old': 1})
+        nested = memory_storage.get_data(CHAT, USER)
+        ops = [('inc', 'counter'), ('inc', 'counter', 2), ('append', 'cart', 'b'), ('remove', 'old'),
+               ('set', ('form', 'age'), 30), ('remove', ('missing', 'key')), ('append', ('form', 'tags'), 't')]
+        expected = {'counter': 3, 'cart': ['a', 'b'], 'form': {'name': 'x', 'age': 30, 'tags': ['t']}}
+        assert memory_storage.patch_data(CHAT, USER, ops) == expected
+        assert memory_storage.get_data(CHAT, USER) == expected
+        assert nested == {'cart': ['a'], 'form': {'name': 'x'}, 'old': 1}
+
+        # Failed operation changes nothing
+        with pytest.raises(TypeError):
+            memory_storage.patch_data(CHAT, USER, [('inc', 'counter'), ('append', 'counter', 1)])
+        with pytest.raises(ValueError):
+            memory_storage.patch_data(CHAT, USER, [('push', 'cart', 1)])
+        for operation in ('set', 'inc', 'append'):
+            with pytest.raises(TypeError):
+                memory_storage.patch_data(CHAT, USER, [(operation, ('counter', 'nested'), 1)])
+        assert memory_storage.get_data(CHAT, USER) == expected
+
+        # Default implementation of BaseStorage
+        assert BaseStorage.patch_data(memory_storage, 1, None, [('set', ('a', 'b'), 1)]) == {'a': {'b': 1}}
+
+        threads = [threading.Thread(target=lambda: [memory_storage.patch_data(CHAT, USER, [('inc', 'hits')])
+                                                    for _ in range(500)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert memory_storage.get_data(CHAT, USER)['hits'] == 2000
+
+    def test_memory_compact(self):
+        memory_storage = MemoryStorage()
+
+        memory_storage.set_state(-100, 7, state=''.join(['TE', 'ST']))
+        memory_storage.set_state('@channel', state=STATE)
+        assert memory_storage.get_state('-100', '7') is STATE
+        assert memory_storage.get_state('-0100', '7') is None
+
+        record = memory_storage._records[(-100, 7)]
+        assert record.data is None
+        memory_storage.update_data(-100, 7, DATA)
+        assert record.data == DATA
+        assert memory_storage.data == {'-100': {'7': {'state': STATE, 'data': DATA}},
+                                       '@channel': {'@channel': {'state': STATE, 'data': {}}}}
+
+    def test_memory_durable(self, tmpdir):
+        path = str(tmpdir)
+        memory_storage = MemoryStorage(path=path, fsync_interval=0, snapshot_every=3)
+        memory_storage.set_state(CHAT, USER, STATE)
+        memory_storage.set_data(CHAT, USER, DATA)
+        memory_storage.set_state(1, state=STATE)
+        memory_storage.update_data(CHAT, USER, DATA_UPDATE)
+        memory_storage.set_deadline(CHAT, USER, 100.0)
+        memory_storage.close()
+
+        assert tmpdir.join('snapshot').check()
+        with open(str(tmpdir.join('journal.log')), 'ab') as log:
+            log.write(b'\x10\x00\x00\x00torn')
+
+        memory_storage = MemoryStorage(path=path, max_entries=1)
+        assert memory_storage.get_state(CHAT, USER) == STATE
+        assert memory_storage.get_data(CHAT, USER) == dict(DATA, **DATA_UPDATE)
+        assert memory_storage.get_state(1) is None
+        assert memory_storage.get_deadlines() == [(CHAT, USER, STATE, 100.0)]
+        memory_storage.set_record(CHAT, USER, {'state': None, 'deadline': None})
+        memory_storage.finish(CHAT, USER)
+        memory_storage.close()
+
+        memory_storage = MemoryStorage(path=path)
+        assert memory_storage.data == {CHAT: {USER: {'state': None, 'data': {}}}}
+        assert memory_storage.get_deadlines() == []
+        memory_storage.close()
+
+    def test_cached(self):
+        memory_storage = MemoryStorage()
+        cached_storage = CachedStorage(memory_storage, max_entries=1)
+
+        assert cached_storage.get_state(CHAT, USER) is None
+        assert cached_storage.get_state(CHAT, USER) is None
+        cached_storage.set_state(CHAT, USER, STATE)
+        cached_storage.update_data(CHAT, USER, DATA)
+        cached_storage.update_data(CHAT, USER, DATA_UPDATE)
+        assert memory_storage.data == {}
+        assert cached_storage.get_data(CHAT, USER) == dict(DATA, **DATA_UPDATE)
+        assert cached_storage.stats == {'entries': 1, 'hits': 1, 'misses': 2, 'flushes': 0, 'writes': 0, 'evicted': 0}
+
+        cached_storage.set_state(1, state=STATE)
+        assert cached_storage.stats['entries'] == 2
+        cached_storage.flush()
+        assert cached_storage.stats == {'entries': 1, 'hits': 1, 'misses': 2, 'flushes': 1, 'writes': 2, 'evicted': 1}
+        assert memory_storage.get_state(CHAT, USER) == STATE
+        assert memory_storage.get_data(CHAT, USER) == dict(DATA, **DATA_UPDATE)
+
+        memory_storage.set_state(1, state=None)
+        assert cached_storage.get_state(1) == STATE
+        cached_storage.invalidate(1)
+        assert cached_storage.get_state(1) is None
+
+        cached_storage.update_data(CHAT, USER, DATA_UPDATE)
+        cached_storage.finish(CHAT, USER)
+        assert memory_storage.data[CHAT][USER] == {'state': None, 'data': {}}
+        assert cached_storage.get_data(CHAT, USER, default={}) == {}
+        cached_storage.flush()
+        assert memory_storage.data[CHAT][USER] == {'state': None, 'data': {}}
+
+        cached_storage.close()
+        assert memory_storage.data == {}
+
+    def test_cached_flush_failure(self):
+        memory_storage = MemoryStorage()
+        cached_storage = CachedStorage(memory_storage, max_entries=1)
+        set_record = memory_storage.set_record
+        failures = [RuntimeError('Storage is down')]
+
+        def failing_set_record(chat, user, record):
+            if failures and chat == 2:
+                raise failures.pop()
+            set_record(chat, user, record)
+
+        memory_storage.set_record = failing_set_record
+        cached_storage.set_state(1, 1, STATE)
+        cached_storage.set_state(2, 2, STATE)
+        cached_storage.update_data(2, 2, DATA)
+        cached_storage.set_data(3, 3, DATA)
+        with pytest.raises(RuntimeError):
+            cached_storage.flush()
+        assert memory_storage.get_state(1, 1) == STATE
+        assert memory_storage.get_state(2, 2) is None
+        assert cached_storage.stats['entries'] == 2
+
+        cached_storage.update_data(2, 2, DATA_UPDATE)
+        cached_storage.flush([])
+        assert memory_storage.get_record(2, 2) == {'state': STATE, 'data': dict(DATA, **DATA_UPDATE)}
+        assert memory_storage.get_data(3, 3) == DATA
+        assert cached_storage.stats['entries'] == 1
+
+        failures.append(RuntimeError('Storage is down'))
+        cached_storage.set_state(2, 2, 'Next')
+        with pytest.raises(RuntimeError):
+            cached_storage.invalidate(2, 2)
+        assert memory_storage.get_state(2, 2) == STATE
+        cached_storage.invalidate(2, 2)
+        assert memory_storage.get_state(2, 2) == 'Next'
+        assert cached_storage.stats['entries'] == 0
+
+    def test_sqlite(self, tmpdir):
+        path = str(tmpdir.join('states.sqlite3'))
+        sqlite_storage = SQLiteStorage(path, max_batch=2)
+        assert sqlite_storage.get_state(CHAT, USER) is None
+
+        sqlite_storage.set_state(CHAT, USER, STATE)
+        sqlite_storage.set_data(CHAT, USER, DATA)
+        sqlite_storage.update_data(CHAT, USER, DATA_UPDATE)
+        sqlite_storage.set_state_many([(1, None), (2, 3)], STATE)
+        assert sqlite_storage.get_state(CHAT, USER) == STATE
+        assert sqlite_storage.get_data(CHAT, USER) == dict(DATA, **DATA_UPDATE)
+
+        result = []
+        thread = threading.Thread(target=lambda: result.append(sqlite_storage.get_state(2, 3)))
+        thread.start()
+        thread.join()
+        assert result == [STATE]
+
+        sqlite_storage.reset_state(1)
+        assert sqlite_storage.transition(2, 3, expected=STATE, state='Next')
+        assert not sqlite_storage.transition(2, 3, expected=STATE, state='Other')
+        assert sqlite_storage.mutate_data(2, 3, lambda data: dict(data, counter=1)) == {'counter': 1}
+        sqlite_storage.set_record(4, 5, {'state': STATE, 'update_data': DATA})
+        assert sqlite_storage.get_record(4, 5) == {'state': STATE, 'data': DATA}
+        sqlite_storage.set_record(4, 5, {'state': None, 'data': {}, 'deadline': 100.0})
+        assert sqlite_storage.get_deadlines() == [('4', '5', None, 100.0)]
+        assert sorted(sqlite_storage.iter_addresses_in_state(STATE)) == [(CHAT, USER)]
+        assert sqlite_storage.count_states() == {STATE: 1, 'Next': 1}
+        sqlite_storage.set_deadline(4, 5, None)
+        sqlite_storage.close()
+
+        sqlite_storage = SQLiteStorage(path)
+        assert sqlite_storage.data == {
+            CHAT: {USER: {'state': STATE, 'data': dict(DATA, **DATA_UPDATE)}},
+            '1': {'1': {'state': None, 'data': {}}},
+            '2': {'3': {'state': 'Next', 'data': {'counter': 1}}},
+            '4': {'5': {'state': None, 'data': {}}},
+        }
+        sqlite_storage.finish_many([(CHAT, USER)])
+        assert sqlite_storage.get_data(CHAT, USER, default={}) == {}
+        sqlite_storage.close()
+
+    def test_sqlite_commit_failure(self, tmpdir):
+        sqlite_storage = SQLiteStorage(str(tmpdir.join('states.sqlite3')))
+        sqlite_storage.retry_interval = 0.01
+        commit, failures, errors = sqlite_storage._commit, [2], []
+
+        def failing_commit(batch):
+            if errors:
+                raise errors.pop()
+            if failures[0]:
+                failures[0] -= 1
+                raise sqlite3.OperationalError('database is locked')
+            commit(batch)
+
+        sqlite_storage._commit = failing_commit
+        sqlite_storage.set_state(CHAT, USER, STATE)
+        sqlite_storage.update_data(CHAT, USER, {42: 'x'})
+        sqlite_storage.update_data(CHAT, USER, DATA)
+        with pytest.raises(sqlite3.OperationalError):
+            sqlite_storage.sync()
+        # Failed writes are still queued and visible
+        expected = dict(DATA)
+        expected[42] = 'x'
+        assert sqlite_storage.get_record(CHAT, USER) == {'state': STATE, 'data': expected}
+        for _ in range(100):
+            try:
+                sqlite_storage.sync()
+                break
+            except sqlite3.OperationalError:
+                time.sleep(0.01)
+        assert sqlite_storage.data[CHAT][USER] == {'state': STATE, 'data': dict(DATA, **{'42': 'x'})}
+
+        # Data, which can't be encoded, is rejected before it's queued
+        with pytest.raises(TypeError):
+            sqlite_storage.set_data(1, 1, {'bad': {1, 2}})
+        with pytest.raises(TypeError):
+            sqlite_storage.set_record(1, 1, {'state': STATE, 'update_data': {'bad': {1, 2}}})
+
+        # Batch, which fails permanently, is dropped and reported once, next writes are committed
+        errors.append(sqlite3.IntegrityError('constraint failed'))
+        sqlite_storage.set_state(1, 1, STATE)
+        with pytest.raises(sqlite3.IntegrityError):
+            sqlite_storage.sync()
+        sqlite_storage.set_state(2, 2, 'ok')
+        sqlite_storage.sync()
+        assert sqlite_storage.get_states_many([(1, 1), (2, 2)]) == [None, 'ok']
+
+        # Writes, which still can't be committed, are reported by close
+        failures[0] = 10 ** 6
+        sqlite_storage.set_state(CHAT, USER, 'Next')
+        with pytest.raises(sqlite3.OperationalError):
+            sqlite_storage.close()
+
+    def test_codec(self, tmpdir):
+        data = {'answers': ['answer {}'.format(number) for number in range(100)], 'name': 'x'}
+        for codec in (DataCodec(), DataCodec('pickle', compression=None), DataCodec(compress_above=10 ** 6)):
+            assert decode(codec.encode(data)) == data
+        assert DataCodec().encode(data)[:2] == b'jz'
+        assert len(DataCodec().encode(data)) < len(DataCodec(compression=None).encode(data))
+        assert DataCodec().encode({'a': 1}) == b'j-{"a":1}'
+        assert decode('{"a": 1}') == {'a': 1} and decode(None) == {}
+        with pytest.raises(DataTooLargeError):
+            DataCodec(compression=None, max_size=100).encode(data)
+
+        path = str(tmpdir.join('states.sqlite3'))
+        sqlite_storage = SQLiteStorage(path)
+        sqlite_storage.set_data(1, 2, DATA)
+        sqlite_storage.close()
+
+        # Data written without codec is still read, state reads don't decode data
+        sqlite_storage = SQLiteStorage(path, codec=DataCodec(compress_above=100, max_size=400))
+        assert sqlite_storage.get_data(1, 2) == DATA
+        sqlite_storage.set_record(CHAT, USER, {'state': STATE, 'data': data})
+        with pytest.raises(DataTooLargeError):
+            sqlite_storage.set_data(3, 4, {'answers': [str(number) * 100 for number in range(100)]})
+        with pytest.raises(DataTooLargeError):
+            sqlite_storage.update_data(CHAT, USER, {'more': [str(number) * 100 for number in range(100)]})
+        sqlite_storage.update_data(CHAT, USER, DATA_UPDATE)
+        sqlite_storage.sync()
+        stored, = sqlite_storage._connection.execute('SELECT data FROM states WHERE chat = ?', (CHAT,)).fetchone()
+        assert stored[:2] == b'jz'
+        assert sqlite_storage.get_record(CHAT, USER) == {'state': STATE, 'data': dict(data, **DATA_UPDATE)}
+        assert sqlite_storage.get_state(CHAT, USER) == STATE
+        sqlite_storage.update_data(1, 2, {7: 'x'})
+        sqlite_storage.sync()
+        assert sqlite_storage.get_data(1, 2) == dict(DATA, **{'7': 'x'})
+        sqlite_storage.close()
+
+    def test_memory_record(self):
+        memory_storage = MemoryStorage()
+        assert memory_storage.get_record(CHAT, USER) == {'state': None, 'data': {}}
+
+        memory_storage.set_record(CHAT, USER, {'state': STATE, 'data': DATA})
+        memory_storage.set_record(CHAT, USER, {'update_data': DATA_UPDATE})
+        record = memory_storage.get_record(CHAT, USER)
+        assert record == {'state': STATE, 'data': dict(DATA, **DATA_UPDATE)}
+        record['data'].clear()
+        assert memory_storage.get_data(CHAT, USER) == dict(DATA, **DATA_UPDATE)
+
+        # Default implementation of BaseStorage
+        assert BaseStorage.get_record(memory_storage, CHAT, USER) == memory_storage.get_record(CHAT, USER)
+        BaseStorage.set_record(memory_storage, CHAT, USER, {'state': None, 'data': {}})
+        assert memory_storage.data[CHAT][USER] == {'state': None, 'data': {}}
+
+    def test_memory_state_index(self):
+        clock = [0]
+        memory_storage = MemoryStorage(ttl=10)
+        memory_storage._now = lambda: clock[0]
+
+        memory_storage.set_state(CHAT, USER, STATE)
+        memory_storage.set_state_many([(1, None), (2, 3)], STATE)
+        memory_storage.set_record(4, 5, {'state': 'Other'})
+        assert sorted(memory_storage.iter_addresses_in_state(STATE)) == sorted([(CHAT, USER), ('1', '1'), ('2', '3')])
+        assert memory_storage.count_states() == {STATE: 3, 'Other': 1}
+
+        memory_storage.transition(1, expected=STATE, state='Other')
+        memory_storage.reset_state(2, 3)
+        memory_storage.finish_many([(4, 5)])
+        assert list(memory_storage.iter_addresses_in_state(STATE)) == [(CHAT, USER)]
+        assert memory_storage.count_states() == {STATE: 1, 'Other': 1}
+
+        clock[0] = 5
+        memory_storage.get_state(1)
+        clock[0] = 12
+        memory_storage.expire()
+        assert memory_storage.count_states() == {'Other': 1}
+        assert BaseStorage.count_states(memory_storage) == {'Other': 1}
+        assert list(BaseStorage.iter_addresses_in_state(memory_storage, 'Other')) == [('1', '1')]
+        with pytest.raises(NotImplementedError):
+            BaseStorage.count_states(BaseStorage())
+
+    def test_migrate(self, tmpdir):
+        memory_storage = MemoryStorage()
+        for chat in range(25):
+            memory_storage.set_record(chat, chat + 1, {'state': STATE if chat % 2 else None, 'data': {'chat': chat}})
+        memory_storage.set_deadline(3, 4, 100.0)
+        records = list(memory_storage.iter_records())
+        assert [(chat, user) for chat, user, _ in records[:3]] == [('0', '1'), ('1', '2'), ('10', '11')]
+        assert records[1][2] == {'state': STATE, 'data': {'chat': 1}}
+        assert list(memory_storage.iter_records(start_after=(3, 4))) == records[19:]
+        with pytest.raises(NotImplementedError):
+            BaseStorage.iter_records(memory_storage)
+        chat_storage = MemoryStorage()
+        for user in (None, 4, 30):
+            chat_storage.set_record(3, user, {'state': STATE, 'data': {'user': user}})
+        chat_storage.set_state(4, 3, STATE)
+        chat_records = [('3', user, {'state': STATE, 'data': {'user': int(user) if user != '3' else None}})
+                        for user in ('3', '30', '4')]
+        assert list(chat_storage.iter_chat_records(3)) == chat_records
+        assert list(BaseStorage.iter_chat_records(chat_storage, 3)) == chat_records
+
+        sqlite_storage = SQLiteStorage(str(tmpdir.join('states.sqlite3')), max_batch=4)
+        reports = []
+        stats = migrate(memory_storage, sqlite_storage, batch_size=10, progress=reports.append, progress_every=20)
+        assert stats['records'] == 25 and stats['last'] == ('9', '10')
+        assert [report['records'] for report in reports] == [20, 25]
+        assert list(sqlite_storage.iter_records()) == records
+        assert sqlite_storage.get_deadlines() == [('3', '4', STATE, 100.0)]
+
+        # Resume copies only records after last copied one
+        target = MemoryStorage()
+        stats = migrate(sqlite_storage, target, batch_size=7, start_after=records[19][:2], progress=None)
+        assert stats['records'] == 5
+        assert list(target.iter_records()) == records[20:]
+        sqlite_storage.close()
+
+    def test_sharded(self, tmpdir):
+        for per_user in (False, True):
+            shards = [MemoryStorage(), SQLiteStorage(str(tmpdir.join('shard{}.sqlite3'.format(per_user))))]
+            sharded_storage = ShardedStorage(shards, per_user=per_user)
+            for chat in range(40):
+                sharded_storage.set_record(chat, None, {'state': STATE, 'data': {'chat': chat}})
+                sharded_storage.set_record(chat, chat + 1, {'state': 'Other', 'data': {}, 'deadline': 100.0})
+            sharded_storage.update_data_many([(chat, None) for chat in range(40)], DATA_UPDATE)
+            sharded_storage.flush()
+            assert all(sum(1 for _ in shard.iter_records()) for shard in shards)
+            if not per_user:
+                assert all(chat == str(int(user) - 1) for shard in shards for chat, user, _ in shard.iter_records()
+                           if chat != user)
+            records = list(sharded_storage.iter_records())
+            assert len(records) == 80 and records == sorted(records, key=lambda item: item[:2])
+            assert sharded_storage.count_states() == {STATE: 40, 'Other': 40}
+            assert sharded_storage.get_states_many([(chat, None) for chat in range(40)]) == [STATE] * 40
+
+            # Records are moved on first access and by rebalance, nothing is lost or duplicated
+            added = MemoryStorage()
+            sharded_storage.add_shard(added)
+            assert sharded_storage.get_data(7) == dict({'chat': 7}, **DATA_UPDATE)
+            assert sharded_storage.transition(8, 9, expected='Other', state=STATE, deadline=200.0)
+            assert list(sharded_storage.iter_records()) == [
+                (chat, user, dict(record, state=STATE, deadline=200.0) if (chat, user) == ('8', '9') else record)
+                for chat, user, record in records]
+            assert sharded_storage.rebalance() > 0
+            assert sharded_storage.rebalance() == 0
+            assert 0 < sum(1 for _, _, record in added.iter_records() if record['state'])
+            assert sharded_storage.count_states() == {STATE: 41, 'Other': 39}
+            assert sorted(sharded_storage.get_deadlines()) == sorted(
+                (str(chat), str(chat + 1), STATE, 200.0) if chat == 8 else (str(chat), str(chat + 1), 'Other', 100.0)
+                for chat in range(40))
+            for chat in range(40):
+                assert sharded_storage.get_record(chat) == {'state': STATE, 'data': dict({'chat': chat}, **DATA_UPDATE)}
+            assert sharded_storage.data['8']['9'] == {'state': STATE, 'data': {}}
+            sharded_storage.close()
+
+    def test_memory_bounded(self):
+        clock = [0]
+        memory_storage = MemoryStorage(max_entries=2, ttl=10)
+        memory_storage._now = lambda: clock[0]
+
+        assert memory_storage.get_state(1) is None
+        assert memory_storage.get_data(1) == {}
+        assert memory_storage.data == {}
+
+        memory_storage.set_state(1, state=STATE)
+        memory_storage.set_state(2, state=STATE)
+        memory_storage.get_state(1)
+        memory_storage.set_state(3, state=STATE)
+        assert memory_storage.get_states_many([(1, None), (2, None), (3, None)]) == [STATE, None, STATE]
+        assert memory_storage.stats == {'entries': 2, 'evicted': 1, 'expired': 0}
+
+        clock[0] = 5
+        memory_storage.get_state(3)
+        clock[0] = 12
+        assert memory_storage.get_state(1) is None
+        assert memory_storage.get_state(3) == STATE
+        clock[0] = 30
+        assert memory_storage.expire() == 1
+        assert memory_storage.stats == {'entries': 0, 'evicted': 1, 'expired': 2}
+
+        # Records in use by other threads are neither evicted nor expired
+        memory_storage.set_state(1, state=STATE)
+        memory_storage.set_state(2, state=STATE)
+        busy = memory_storage._lock(memory_storage._key(1, None))
+        assert busy is not memory_storage._lock(memory_storage._key(3, None))
+        with busy:
+            memory_storage.set_state(3, state=STATE)
+            assert memory_storage.get_states_many([(1, None), (2, None), (3, None)]) == [STATE, None, STATE]
+            clock[0] = 45
+            assert memory_storage.expire() == 1
+            assert memory_storage.get_state(1) == STATE
+
+        # Any write sweeps idle records, not only creation of record
+        memory_storage.set_state(4, state=STATE)
+        clock[0] = 50
+        memory_storage.get_state(1)
+        clock[0] = 58
+        memory_storage.set_state(1, state=STATE)
+        assert memory_storage.stats == {'entries': 1, 'evicted': 2, 'expired': 4}
+
+    def test_memory_bounded_concurrent(self, tmpdir):
+        memory_storage = MemoryStorage(max_entries=2, ttl=0.005, expire_interval=0.001, path=str(tmpdir),
+                                       fsync_interval=0, snapshot_every=None, lock_stripes=8)
+
+        def increment(data):
+            time.sleep(0)
+            data['counter'] = data.get('counter', 0) + 1
+            return data
+
+        def work(n):
+            for i in range(300):
+                user = n * 100 + i % 20
+                if not memory_storage.transition(CHAT, user, expected=None, state=STATE):
+                    memory_storage.transition(CHAT, user, expected=STATE, state='Other')
+                memory_storage.mutate_data(CHAT, user, increment)
+
+        # Switch threads often, so sweeps interleave with writes
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        # Writes never land on forgotten records: index and journal match stored records
+        records = memory_storage._dump()
+        assert len(records) <= 2 + len(threads)
+        assert memory_storage.count_states() == dict(collections.Counter(state for _, state, _ in records if state))
+        memory_storage.close()
+        memory_storage = MemoryStorage(path=str(tmpdir))
+        assert sorted(memory_storage._dump()) == sorted(records)
+        memory_storage.close()
+
+    def test_memory_many(self):
+        memory_storage = MemoryStorage()
+        addresses = [(CHAT, USER), (CHAT, None), (None, USER)]
+
+        assert memory_storage.get_states_many(addresses, default='') == ['', '', '']
+        assert memory_storage.data == {}
+
+        memory_storage.set_state_many(addresses, STATE)
+        memory_storage.update_data_many(addresses[:2], DATA)
+        assert memory_storage.get_states_many(addresses) == [STATE] * 3
+        assert memory_storage.get_data_many(addresses) == [DATA, DATA, {}]
+        assert memory_storage.get_data(CHAT) is not memory_storage.get_data(CHAT, USER)
+
+        memory_storage.finish_many(addresses[1:])
+        assert memory_storage.get_states_many(addresses) == [STATE, None, None]
+        assert memory_storage.get_data_many(addresses) == [DATA, {}, {}]
+
+    def test_pool(self):
+        class Connection:
+            def __init__(self):
+                self.open = True
+
+            def close(self):
+                self.open = False
+
+        pool = ConnectionPool(Connection, min_size=1, max_size=2, timeout=0.01, check=lambda connection: connection.open)
+        assert pool.stats['size'] == 1
+
+        assert not pool.checked_out
+        with pool.connection() as first:
+            with pool.connection() as nested:
+                assert nested is first and pool.checked_out
+            assert pool.stats['in_use'] == 1
+
+            result = []
+            thread = threading.Thread(target=lambda: result.append(pool._checkout()))
+            thread.start()
+            thread.join()
+            assert result[0] is not first
+            assert pool.stats == {'size': 2, 'idle': 0, 'in_use': 2, 'waits': 0, 'wait_time': 0.0}
+
+            with pytest.raises(TimeoutError):
+                pool._checkout()
+            assert pool.stats['waits'] == 1
+            pool._checkin(result[0])
+
+        first.close()
+        with pool.connection() as connection:
+            assert connection.open
+            pool.discard()
+        assert pool.stats['size'] == 1
+
+        pool.close()
+        assert pool.stats['size'] == 0
+        with pytest.raises(RuntimeError):
+            with pool.connection():
+                pass
+
     @pytest.mark.db
     def test_rethinkdb(self, cmdopts):
         from fsm_telebot.storage.rethinkdb import RethinkDBStorage
@@ -63,6 +637,110 @@ class TestStorage:
 
         memory_storage.finish(chat, user)
         assert memory_storage.data[chat][user] == {'state': None, 'data': {}}
+        assert memory_storage.get_state(chat, 'missing', default='') == ''
+        assert memory_storage.get_data('missing', default={}) == {}
+        assert memory_storage.get_record('missing') == {'state': None, 'data': {}}
 
         memory_storage.close()
         assert memory_storage.data == {}
+
+    @pytest.mark.db
+    def test_rethinkdb_many(self, cmdopts):
+        from fsm_telebot.storage.rethinkdb import RethinkDBStorage
+
+        storage = RethinkDBStorage(host=cmdopts.getoption('--dbhost'), port=cmdopts.getoption('--dbport'), db=cmdopts.getoption('--db'),
+                                   user=cmdopts.getoption('--dbuser'), password=cmdopts.getoption('--dbpassword'),
+                                   timeout=cmdopts.getoption('--dbtimeout'))
+        addresses = [(CHAT, USER), (CHAT, None), (None, USER)]
+
+        storage.set_state_many(addresses, STATE)
+        storage.update_data_many(addresses[:2], DATA)
+        assert storage.get_states_many(addresses) == [STATE] * 3
+        assert storage.get_data_many(addresses, default={}) == [DATA, DATA, {}]
+
+        storage.finish_many(addresses)
+        assert storage.get_states_many(addresses) == [None] * 3
+        storage.close()
+
+        storage = RethinkDBStorage(host=cmdopts.getoption('--dbhost'), port=cmdopts.getoption('--dbport'), db=cmdopts.getoption('--db'),
+                                   user=cmdopts.getoption('--dbuser'), password=cmdopts.getoption('--dbpassword'),
+                                   timeout=cmdopts.getoption('--dbtimeout'), codec=DataCodec(compress_above=0))
+        storage.set_record(CHAT, USER, {'state': STATE, 'data': DATA})
+        storage.set_record(CHAT, USER, {'state': 'Next', 'update_data': DATA_UPDATE})
+        assert storage.get_record(CHAT, USER) == {'state': 'Next', 'data': dict(DATA, **DATA_UPDATE)}
+        assert storage.patch_data(CHAT, USER, [('inc', 'counter')])['counter'] == 1
+        assert storage.get_data_many([(CHAT, USER)]) == [dict(DATA, counter=1, **DATA_UPDATE)]
+        storage.update_data(CHAT, USER, {7: 'x'})
+        assert storage.get_data(CHAT, USER)['7'] == 'x'
+        storage.finish(CHAT, USER)
+        storage.close()
+
+    @pytest.mark.db
+    def test_rethinkdb_cache(self, cmdopts):
+        from fsm_telebot.storage.rethinkdb import RethinkDBStorage
+
+        options = dict(host=cmdopts.getoption('--dbhost'), port=cmdopts.getoption('--dbport'), db=cmdopts.getoption('--db'),
+                       user=cmdopts.getoption('--dbuser'), password=cmdopts.getoption('--dbpassword'),
+                       timeout=cmdopts.getoption('--dbtimeout'))
+        storage = RethinkDBStorage(**options)
+        cached_storage = RethinkDBStorage(cache_size=10, **options)
+        assert cached_storage._feed_ready.wait(5)
+
+        cached_storage.set_state(CHAT, USER, STATE)
+        assert cached_storage.get_state(CHAT, USER) == STATE
+        assert cached_storage.get_state(CHAT, USER) == STATE
+        assert cached_storage.cache_stats['hits'] == 1
+
+        storage.update_data(CHAT, USER, DATA)
+        for _ in range(50):
+            if cached_storage.get_data(CHAT, USER) == DATA:
+                break
+            time.sleep(0.1)
+        assert cached_storage.get_data(CHAT, USER) == DATA
+
+        assert cached_storage.transition(CHAT, USER, expected=STATE, state='Next')
+        assert not storage.transition(CHAT, USER, expected=STATE, state='Other')
+        assert storage.mutate_data(CHAT, USER, lambda data: dict(data, counter=1)) == dict(DATA, counter=1)
+        assert storage.patch_data(CHAT, USER, [('inc', 'counter'), ('append', ('form', 'answers'), 'yes')]) == \
+            dict(DATA, counter=2, form={'answers': ['yes']})
+        assert storage.patch_data(2, 3, [('inc', 'counter'), ('remove', 'missing')]) == {'counter': 1}
+        storage.finish(2, 3)
+
+        storage.finish(CHAT, USER)
+        storage.close()
+        cached_storage.close()
+
+    def test_async_memory(self):
+        from fsm_telebot.storage.memory import AsyncMemoryStorage
+
+        chat, user = CHAT, USER
+        state, data, data_update = STATE, DATA.copy(), DATA_UPDATE.copy()
+        memory_storage = AsyncMemoryStorage()
+
+        async def run():
+            await memory_storage.set_state(chat, user, state)
+            await memory_storage.set_data(chat, user, data)
+            assert await memory_storage.get_state(chat, user) == state
+            assert await memory_storage.get_data(chat, user) == data
+
+            await memory_storage.update_data(chat, user, data_update)
+            data.update(data_update)
+            assert await memory_storage.get_data(chat, user) == data
+
+            await memory_storage.finish(chat, user)
+            assert memory_storage.data[chat][user] == {'state': None, 'data': {}}
+
+            assert await memory_storage.transition(chat, user, expected=None, state=state)
+            assert not await memory_storage.transition(chat, user, expected=None, state='Next')
+            assert await memory_storage.patch_data(chat, user, [('inc', 'counter')]) == {'counter': 1}
+            # Default implementation of AsyncBaseStorage
+            assert await AsyncBaseStorage.transition(memory_storage, chat, user, expected=state, state='Next')
+            assert await AsyncBaseStorage.patch_data(memory_storage, chat, user, [('inc', 'counter')]) == {'counter': 2}
+            assert memory_storage.data[chat][user] == {'state': 'Next', 'data': {'counter': 2}}
+
+            await memory_storage.close()
+            assert memory_storage.data == {}
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
@@ -1,10 +1,15 @@
 # -*- coding:utf-8; -*-
 
+import asyncio
+import threading
 import time
 
+import pytest
 from telebot import types
 
 import fsm_telebot
+from fsm_telebot.storage.cached import CachedStorage
+from fsm_telebot.states import State, StatesGroup, get_state
 from fsm_telebot.storage.memory import MemoryStorage
 
 USER, CHAT = '10100101', '10010101'  # random
@@ -53,3 +58,360 @@ class TestTeleBot:
         assert memory_storage.data[chat][user] == {'state': None, 'data': {}}
 
         memory_storage.close()
+
+    def test_cached_storage(self):
+        memory_storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=CachedStorage(memory_storage), threaded=False)
+
+        @bot.message_handler(func=lambda message: True)
+        def handler(message):
+            bot.set_state(STATE, 11)
+            bot.update_data(DATA, 11)
+            bot.update_data(DATA_UPDATE, 11)
+            bot.set_state(STATE, 12)
+            assert memory_storage.data == {}
+
+        # Write of other thread is not flushed by handler
+        thread = threading.Thread(target=bot.storage.set_state, args=(13, None, STATE))
+        thread.start()
+        thread.join()
+        bot.process_new_messages([self.create_text_message('1')])
+        assert memory_storage.data == {'11': {'11': {'state': STATE, 'data': dict(DATA, **DATA_UPDATE)}},
+                                       '12': {'12': {'state': STATE, 'data': {}}}}
+        # State and data of sender are written with one call
+        assert bot.storage.stats['writes'] == 2
+        bot.storage.flush()
+        assert memory_storage.get_state(13) == STATE
+
+    def test_ordered(self):
+        storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, num_threads=2, ordered=True)
+        handled = []
+
+        @bot.message_handler(state='Second')
+        def second(message):
+            handled.append((message.chat.id, 'Second'))
+            bot.reset_state(message.chat.id)
+
+        @bot.message_handler(func=lambda message: True)
+        def first(message):
+            time.sleep(0.1)
+            handled.append((message.chat.id, 'First'))
+            bot.set_state('Second', message.chat.id)
+
+        messages = [self.create_text_message('1'), self.create_text_message('2')]
+        other = self.create_text_message('3')
+        other.chat = types.User(12, False, 'test')
+        bot.process_new_messages(messages + [other])
+        bot.worker_pool.close()
+
+        assert [entry for entry in handled if entry[0] == 11] == [(11, 'First'), (11, 'Second')]
+        assert (12, 'First') in handled
+        stats = bot.worker_pool.stats
+        assert sum(shard['processed'] for shard in stats) == 3
+        assert all(shard['depth'] == 0 for shard in stats)
+
+    def test_states_group(self):
+        class Order(StatesGroup):
+            product = State()
+            address = State('address')
+
+        assert Order.product == 'Order:product' and Order.address == 'address'
+        assert get_state(Order.address.id) is Order.address and Order.address.id == Order.product.id + 1
+        assert Order.next() is Order.product and Order.next(Order.product) is Order.address and Order.next('address') is None
+        assert Order.previous(Order.product) is None and 'Order:product' in Order
+
+        storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        handled = []
+        bot.message_handler(state='typo')(handled.append)
+        with pytest.raises(ValueError):
+            bot.register_states(Order)
+
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        bot.register_states(Order)
+        bot.message_handler(state=Order.address)(handled.append)
+        with pytest.raises(ValueError):
+            bot.message_handler(state='Order:adress')(handled.append)
+        with pytest.raises(ValueError):
+            bot.set_state('Order:adress', 11)
+
+        bot.set_state(Order.address, 11)
+        assert storage.get_state(11) == Order.address
+        bot.process_new_messages([self.create_text_message('1')])
+        assert len(handled) == 1
+
+    def test_router(self):
+        bot = fsm_telebot.TeleBot('', threaded=False)
+        handled = []
+
+        for word in ('apple', 'banana', 'cherry'):
+            bot.message_handler(regexp=word)(lambda message, word=word: handled.append(word))
+        bot.message_handler(commands=['start', 'help'], regexp='now')(lambda message: handled.append('start now'))
+        bot.message_handler(commands=['start'])(lambda message: handled.append('start'))
+        bot.message_handler(func=lambda message: True)(lambda message: handled.append('default'))
+
+        texts = ('a Cherry and a banana', 'berry', 'nothing', '/start', '/help', '/start now', '/start@bot banana')
+        for text in texts:
+            bot.process_new_messages([self.create_text_message(text)])
+        assert handled == ['banana', 'default', 'default', 'start', 'default', 'start now', 'banana']
+        assert bot.message_handlers.router()._combined is not None
+
+        # Pattern with inline flags can't be combined, so all regexps are tested one by one
+        bot.message_handlers.insert(0, bot._build_handler_dict(lambda message: handled.append('flags'), regexp=r'(?i)^b'))
+        del handled[:]
+        for text in texts:
+            bot.process_new_messages([self.create_text_message(text)])
+        assert handled == ['banana', 'flags', 'default', 'start', 'default', 'start now', 'banana']
+        assert bot.message_handlers.router()._combined is None
+
+        # Nor can pattern with inline flags in the middle
+        del bot.message_handlers[0]
+        assert bot.message_handlers.router()._combined is not None
+        bot.message_handlers.append(bot._build_handler_dict(lambda message: handled.append('flags'), regexp=r'^no(?x)'))
+        assert bot.message_handlers.router()._combined is None
+
+    def test_fsm_context(self):
+        class CountingStorage(MemoryStorage):
+            calls = 0
+
+            def __getattribute__(self, name):
+                if name in ('get_state', 'get_data', 'get_record', 'set_state', 'set_data', 'update_data',
+                            'set_record', 'reset_state'):
+                    object.__setattr__(self, 'calls', object.__getattribute__(self, 'calls') + 1)
+                return super(CountingStorage, self).__getattribute__(name)
+
+        storage = CountingStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        storage.set_data(11, data={'step': 0})
+        storage.calls = 0
+
+        @bot.message_handler(commands=['start'])
+        def start(message):
+            context = bot.current_context()
+            bot.set_state('Form', message.chat.id)
+            bot.update_data({'name': 'test'}, message.chat.id)
+            bot.update_data({'step': 1}, message.chat.id)
+            assert bot.get_data(message.chat.id) == {'step': 1, 'name': 'test'}
+            assert bot.get_state(message.chat.id) == 'Form'
+            assert context.changed and storage.get_state(11) is None
+            bot.update_data({'other': True}, 12)
+
+        @bot.message_handler(state='Form')
+        def fail(message):
+            bot.finish_user(message.chat.id)
+            raise ValueError
+
+        bot.process_new_messages([self.create_text_message('/start')])
+        assert storage.get_record(11) == {'state': 'Form', 'data': {'step': 1, 'name': 'test'}}
+        assert storage.get_data(12) == {'other': True}
+        # get_data and set_record of context, get_state check and update_data of other chat, then two reads above
+        assert storage.calls == 6
+        assert bot.current_context() is None
+
+        with pytest.raises(ValueError):
+            bot.process_new_messages([self.create_text_message('1')])
+        assert bot.get_state(11) == 'Form'
+
+    def test_fsm_context_any_keys(self):
+        storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+
+        @bot.message_handler(commands=['start'])
+        def start(message):
+            bot.set_state('Form', message.chat.id)
+            bot.update_data({42: 'x'}, message.chat.id)
+            bot.update_data({(1, 2): 'y'}, message.chat.id)
+
+        bot.process_new_messages([self.create_text_message('/start')])
+        assert storage.get_record(11) == {'state': 'Form', 'data': {42: 'x', (1, 2): 'y'}}
+
+    def test_timer_wheel(self):
+        clock, fired = [1000.0], []
+        wheel = fsm_telebot.timers.TimerWheel(lambda key, value: fired.append(key), tick=1, slots=8,
+                                              clock=lambda: clock[0])
+        wheel.schedule('soon', 1002.5)
+        wheel.schedule('late', 1020)
+        wheel.schedule('cancelled', 1001)
+        wheel.schedule('past', 900)
+        assert wheel.cancel('cancelled') and not wheel.cancel('cancelled')
+
+        assert wheel.advance(1001) == 1 and fired == ['past']
+        assert wheel.advance(1002.9) == 0
+        assert wheel.advance(1003) == 1 and fired == ['past', 'soon']
+        # Wheel turned twice, late timer waited in its slot
+        assert wheel.advance(1019) == 0
+        assert wheel.advance(1100) == 1 and fired == ['past', 'soon', 'late']
+        assert len(wheel) == 0
+
+    def test_state_timeout(self):
+        storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        timed_out = []
+
+        @bot.timeout_handler(state='Form', timeout=60)
+        def form_timeout(chat_id, user_id, state):
+            timed_out.append((chat_id, user_id, state))
+            bot.set_data({'timed_out': True}, chat_id, user_id)
+
+        @bot.message_handler(commands=['start'])
+        def start(message):
+            bot.set_state('Form', message.chat.id)
+
+        bot.process_new_messages([self.create_text_message('/start')])
+        bot.set_state('Form', 12)
+        bot.set_state('Other', 12)
+        (chat, user, state, deadline), = storage.get_deadlines()
+        assert (chat, user, state) == ('11', '11', 'Form')
+        assert deadline > time.time() + 50
+
+        # Timers are restored by new bot, i.e. after restart
+        bot._timers.close()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        bot.register_state_timeout('Form', 60, form_timeout)
+        assert len(bot._timers) == 1
+        assert bot._timers.advance(deadline + 1) == 1
+        # Ids of restored timers are converted back to int
+        assert timed_out == [(11, 11, 'Form')]
+        assert storage.get_record(11) == {'state': None, 'data': {'timed_out': True}}
+        assert storage.get_deadlines() == []
+
+        # Deadline is written with state by transition
+        assert bot.transition(None, 'Form', 13)
+        assert [deadline[:3] for deadline in storage.get_deadlines()] == [('13', '13', 'Form')]
+        assert bot.transition('Form', 'Other', 13)
+        assert storage.get_deadlines() == []
+        bot._timers.close()
+
+    def test_filter_order(self):
+        class CountingStorage(MemoryStorage):
+            reads = 0
+
+            def get_state(self, *args, **kwargs):
+                self.reads += 1
+                return super(CountingStorage, self).get_state(*args, **kwargs)
+
+        storage = CountingStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        bot.profiler = fsm_telebot.dispatch.FilterProfiler()
+        calls, handled = [], []
+
+        # func is expensive, so it runs only after content types and commands passed
+        bot.message_handler(commands=['start'], func=lambda message: calls.append('func') or True)(
+            lambda message: handled.append('start'))
+        bot.message_handler(state='Test')(lambda message: handled.append('Test'))
+
+        bot.process_new_messages([self.create_text_message('/start')])
+        assert handled == ['start'] and calls == ['func']
+        assert storage.reads == 0
+
+        bot.process_new_messages([self.create_text_message('/help')])
+        assert calls == ['func']
+        assert storage.reads == 1
+
+        stats = {(record['handler'].rsplit('.', 1)[-1], record['filter']): record for record in bot.profiler.stats()}
+        assert stats[('<lambda>', 'content_types')]['calls'] == 1
+        assert stats[('<lambda>', 'func')]['rejection_rate'] == 0
+        assert stats[('*', 'state')]['calls'] == 1
+        bot.profiler.reset()
+        assert bot.profiler.stats() == []
+
+    def test_state_index(self):
+        class CountingStorage(MemoryStorage):
+            reads = 0
+
+            def get_state(self, *args, **kwargs):
+                self.reads += 1
+                return super(CountingStorage, self).get_state(*args, **kwargs)
+
+        storage = CountingStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        handled = []
+
+        for state in ('First', 'Second', 'Third'):
+            bot.message_handler(state=state)(lambda message, state=state: handled.append(state))
+
+        bot.message_handler(func=lambda message: message.text == 'stateless')(lambda message: handled.append(None))
+
+        bot.set_state('Second', 11)
+        bot.process_new_messages([self.create_text_message('1')])
+        assert handled == ['Second']
+        assert storage.reads == 1
+
+        bot.reset_state(11)
+        bot.process_new_messages([self.create_text_message('stateless')])
+        assert handled == ['Second', None]
+        assert storage.reads == 2
+
+        # State isn't read, if static filters of every stated handler reject update
+        storage = CountingStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        handled = []
+        bot.message_handler(state='Photo', content_types=['photo'])(lambda message: handled.append('Photo'))
+        bot.message_handler(state='Command', commands=['done'])(lambda message: handled.append('Command'))
+        bot.message_handler(func=lambda message: True)(lambda message: handled.append(None))
+        bot.set_state('Command', 11)
+        bot.process_new_messages([self.create_text_message('text')])
+        assert handled == [None] and storage.reads == 0
+        bot.process_new_messages([self.create_text_message('/done')])
+        assert handled == [None, 'Command'] and storage.reads == 1
+
+    def test_callback_query_state(self):
+        storage = MemoryStorage()
+        bot = fsm_telebot.TeleBot('', storage=storage, threaded=False)
+        handled = []
+
+        @bot.callback_query_handler(func=lambda query: query.data == 'yes', state='Confirm')
+        def confirm(query):
+            handled.append(query.data)
+
+        message = self.create_text_message('1')
+        message.from_user = types.User(12, False, 'test')
+        query = types.CallbackQuery(1, message.from_user, 'yes', 'instance', message=message)
+
+        bot.process_new_callback_query([query])
+        assert handled == []
+
+        bot.set_state('Confirm', 11, 12)
+        bot.process_new_callback_query([query])
+        assert handled == ['yes']
+
+        tests = bot.callback_query_handlers[0]['tests']
+        bot.process_new_callback_query([query])
+        assert bot.callback_query_handlers[0]['tests'] is tests
+
+    def test_async_message_handler(self):
+        from fsm_telebot.aio import AsyncTeleBot
+        from fsm_telebot.storage.memory import AsyncMemoryStorage
+
+        loop = asyncio.new_event_loop()
+        bot = AsyncTeleBot('', storage=AsyncMemoryStorage(), loop=loop)
+        handled = []
+        with pytest.raises(TypeError):
+            bot.register_state_timeout('Test', 60)
+
+        @bot.message_handler(state='Test')
+        async def state_handler(message):
+            await asyncio.sleep(0)
+            handled.append(await bot.get_state(11))
+
+        @bot.message_handler(func=lambda message: True)
+        def default_handler(message):
+            handled.append(None)
+
+        async def run():
+            bot.process_new_messages([self.create_text_message('1')])
+            await bot.join()
+            await bot.set_state('Test', 11)
+            bot.process_new_messages([self.create_text_message('1')])
+            await bot.join()
+
+            assert not await bot.transition('Other', 'Next', 11)
+            assert await bot.transition('Test', 'Next', 11)
+            assert await bot.mutate_data(lambda data: dict(data, a=1), 11) == {'a': 1}
+            assert await bot.patch_data([('inc', 'a')], 11) == {'a': 2}
+            assert await bot.get_state(11) == 'Next'
+
+        loop.run_until_complete(run())
+        loop.close()
+        assert handled == [None, 'Test']